@@ -0,0 +1,65 @@
+# Load time of a synthetic scene from ascii .pcd, binary .pcd and its binary cloud
+# (cloud_reader.write_binary_cloud), through both the streaming and whole cloud readers,
+# checking each gives the same downsampled cloud.
+# Usage (from the api directory):
+#   python -m benchmarks.binary_cloud --points 1000000
+import argparse
+import os
+import shutil
+import statistics
+import tempfile
+import time
+
+import numpy as np
+import open3d as o3d
+
+from benchmarks.synthetic_scene import SceneParams, make_scene, write_scene_pcd
+from tactil_api.cloud_reader import read_cloud_downsampled, write_binary_cloud
+from tactil_api.process_cloud import read_cloud
+
+
+def timed(function, repeat: int):
+    times, result = [], None
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - tic)
+    return statistics.median(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark loading clouds from text, binary .pcd and binary clouds")
+    parser.add_argument("--points", type=int, default=1_000_000)
+    parser.add_argument("--voxel-size", type=float, default=0.05)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        binary_path = os.path.join(directory, "binary.pcd")
+        write_scene_pcd(make_scene(SceneParams(point_count=args.points)), binary_path)
+        ascii_path = os.path.join(directory, "ascii.pcd")
+        o3d.io.write_point_cloud(ascii_path, o3d.io.read_point_cloud(binary_path), write_ascii=True)
+        cached_path = os.path.join(directory, "cached.pcd")
+        shutil.copy(ascii_path, cached_path)
+        convert_time, cloud_dir = timed(lambda: write_binary_cloud(cached_path), 1)
+
+        print(f"{args.points} points, binary cloud written in {convert_time:.3f} s")
+        print(f"  {'source':<14} {'size (MB)':>10} {'streamed (s)':>13} {'whole (s)':>10}")
+        reference = None
+        for name, path in [("ascii .pcd", ascii_path), ("binary .pcd", binary_path), ("binary cloud", cached_path)]:
+            streamed_time, pcd = timed(lambda: read_cloud_downsampled(path, 2, 2.0, args.voxel_size), args.repeat)
+            whole_time, _ = timed(lambda: read_cloud(path), args.repeat)
+            if name == "binary cloud":
+                size = sum(os.path.getsize(os.path.join(cloud_dir, f)) for f in os.listdir(cloud_dir))
+            else:
+                size = os.path.getsize(path)
+            print(f"  {name:<14} {size / 1e6:>10.1f} {streamed_time:>13.3f} {whole_time:>10.3f}")
+            points = np.asarray(pcd.points)
+            if reference is None:
+                reference = points
+            elif points.shape != reference.shape or not np.allclose(points, reference, atol=1e-4):
+                raise AssertionError(f"{name} downsampled differently from ascii .pcd")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+# Compares the MeanShift and azimuth histogram normal clusterers on synthetic wall normals,
+# reporting runtime, adjusted Rand index against the true wall directions, and how many
+# wall directions were recovered (a cluster mean within 5 degrees of the true direction).
+# Usage (from the api directory): python -m benchmarks.normal_clustering [point_count ...]
+import sys
+import time
+
+import numpy as np
+from sklearn.metrics import adjusted_rand_score
+
+from tactil_api.process_cloud import cluster_by_normal, cluster_by_normal_histogram
+from tactil_api.SuppressStream import SuppressStream
+
+# azimuth of each wall direction (degrees) and its share of the points
+WALL_DIRECTIONS = np.array([0, 90, 180, 270, 30, 210])
+WALL_WEIGHTS = np.array([0.25, 0.2, 0.2, 0.15, 0.1, 0.1])
+
+
+def synthetic_normals(point_count: int, noise_degrees: float, rng: np.random.Generator):
+    truth = rng.choice(len(WALL_DIRECTIONS), size=point_count, p=WALL_WEIGHTS)
+    azimuth = np.radians(WALL_DIRECTIONS[truth] + rng.normal(0, noise_degrees, point_count))
+    vertical = rng.normal(0, 0.05, point_count)
+    normals = np.stack([np.cos(azimuth), np.sin(azimuth), vertical], axis=1)
+    return normals, truth
+
+
+def walls_recovered(unit_normals: np.ndarray, labels: np.ndarray, tolerance_degrees: float = 5) -> int:
+    cluster_azimuths = []
+    for label in np.unique(labels):
+        mean = unit_normals[labels == label].mean(axis=0)
+        cluster_azimuths.append(np.degrees(np.arctan2(mean[1], mean[0])))
+    cluster_azimuths = np.array(cluster_azimuths)
+    recovered = 0
+    for direction in WALL_DIRECTIONS:
+        difference = np.abs((cluster_azimuths - direction + 180) % 360 - 180)
+        recovered += np.any(difference < tolerance_degrees)
+    return recovered
+
+
+def main(point_counts: list[int], noise_degrees: float = 3.0):
+    rng = np.random.default_rng(0)
+    clusterers = {"meanshift": cluster_by_normal, "histogram": cluster_by_normal_histogram}
+    print(f"{'points':>8} {'clusterer':>10} {'time (s)':>9} {'clusters':>9} {'ARI':>6} {'walls':>6}")
+    for point_count in point_counts:
+        normals, truth = synthetic_normals(point_count, noise_degrees, rng)
+        for name, clusterer in clusterers.items():
+            with SuppressStream(sys.stdout):
+                tic = time.perf_counter()
+                unit_normals, labels = clusterer(normals)
+                elapsed = time.perf_counter() - tic
+            ari = adjusted_rand_score(truth, labels)
+            walls = walls_recovered(unit_normals, labels)
+            print(f"{point_count:>8} {name:>10} {elapsed:>9.3f} {len(np.unique(labels)):>9} {ari:>6.3f} "
+                  f"{walls:>3}/{len(WALL_DIRECTIONS)}")
+
+
+if __name__ == "__main__":
+    counts = [int(arg) for arg in sys.argv[1:]] or [5_000, 20_000, 50_000]
+    main(counts)
@@ -0,0 +1,57 @@
+# Microbenchmark of the horizontal normal filter and label partitioning, comparing the
+# previous per-point/per-label loops with the vectorised versions in pcd_operations.
+# Usage (from the api directory): python -m benchmarks.normal_filter_partition [point_count ...]
+import sys
+import time
+
+import numpy as np
+
+from tactil_api.pcd_operations import partition_indices_by_labels
+
+
+def normal_filter_loop(normals: np.ndarray, epsilon: float) -> np.ndarray:
+    vertical = np.array([0.0, 0.0, 1.0])
+    dot = np.array([np.dot(vertical, norm) for norm in normals])
+    return np.arange(len(dot))[np.abs(dot) < epsilon]
+
+
+def normal_filter_vectorised(normals: np.ndarray, epsilon: float) -> np.ndarray:
+    return np.flatnonzero(np.abs(normals[:, 2]) < epsilon)
+
+
+def partition_loop(labels: np.ndarray) -> list[np.ndarray]:
+    clusters = []
+    for label in range(np.amax(labels) + 1):
+        current_cluster_mask = labels == label
+        clusters.append(np.arange(labels.shape[0])[current_cluster_mask])
+    return clusters
+
+
+def time_call(fn, *args):
+    tic = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - tic
+
+
+def main(point_counts: list[int], label_count: int = 200):
+    rng = np.random.default_rng(0)
+    print(f"{'points':>10} {'stage':>16} {'loop (s)':>10} {'vectorised (s)':>15} {'speedup':>8}")
+    for point_count in point_counts:
+        normals = rng.normal(size=(point_count, 3))
+        normals /= np.linalg.norm(normals, axis=1).reshape(-1, 1)
+        labels = rng.integers(-1, label_count, size=point_count)
+
+        loop_result, loop_time = time_call(normal_filter_loop, normals, 0.2)
+        vec_result, vec_time = time_call(normal_filter_vectorised, normals, 0.2)
+        assert np.array_equal(loop_result, vec_result)
+        print(f"{point_count:>10} {'normal filter':>16} {loop_time:>10.3f} {vec_time:>15.4f} {loop_time/vec_time:>7.0f}x")
+
+        loop_result, loop_time = time_call(partition_loop, labels)
+        vec_result, vec_time = time_call(partition_indices_by_labels, labels)
+        assert all(np.array_equal(a, b) for a, b in zip(loop_result, vec_result))
+        print(f"{point_count:>10} {'label partition':>16} {loop_time:>10.3f} {vec_time:>15.4f} {loop_time/vec_time:>7.0f}x")
+
+
+if __name__ == "__main__":
+    counts = [int(arg) for arg in sys.argv[1:]] or [1_000_000, 10_000_000]
+    main(counts)
@@ -0,0 +1,164 @@
+# End to end benchmark of process() and generate() on synthetic floor plans.
+# Generates (or reuses) a synthetic scene, runs the pipeline with the stage profiler,
+# and scores the recovered walls against the ground truth, so that performance changes
+# can be checked for accuracy as well as speed.
+# Usage (from the api directory):
+#   python -m benchmarks.pipeline --points 1000000 --rooms 4 --clutter 10
+#   python -m benchmarks.pipeline --points 100000 1000000 10000000 --json results.json
+#   python -m benchmarks.pipeline --preset fast accurate
+#   python -m benchmarks.pipeline --no-normals  # estimates normals, as for scans without them
+import argparse
+import dataclasses
+import itertools
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from benchmarks.synthetic_scene import SceneParams, make_scene, write_scene_pcd
+from benchmarks.wall_scoring import score_walls
+from tactil_api.generate_stl import PhysicalParameters, generate
+from tactil_api.parameters import PRESETS, WALL_ENGINES, ProcessParameters, resolve_parameters
+from tactil_api.process_cloud import NORMAL_CLUSTERERS, process
+from tactil_api.profiler import StageProfiler
+from tactil_api.SuppressStream import SuppressStream
+
+MODEL_PARAMS = PhysicalParameters(
+    model_scale_factor=1 / 120,
+    wall_height_mm=2.5,
+    wall_thickness_mm=2.5,
+    border_width_mm=5,
+    floor_thickness_mm=5,
+)
+
+
+def scene_cloud(params: SceneParams, cache_dir: str, normals: bool = True):
+    """Path of the scene's .pcd, generating it if it is not already in cache_dir.
+    normals: False for a cloud of the same points without normals"""
+    scene = make_scene(params)
+    path = os.path.join(cache_dir, f"scene_{params.slug()}{'' if normals else '_points'}.pcd")
+    if not os.path.exists(path):
+        tic = time.perf_counter()
+        write_scene_pcd(scene, path + ".tmp", normals)
+        os.replace(path + ".tmp", path)
+        print(f"Generated {params.point_count} point scene in {time.perf_counter() - tic:.1f} s", file=sys.stderr)
+    return scene, path
+
+
+def run_once(cloud_path: str, output_dir: str, parameters: ProcessParameters, workers: int):
+    process_profiler, generate_profiler = StageProfiler(), StageProfiler()
+    with SuppressStream(sys.stdout):
+        vector_map, _ = process(cloud_path, os.path.join(output_dir, "images"), parameters,
+                                profiler=process_profiler, workers=workers)
+        generate(vector_map, MODEL_PARAMS, visualise=False, output_folder=os.path.join(output_dir, "stl"),
+                 profiler=generate_profiler)
+    return vector_map, process_profiler.report(), generate_profiler.report()
+
+
+def median_stages(reports: list[dict]) -> list[dict]:
+    """Per stage median over repeated runs (of the same pipeline, so stages line up)"""
+    stages = []
+    for records in zip(*[report["stages"] for report in reports]):
+        stage = dict(records[0])
+        for key in ("wall_time", "cpu_time", "peak_rss"):
+            values = [r[key] for r in records if r[key] is not None]
+            stage[key] = statistics.median(values) if values else None
+        stages.append(stage)
+    return stages
+
+
+def print_stages(prefix: str, stages: list[dict]):
+    for s in stages:
+        rss = "" if s["peak_rss"] is None else f"{s['peak_rss'] / 1e6:.0f}"
+        points = "" if s["points_out"] is None else str(s["points_out"])
+        print(f"  {prefix + s['name']:<22} {s['wall_time']:>9.3f} {s['cpu_time']:>9.3f} {rss:>14} {points:>11}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark process() and generate() on synthetic floor plans")
+    parser.add_argument("--points", type=int, nargs="+", default=[1_000_000], help="cloud sizes to run")
+    parser.add_argument("--rooms", type=int, default=4)
+    parser.add_argument("--walls", type=int, default=0, help="extra free standing partition walls")
+    parser.add_argument("--noise", type=float, default=0.01, help="position noise (m)")
+    parser.add_argument("--normal-noise", type=float, default=2.0, help="normal noise (degrees)")
+    parser.add_argument("--no-roof", action="store_true")
+    parser.add_argument("--clutter", type=int, default=0, help="furniture-like boxes")
+    parser.add_argument("--yaw", type=float, default=17.0, help="scene rotation (degrees)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=1, help="runs per cloud, stage times are medians")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="wall match distance (m)")
+    parser.add_argument("--preset", choices=list(PRESETS), nargs="+", default=["balanced"], help="presets to run")
+    parser.add_argument("--normal-clusterer", choices=list(NORMAL_CLUSTERERS), help="overrides the preset's")
+    parser.add_argument("--engine", choices=WALL_ENGINES, help="wall engine, overrides the preset's")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--no-streaming", action="store_true")
+    parser.add_argument("--no-normals", action="store_true", help="cloud without normals, so they are estimated")
+    parser.add_argument("--cache-dir", default=os.path.join(tempfile.gettempdir(), "tactil_benchmark_scenes"),
+                        help="where generated clouds are kept between runs")
+    parser.add_argument("--json", help="write all results to this file")
+    args = parser.parse_args()
+
+    os.makedirs(args.cache_dir, exist_ok=True)
+    overrides = {"load": {"streaming": not args.no_streaming}}
+    if args.normal_clusterer is not None:
+        overrides["clustering"] = {"normal_clusterer": args.normal_clusterer}
+    if args.engine is not None:
+        overrides["walls"] = {"engine": args.engine}
+    results = []
+    for point_count, preset in itertools.product(args.points, args.preset):
+        parameters = resolve_parameters(overrides, preset=preset)
+        params = SceneParams(
+            point_count=point_count,
+            room_count=args.rooms,
+            extra_walls=args.walls,
+            position_noise=args.noise,
+            normal_noise_degrees=args.normal_noise,
+            roof=not args.no_roof,
+            clutter=args.clutter,
+            yaw_degrees=args.yaw,
+            seed=args.seed,
+        )
+        scene, cloud_path = scene_cloud(params, args.cache_dir, not args.no_normals)
+
+        process_reports, generate_reports = [], []
+        with tempfile.TemporaryDirectory() as output_dir:
+            for _ in range(args.repeat):
+                vector_map, process_report, generate_report = run_once(cloud_path, output_dir, parameters, args.workers)
+                process_reports.append(process_report)
+                generate_reports.append(generate_report)
+        score = score_walls(vector_map, scene.walls, args.tolerance)
+
+        process_stages, generate_stages = median_stages(process_reports), median_stages(generate_reports)
+        process_time = statistics.median(r["total_wall_time"] for r in process_reports)
+        generate_time = statistics.median(r["total_wall_time"] for r in generate_reports)
+        peak_rss = max(r["peak_rss"] or 0 for r in process_reports + generate_reports)
+        print(f"{point_count} points, {params.room_count} rooms, {len(scene.walls)} wall segments, {preset} preset: "
+              f"process {process_time:.3f} s, generate {generate_time:.3f} s, peak rss {peak_rss / 1e6:.0f} MB")
+        print(f"  {'stage':<22} {'wall (s)':>9} {'cpu (s)':>9} {'peak rss (MB)':>14} {'points out':>11}")
+        print_stages("process.", process_stages)
+        print_stages("generate.", generate_stages)
+        print(f"  walls found {score.walls_found}/{score.wall_count} from {score.edge_count} edges, "
+              f"precision {score.precision:.3f}, recall {score.recall:.3f}, f1 {score.f1:.3f}, "
+              f"mean error {score.mean_error * 100:.1f} cm")
+
+        results.append({
+            "scene": dataclasses.asdict(params),
+            "normals": not args.no_normals,
+            "preset": preset,
+            "parameters": dataclasses.asdict(parameters),
+            "workers": args.workers,
+            "process": {"total_wall_time": process_time, "stages": process_stages},
+            "generate": {"total_wall_time": generate_time, "stages": generate_stages},
+            "peak_rss": peak_rss,
+            "score": dataclasses.asdict(score),
+        })
+
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+# Compares the plane extractors of fit_planes: the fixed iteration Open3D loop
+# (segment_plane_indices) and adaptive RANSAC (segment_plane_indices_adaptive).
+# Each is timed on the clusters process() passes to plane fitting for a synthetic scene,
+# and on a cluster mixing two walls with a large floor patch, which the Open3D loop keeps
+# finding and rejecting. The recovered walls are then scored end to end for each method.
+# Usage (from the api directory):
+#   python -m benchmarks.plane_fit --points 100000 1000000
+import argparse
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.pipeline import scene_cloud
+from benchmarks.synthetic_scene import SceneParams
+from benchmarks.wall_scoring import score_walls
+from tactil_api.parameters import resolve_parameters
+from tactil_api.process_cloud import process, run_stages, segment_cluster_planes, split_clouds, stage_graph
+from tactil_api.profiler import StageProfiler
+from tactil_api.SuppressStream import SuppressStream
+
+METHODS = ["open3d", "adaptive"]
+
+
+def partition_clusters(cloud_path: str, image_dir: str) -> list[np.ndarray]:
+    """The clusters process() fits planes to, as point arrays"""
+    parameters = resolve_parameters()
+    graph = stage_graph(cloud_path, image_dir, True, False, 1, "process")
+    with SuppressStream(sys.stdout):
+        clusters = run_stages(graph, ["partition"], parameters, StageProfiler())["partition"]
+    return split_clouds(clusters)
+
+
+def walls_and_floor(seed: int = 0) -> np.ndarray:
+    """Two noisy walls meeting at a corner, standing on a larger floor patch"""
+    rng = np.random.default_rng(seed)
+    wall_a = np.c_[rng.uniform(0, 4, 1500), rng.normal(0, 0.01, 1500), rng.uniform(0, 0.5, 1500)]
+    wall_b = np.c_[rng.normal(0, 0.01, 1500), rng.uniform(0, 3, 1500), rng.uniform(0, 0.5, 1500)]
+    floor = np.c_[rng.uniform(0, 4, 4000), rng.uniform(0, 3, 4000), rng.normal(0, 0.01, 4000)]
+    return np.concatenate([wall_a, wall_b, floor])
+
+
+def time_method(clusters: list[np.ndarray], method: str, repeat: int):
+    parameters = resolve_parameters({"plane_fit": {"method": method}}).plane_fit
+    times, results = [], None
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        with SuppressStream(sys.stdout):
+            results = [segment_cluster_planes(points, parameters.seed + i, distance_threshold=parameters.distance_threshold,
+                                              num_iterations=parameters.num_iterations,
+                                              verticality_epsilon=parameters.verticality_epsilon,
+                                              min_plane_size=parameters.min_plane_size, max_planes=parameters.max_planes,
+                                              method=method, confidence=parameters.confidence)
+                       for i, points in enumerate(clusters)]
+        times.append(time.perf_counter() - tic)
+    planes = sum(len(indices) for indices, _, _ in results)
+    plane_points = sum(len(i) for indices, _, _ in results for i in indices)
+    return statistics.median(times), planes, plane_points
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the plane extractors of fit_planes")
+    parser.add_argument("--points", type=int, nargs="+", default=[1_000_000], help="scene sizes to run")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--cache-dir", default=tempfile.gettempdir() + "/tactil_benchmark_scenes")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as image_dir:
+        cases = [("walls and floor", None, [walls_and_floor()])]
+        for point_count in args.points:
+            scene, cloud_path = scene_cloud(SceneParams(point_count=point_count), args.cache_dir)
+            cases.append((f"{point_count} point scene", (scene, cloud_path), partition_clusters(cloud_path, image_dir)))
+
+        for name, scene_and_path, clusters in cases:
+            print(f"{name}: {len(clusters)} clusters, {sum(len(c) for c in clusters)} points")
+            print(f"  {'method':<10} {'time (s)':>9} {'planes':>7} {'plane points':>13} {'recall':>7} {'precision':>10}")
+            for method in METHODS:
+                seconds, planes, plane_points = time_method(clusters, method, args.repeat)
+                score = ""
+                if scene_and_path is not None:
+                    scene, cloud_path = scene_and_path
+                    with SuppressStream(sys.stdout):
+                        vector_map, _ = process(cloud_path, image_dir, resolve_parameters({"plane_fit": {"method": method}}))
+                    walls = score_walls(vector_map, scene.walls)
+                    score = f"{walls.recall:>7.3f} {walls.precision:>10.3f}"
+                print(f"  {method:<10} {seconds:>9.4f} {planes:>7} {plane_points:>13} {score}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+# Compares the per-box reference STL wall builder with the batched one, checking that
+# both produce the same triangles and reporting the time taken by each.
+# Usage (from the api directory): python -m benchmarks.stl_builder [wall_count ...]
+import sys
+import time
+
+import numpy as np
+
+from tactil_api.generate_stl import PhysicalParameters, boxes_to_mesh, wall_box_vertices, wall_meshes_per_box
+
+MODEL_PARAMS = PhysicalParameters(
+    model_scale_factor=1 / 120,
+    wall_height_mm=2.5,
+    wall_thickness_mm=2.5,
+    border_width_mm=5,
+    floor_thickness_mm=5,
+)
+
+
+def random_walls(wall_count: int, rng: np.random.Generator):
+    """Centers, extents and z rotations in the form generate() passes to the builders"""
+    centers = np.zeros((wall_count, 3))
+    centers[:, 0:2] = rng.uniform(-200, 200, size=(wall_count, 2))
+    extents = np.stack([rng.uniform(1, 50, wall_count), np.full(wall_count, 0.8), np.full(wall_count, 8)], axis=1)
+    angles = rng.uniform(-np.pi, np.pi, wall_count)
+    rotations = np.zeros((wall_count, 3, 3))
+    rotations[:, 0, 0] = rotations[:, 1, 1] = np.cos(angles)
+    rotations[:, 0, 1] = -np.sin(angles)
+    rotations[:, 1, 0] = np.sin(angles)
+    rotations[:, 2, 2] = 1
+    return centers, extents, rotations
+
+
+def main(wall_counts: list[int]):
+    rng = np.random.default_rng(0)
+    print(f"{'walls':>8} {'per box (s)':>12} {'batched (s)':>12} {'speedup':>8} {'max diff (mm)':>14}")
+    for wall_count in wall_counts:
+        centers, extents, rotations = random_walls(wall_count, rng)
+
+        tic = time.perf_counter()
+        reference = wall_meshes_per_box(centers, extents, rotations, MODEL_PARAMS)
+        reference_time = time.perf_counter() - tic
+
+        tic = time.perf_counter()
+        batched = boxes_to_mesh(wall_box_vertices(centers, extents, rotations, MODEL_PARAMS))
+        batched_time = time.perf_counter() - tic
+
+        assert reference.vectors.shape == batched.vectors.shape
+        difference = np.abs(reference.vectors - batched.vectors).max()
+        assert np.allclose(reference.vectors, batched.vectors, atol=1e-3)
+        assert np.allclose(reference.normals, batched.normals, atol=1e-3)
+        print(f"{wall_count:>8} {reference_time:>12.3f} {batched_time:>12.4f} "
+              f"{reference_time/batched_time:>7.0f}x {difference:>14.2e}")
+
+
+if __name__ == "__main__":
+    counts = [int(arg) for arg in sys.argv[1:]] or [100, 1_000, 10_000]
+    main(counts)
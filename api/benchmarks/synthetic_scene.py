@@ -0,0 +1,211 @@
+# Synthetic indoor point clouds with known walls, for benchmarking and scoring process().
+# A scene is a grid of rooms with doorways in the interior walls, optional free standing
+# partition walls, floor, ceiling and furniture-like clutter. Points are sampled on each
+# surface in proportion to its area and written to a binary .pcd chunk by chunk, so
+# clouds much larger than memory (tens of millions of points) can be generated.
+import dataclasses
+import math
+import typing
+
+import numpy as np
+
+CHUNK_SIZE = 1_000_000  # points generated and written at a time
+
+
+@dataclasses.dataclass
+class SceneParams:
+    """Class for storing the parameters of a synthetic scene"""
+    point_count: int = 1_000_000
+    room_count: int = 4
+    extra_walls: int = 0  # free standing partition walls, at random angles
+    position_noise: float = 0.01  # metres, standard deviation along the surface normal
+    normal_noise_degrees: float = 2.0
+    roof: bool = True
+    clutter: int = 0  # number of furniture-like boxes
+    yaw_degrees: float = 17.0  # rotation of the whole scene about the vertical axis
+    wall_height: float = 2.5  # metres
+    wall_thickness: float = 0.1  # metres
+    door_width: float = 0.9  # metres
+    seed: int = 0
+
+    def slug(self) -> str:
+        """Identifies the scene, e.g. for caching generated clouds"""
+        return "_".join(f"{f.name}-{getattr(self, f.name)}" for f in dataclasses.fields(self))
+
+
+@dataclasses.dataclass
+class Surface:
+    """A planar parallelogram origin + a*u + b*v for a, b in [0, 1], with unit normal"""
+    origin: np.ndarray
+    u: np.ndarray
+    v: np.ndarray
+    normal: np.ndarray
+
+    def area(self) -> float:
+        return float(np.linalg.norm(np.cross(self.u, self.v)))
+
+
+@dataclasses.dataclass
+class Scene:
+    """Class for storing the surfaces to sample and the ground truth walls"""
+    params: SceneParams
+    surfaces: list[Surface]
+    walls: np.ndarray  # Wx2x2, centre line of each wall segment as [[x_a, y_a], [x_b, y_b]]
+
+
+def vertical_face(a: np.ndarray, b: np.ndarray, bottom: float, top: float, normal_2d: np.ndarray) -> Surface:
+    """A vertical face from a to b (2D) spanning bottom to top"""
+    return Surface(
+        origin=np.array([a[0], a[1], bottom]),
+        u=np.array([b[0] - a[0], b[1] - a[1], 0.0]),
+        v=np.array([0.0, 0.0, top - bottom]),
+        normal=np.array([normal_2d[0], normal_2d[1], 0.0]),
+    )
+
+
+def wall_faces(a: np.ndarray, b: np.ndarray, params: SceneParams, sides: typing.Sequence[int] = (1, -1)) -> list[Surface]:
+    """Faces of a wall centred on a-b, offset by half its thickness to either side.
+    sides: which faces are visible, 1 for the left of a->b and -1 for the right"""
+    direction = (b - a) / np.linalg.norm(b - a)
+    left = np.array([-direction[1], direction[0]])
+    faces = []
+    for side in sides:
+        offset = side * left * params.wall_thickness / 2
+        faces.append(vertical_face(a + offset, b + offset, 0.0, params.wall_height, side * left))
+    return faces
+
+
+def split_for_door(a: np.ndarray, b: np.ndarray, params: SceneParams, rng: np.random.Generator) -> list[tuple]:
+    """Wall a-b as the segments either side of a doorway at a random position"""
+    length = np.linalg.norm(b - a)
+    margin = params.wall_thickness + 0.3
+    if length < params.door_width + 2 * margin:
+        return [(a, b)]
+    start = rng.uniform(margin, length - margin - params.door_width)
+    direction = (b - a) / length
+    return [(a, a + direction * start), (a + direction * (start + params.door_width), b)]
+
+
+def box_faces(center: np.ndarray, size: np.ndarray, angle: float) -> list[Surface]:
+    """The four sides and top of a box resting on the floor"""
+    cos, sin = math.cos(angle), math.sin(angle)
+    x_axis, y_axis = np.array([cos, sin]), np.array([-sin, cos])
+    corners = [center + sx * x_axis * size[0] / 2 + sy * y_axis * size[1] / 2
+               for sx, sy in [(-1, -1), (1, -1), (1, 1), (-1, 1)]]
+    faces = []
+    for i in range(4):
+        a, b = corners[i], corners[(i + 1) % 4]
+        edge = (b - a) / np.linalg.norm(b - a)
+        faces.append(vertical_face(a, b, 0.0, size[2], np.array([edge[1], -edge[0]])))
+    faces.append(Surface(
+        origin=np.array([corners[0][0], corners[0][1], size[2]]),
+        u=np.array([*(corners[1] - corners[0]), 0.0]),
+        v=np.array([*(corners[3] - corners[0]), 0.0]),
+        normal=np.array([0.0, 0.0, 1.0]),
+    ))
+    return faces
+
+
+def make_scene(params: SceneParams) -> Scene:
+    rng = np.random.default_rng(params.seed)
+    columns = math.ceil(math.sqrt(params.room_count))
+    rows = math.ceil(params.room_count / columns)
+    widths = rng.uniform(3.0, 6.0, columns)
+    depths = rng.uniform(3.0, 6.0, rows)
+    xs = np.concatenate([[0.0], np.cumsum(widths)])
+    ys = np.concatenate([[0.0], np.cumsum(depths)])
+    # cells in the last row beyond room_count are merged into its last room
+    last_row_rooms = params.room_count - (rows - 1) * columns
+
+    segments = []  # (a, b, visible sides)
+    # outer walls, seen from inside only (the left of an anticlockwise loop)
+    corners = [np.array(c) for c in [(xs[0], ys[0]), (xs[-1], ys[0]), (xs[-1], ys[-1]), (xs[0], ys[-1])]]
+    for i in range(4):
+        segments.append((corners[i], corners[(i + 1) % 4], (1,)))
+    # interior walls between neighbouring cells, each with a doorway
+    for row in range(rows):
+        for column in range(1, columns):
+            if row == rows - 1 and column >= last_row_rooms:
+                continue
+            a, b = np.array([xs[column], ys[row]]), np.array([xs[column], ys[row + 1]])
+            segments += [(p, q, (1, -1)) for p, q in split_for_door(a, b, params, rng)]
+    for row in range(1, rows):
+        for column in range(columns):
+            a, b = np.array([xs[column], ys[row]]), np.array([xs[column + 1], ys[row]])
+            segments += [(p, q, (1, -1)) for p, q in split_for_door(a, b, params, rng)]
+    # free standing partitions inside random rooms
+    for _ in range(params.extra_walls):
+        row, column = rng.integers(rows), rng.integers(columns)
+        center = np.array([rng.uniform(xs[column] + 1.2, xs[column + 1] - 1.2),
+                           rng.uniform(ys[row] + 1.2, ys[row + 1] - 1.2)])
+        angle = rng.uniform(0, np.pi)
+        half = np.array([math.cos(angle), math.sin(angle)]) * rng.uniform(0.5, 1.0)
+        segments.append((center - half, center + half, (1, -1)))
+
+    surfaces = []
+    for a, b, sides in segments:
+        surfaces += wall_faces(a, b, params, sides)
+    extent = np.array([xs[-1], ys[-1]])
+    surfaces.append(Surface(np.zeros(3), np.array([extent[0], 0, 0]), np.array([0, extent[1], 0]), np.array([0, 0, 1.0])))
+    if params.roof:
+        surfaces.append(Surface(np.array([0, 0, params.wall_height]), np.array([extent[0], 0, 0]),
+                                np.array([0, extent[1], 0]), np.array([0, 0, -1.0])))
+    for _ in range(params.clutter):
+        size = np.array([rng.uniform(0.4, 1.5), rng.uniform(0.4, 1.0), rng.uniform(0.4, 1.0)])
+        center = rng.uniform([1.0, 1.0], extent - 1.0)
+        surfaces += box_faces(center, size, rng.uniform(0, np.pi))
+
+    # rotate everything about the vertical axis
+    yaw = math.radians(params.yaw_degrees)
+    rotation = np.array([[math.cos(yaw), -math.sin(yaw), 0], [math.sin(yaw), math.cos(yaw), 0], [0, 0, 1]])
+    for s in surfaces:
+        s.origin, s.u, s.v, s.normal = rotation @ s.origin, rotation @ s.u, rotation @ s.v, rotation @ s.normal
+    walls = np.array([[a, b] for a, b, _ in segments]) @ rotation[0:2, 0:2].T
+    return Scene(params, surfaces, walls)
+
+
+def allocate_points(areas: np.ndarray, point_count: int) -> np.ndarray:
+    """Splits point_count between surfaces in proportion to area (largest remainder rounding)"""
+    exact = areas / areas.sum() * point_count
+    counts = np.floor(exact).astype(np.int64)
+    remainder_order = np.argsort(-(exact - counts), kind="stable")
+    counts[remainder_order[:point_count - counts.sum()]] += 1
+    return counts
+
+
+def sample_surface(surface: Surface, count: int, params: SceneParams, rng: np.random.Generator) -> np.ndarray:
+    """count x 6 array of points and (noisy, unit) normals"""
+    a, b = rng.random((count, 1)), rng.random((count, 1))
+    points = surface.origin + a * surface.u + b * surface.v
+    points += rng.normal(0, params.position_noise, (count, 1)) * surface.normal
+    normals = surface.normal + rng.normal(0, math.radians(params.normal_noise_degrees), (count, 3))
+    normals /= np.linalg.norm(normals, axis=1).reshape(-1, 1)
+    return np.concatenate([points, normals], axis=1)
+
+
+def write_scene_pcd(scene: Scene, path: str, normals: bool = True):
+    """Samples the scene and writes it as a binary .pcd, one chunk at a time.
+    normals: False to write points only, as scanners without normals do"""
+    params = scene.params
+    rng = np.random.default_rng(params.seed + 1)
+    counts = allocate_points(np.array([s.area() for s in scene.surfaces]), params.point_count)
+    field_count = 6 if normals else 3
+    header = (
+        "# .PCD v0.7 - Point Cloud Data file format\n"
+        "VERSION 0.7\n"
+        f"FIELDS {'x y z normal_x normal_y normal_z' if normals else 'x y z'}\n"
+        f"SIZE {' '.join(['4'] * field_count)}\n"
+        f"TYPE {' '.join(['F'] * field_count)}\n"
+        f"COUNT {' '.join(['1'] * field_count)}\n"
+        f"WIDTH {params.point_count}\n"
+        "HEIGHT 1\n"
+        "VIEWPOINT 0 0 0 1 0 0 0\n"
+        f"POINTS {params.point_count}\n"
+        "DATA binary\n"
+    )
+    with open(path, "wb") as f:
+        f.write(header.encode("ascii"))
+        for surface, count in zip(scene.surfaces, counts):
+            for start in range(0, count, CHUNK_SIZE):
+                chunk = sample_surface(surface, min(CHUNK_SIZE, count - start), params, rng)
+                f.write(chunk[:, :field_count].astype(np.float32).tobytes())
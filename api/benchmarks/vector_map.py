@@ -0,0 +1,85 @@
+# Load, dump and wall box times of large vector maps, as VectorMap dataclasses (through
+# their marshmallow schema, as /api/generate used to load them) and as VectorMapArrays
+# (from the same JSON, and from the binary wire format), checking each round trip.
+# Usage (from the api directory):
+#   python -m benchmarks.vector_map --walls 1000 10000 50000
+import argparse
+import dataclasses
+import json
+import statistics
+import time
+
+import numpy as np
+
+from tactil_api.generate_stl import vector_map_to_box_properties
+from tactil_api.VectorMap import VectorMap, VectorMapArrays
+
+
+def grid_map(wall_count: int, seed: int = 0) -> VectorMap:
+    """A connected grid of square rooms with about wall_count walls, corners slightly jittered"""
+    side = max(int(np.ceil(np.sqrt(wall_count / 2))), 1)
+    rng = np.random.default_rng(seed)
+    x, y = np.meshgrid(np.arange(side + 1) * 3.0, np.arange(side + 1) * 3.0, indexing="ij")
+    positions = np.column_stack([x.ravel(), y.ravel()]) + rng.normal(0, 0.01, ((side + 1) ** 2, 2))
+    index = np.arange((side + 1) ** 2).reshape(side + 1, side + 1)
+    horizontal = np.column_stack([index[:-1, :].ravel(), index[1:, :].ravel()])
+    vertical = np.column_stack([index[:, :-1].ravel(), index[:, 1:].ravel()])
+    return VectorMap.from_graph(positions, np.concatenate([horizontal, vertical])[:wall_count])
+
+
+def timed(function, repeat: int):
+    times, result = [], None
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - tic)
+    return statistics.median(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark VectorMap and VectorMapArrays serialisation")
+    parser.add_argument("--walls", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    for wall_count in args.walls:
+        vector_map = grid_map(wall_count)
+        text = json.dumps(VectorMap.Schema().dump(vector_map))
+        payload = json.loads(text)
+        parse_time, _ = timed(lambda: json.loads(text), args.repeat)
+        arrays = VectorMapArrays.from_json(payload)
+        binary = arrays.to_bytes()
+
+        rows = [
+            ("VectorMap", [
+                timed(lambda: VectorMap.Schema().load(payload), args.repeat)[0],
+                timed(lambda: VectorMap.Schema().dump(vector_map), args.repeat)[0],
+                timed(lambda: vector_map_to_box_properties(vector_map), args.repeat)[0],
+            ], len(text)),
+            ("arrays, JSON", [
+                timed(lambda: VectorMapArrays.from_json(payload), args.repeat)[0],
+                timed(lambda: arrays.to_json(), args.repeat)[0],
+                timed(lambda: vector_map_to_box_properties(arrays), args.repeat)[0],
+            ], len(text)),
+            ("arrays, binary", [
+                timed(lambda: VectorMapArrays.from_bytes(binary), args.repeat)[0],
+                timed(lambda: arrays.to_bytes(), args.repeat)[0],
+                None,
+            ], len(binary)),
+        ]
+        print(f"{len(vector_map.edges)} walls, {len(vector_map.vertices)} vertices, json.loads {parse_time:.3f} s")
+        print(f"  {'form':<15} {'load (s)':>9} {'dump (s)':>9} {'boxes (s)':>10} {'size (kB)':>10}")
+        for name, (load_time, dump_time, box_time), size in rows:
+            box = f"{box_time:>10.4f}" if box_time is not None else f"{'':>10}"
+            print(f"  {name:<15} {load_time:>9.4f} {dump_time:>9.4f} {box} {size / 1000:>10.1f}")
+
+        # every form describes the same map
+        round_tripped = VectorMapArrays.from_bytes(binary).to_vector_map()
+        if dataclasses.asdict(round_tripped) != dataclasses.asdict(VectorMap.Schema().load(payload)):
+            raise AssertionError("binary round trip changed the map")
+        if json.loads(json.dumps(arrays.to_json())) != payload:
+            raise AssertionError("JSON round trip changed the map")
+
+
+if __name__ == "__main__":
+    main()
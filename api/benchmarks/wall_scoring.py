@@ -0,0 +1,115 @@
+# Scores a recovered VectorMap against ground truth wall segments.
+# process() rotates the cloud about the origin to align it with its primary wall
+# direction, so the recovered map is first registered to the ground truth by a rotation
+# about the origin. Walls are then compared by length: segments are sampled densely and
+# a sample counts as matched if it lies within tolerance of the other set of walls.
+import dataclasses
+import math
+
+import numpy as np
+from scipy.optimize import minimize_scalar
+from scipy.spatial import cKDTree
+
+from tactil_api.VectorMap import VectorMap
+
+SAMPLE_SPACING = 0.02  # metres between samples along each segment
+
+
+@dataclasses.dataclass
+class WallScore:
+    """Class for storing how well recovered walls match the ground truth"""
+    precision: float  # fraction of recovered wall length within tolerance of a true wall
+    recall: float  # fraction of true wall length within tolerance of a recovered wall
+    f1: float
+    walls_found: int  # true walls at least half covered by recovered walls
+    wall_count: int
+    edge_count: int  # edges in the recovered map
+    mean_error: float  # metres, mean distance of matched recovered samples from the true walls
+    rotation_degrees: float  # rotation registering the recovered map to the ground truth
+
+
+def vector_map_segments(vector_map: VectorMap) -> np.ndarray:
+    """Ex2x2 array of the map's edges"""
+    segments = []
+    for edge_id in vector_map.edges:
+        edge = vector_map.features[edge_id]
+        a = vector_map.features[edge.vertex_id_a].position
+        b = vector_map.features[edge.vertex_id_b].position
+        segments.append([[a.x, a.y], [b.x, b.y]])
+    return np.array(segments, dtype=float).reshape(-1, 2, 2)
+
+
+def sample_segments(segments: np.ndarray, spacing: float = SAMPLE_SPACING):
+    """Points every spacing metres along each segment, and the index of their segment"""
+    lengths = np.linalg.norm(segments[:, 1] - segments[:, 0], axis=1)
+    counts = np.maximum(np.ceil(lengths / spacing).astype(int), 1)
+    owner = np.repeat(np.arange(len(segments)), counts)
+    # midpoints of counts equal steps along each segment
+    steps = (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + 0.5) / np.repeat(counts, counts)
+    a, b = segments[owner, 0], segments[owner, 1]
+    return a + (b - a) * steps.reshape(-1, 1), owner
+
+
+def rotate(points: np.ndarray, angle: float) -> np.ndarray:
+    cos, sin = math.cos(angle), math.sin(angle)
+    return points @ np.array([[cos, sin], [-sin, cos]])
+
+
+def register_rotation(recovered: np.ndarray, truth: np.ndarray, tolerance: float) -> float:
+    """Rotation about the origin taking the recovered segments onto the true ones.
+    Candidates align one of the longest recovered segments with each true wall direction,
+    and the best is refined by minimising a truncated distance cost."""
+    truth_tree = cKDTree(sample_segments(truth)[0])
+    samples, _ = sample_segments(recovered, spacing=0.1)
+
+    def cost(angle: float) -> float:
+        distances, _ = truth_tree.query(rotate(samples, angle), distance_upper_bound=4 * tolerance)
+        return float(np.mean(np.minimum(distances, 4 * tolerance) ** 2))
+
+    def direction(segments):
+        delta = segments[:, 1] - segments[:, 0]
+        return np.arctan2(delta[:, 1], delta[:, 0])
+
+    longest = recovered[np.argsort(-np.linalg.norm(recovered[:, 1] - recovered[:, 0], axis=1))[:8]]
+    truth_directions = np.unique(np.round(np.degrees(direction(truth)) % 180, 1))
+    candidates = set()
+    for recovered_direction in np.degrees(direction(longest)):
+        for truth_direction in truth_directions:
+            for flip in (0, 180):
+                candidates.add(round((truth_direction - recovered_direction + flip) % 360, 1))
+    best = min(candidates, key=lambda c: cost(math.radians(c)))
+    refined = minimize_scalar(cost, bounds=(math.radians(best - 2), math.radians(best + 2)), method="bounded")
+    return refined.x if refined.fun <= cost(math.radians(best)) else math.radians(best)
+
+
+def score_walls(vector_map: VectorMap, truth: np.ndarray, tolerance: float = 0.15) -> WallScore:
+    """truth: Wx2x2 array of true wall centre lines, in the frame of the scanned cloud
+    tolerance: metres a wall may be from the truth and still count as found"""
+    recovered = vector_map_segments(vector_map)
+    if len(recovered) == 0:
+        return WallScore(0.0, 0.0, 0.0, 0, len(truth), 0, float("nan"), float("nan"))
+
+    angle = register_rotation(recovered, truth, tolerance)
+    recovered = rotate(recovered.reshape(-1, 2), angle).reshape(-1, 2, 2)
+
+    truth_samples, truth_owner = sample_segments(truth)
+    recovered_samples, _ = sample_segments(recovered)
+    recovered_distances, _ = cKDTree(truth_samples).query(recovered_samples)
+    truth_distances, _ = cKDTree(recovered_samples).query(truth_samples)
+    recovered_matched = recovered_distances <= tolerance
+    truth_matched = truth_distances <= tolerance
+
+    precision = float(np.mean(recovered_matched))
+    recall = float(np.mean(truth_matched))
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.0
+    coverage = np.bincount(truth_owner, weights=truth_matched, minlength=len(truth)) / np.bincount(truth_owner, minlength=len(truth))
+    return WallScore(
+        precision=precision,
+        recall=recall,
+        f1=f1,
+        walls_found=int(np.sum(coverage >= 0.5)),
+        wall_count=len(truth),
+        edge_count=len(recovered),
+        mean_error=float(np.mean(recovered_distances[recovered_matched])) if np.any(recovered_matched) else float("nan"),
+        rotation_degrees=math.degrees(angle) % 360,
+    )
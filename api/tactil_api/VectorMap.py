@@ -1,7 +1,12 @@
 # from dataclasses import dataclass
+import dataclasses
+import json
+import struct
+from marshmallow import ValidationError
 from marshmallow_dataclass import dataclass
-from math import sqrt
-from typing import Dict, Union
+from collections import defaultdict
+from math import cos, radians, sin, sqrt
+from typing import Dict, Optional, Union
 import numpy as np
 
 @dataclass
@@ -48,10 +53,7 @@ class VectorMap:
 
     @classmethod
     def from_boxes(cls, centers, extents, rotations):
-        vertices = []
-        edges = []
-        features: Dict[int, Union[Label, Vertex, Edge]] = dict()
-
+        segments = []
         for center, extent, rotation in zip(centers, extents, rotations):
 
             z_rot_euler = np.arctan2(rotation[1][0], rotation[0][0])
@@ -64,15 +66,27 @@ class VectorMap:
             vert_b_no_transform = apply_z_rot(Coord2D(x_coord_pos, 0), z_rot_euler)
             vert_a_coord = apply_translation(vert_a_no_transform, center_coord)
             vert_b_coord = apply_translation(vert_b_no_transform, center_coord)
+            segments.append([[vert_a_coord.x, vert_a_coord.y], [vert_b_coord.x, vert_b_coord.y]])
+
+        return cls.from_segments(segments)
+
+    @classmethod
+    def from_segments(cls, segments):
+        """ segments: [[x_a, y_a], [x_b, y_b]] end points of each wall, each becoming an edge
+        between two new vertices """
+        vertices = []
+        edges = []
+        features: Dict[int, Union[Label, Vertex, Edge]] = dict()
 
+        for (x_a, y_a), (x_b, y_b) in segments:
             maxId = len(features) - 1 # Find new ids according to current max id
             
             vertex_a_id = maxId+1
             vertex_b_id = maxId+2
             edge_id = maxId+3
 
-            vertex_a = Vertex(vertex_a_id, vert_a_coord)
-            vertex_b = Vertex(vertex_b_id, vert_b_coord)
+            vertex_a = Vertex(vertex_a_id, Coord2D(float(x_a), float(y_a)))
+            vertex_b = Vertex(vertex_b_id, Coord2D(float(x_b), float(y_b)))
             edge = Edge(edge_id, vertex_a.id, vertex_b.id)
 
             vertices += [vertex_a.id, vertex_b.id]
@@ -86,5 +100,461 @@ class VectorMap:
 
         return cls(features, vertices, edges, labels)
 
+    @classmethod
+    def from_graph(cls, positions, edge_pairs, labels=()):
+        """ positions: [x, y] of each vertex, edge_pairs: [a, b] indices into positions of the
+        vertices of each edge, labels: Labels to keep. Features are numbered vertices first,
+        then edges, then labels """
+        features: Dict[int, Union[Label, Vertex, Edge]] = dict()
+        for vertex_id, (x, y) in enumerate(positions):
+            features[vertex_id] = Vertex(vertex_id, Coord2D(float(x), float(y)))
+        vertices = list(features)
+
+        edges = []
+        for a, b in edge_pairs:
+            edge_id = len(features)
+            features[edge_id] = Edge(edge_id, int(a), int(b))
+            edges.append(edge_id)
+
+        label_ids = []
+        for label in labels:
+            label_id = len(features)
+            features[label_id] = Label(label_id, label.text, label.position, label.size, label.is_braille)
+            label_ids.append(label_id)
+
+        return cls(features, vertices, edges, label_ids)
+
+    def snapped(self, tolerance: float, merge_angle_degrees: float = 5.0) -> "VectorMap":
+        """ A copy of the map as a connected graph. Vertices within tolerance of each other
+        become one, placed where the lines of their walls cross (if those are not parallel).
+        A wall end within tolerance of another wall is joined to it, splitting that wall.
+        Walls meeting end to end within merge_angle_degrees of a straight line become one.
+        Repeated and zero length walls are removed, and features are renumbered. """
+        positions = {
+            vertex_id: np.array([self.features[vertex_id].position.x, self.features[vertex_id].position.y])
+            for vertex_id in self.vertices
+        }
+        edge_pairs = [(self.features[edge_id].vertex_id_a, self.features[edge_id].vertex_id_b) for edge_id in self.edges]
+
+        positions, edge_pairs = merge_close_vertices(positions, edge_pairs, tolerance, merge_angle_degrees)
+        edge_pairs = join_wall_ends(positions, edge_pairs, tolerance, merge_angle_degrees)
+        edge_pairs = merge_collinear_edges(positions, edge_pairs, merge_angle_degrees)
+
+        # vertices left without walls are dropped
+        kept = sorted({vertex_id for pair in edge_pairs for vertex_id in pair})
+        index_of = {vertex_id: i for i, vertex_id in enumerate(kept)}
+        return VectorMap.from_graph(
+            [positions[vertex_id] for vertex_id in kept],
+            [(index_of[a], index_of[b]) for a, b in edge_pairs],
+            [self.features[label_id] for label_id in self.labels],
+        )
+
 def euclidean_distance(coord_a: Coord2D, coord_b: Coord2D) -> float:
-    return sqrt((coord_a.x-coord_b.x)**2 + (coord_a.y-coord_b.y)**2)
\ No newline at end of file
+    return sqrt((coord_a.x-coord_b.x)**2 + (coord_a.y-coord_b.y)**2)
+
+
+# Binary form of VectorMapArrays (see VectorMapArrays.to_bytes): this header of magic, version,
+# vertex, edge and label counts and the byte length of the label table, followed by the
+# vertex ids (int64), positions (float64 x, y), edge ids (int64) and edge vertex rows
+# (int32 pairs), then the label table as UTF-8 JSON. Little endian throughout.
+VECTOR_MAP_MAGIC = b"TVMA"
+VECTOR_MAP_VERSION = 1
+VECTOR_MAP_HEADER = struct.Struct("<4sIQQQQ")
+VECTOR_MAP_MEDIA_TYPE = "application/x-tactil-vector-map"
+
+
+@dataclasses.dataclass
+class VectorMapArrays:
+    """ Class for storing a VectorMap as columns: vertices as rows of arrays, edges as pairs
+    of vertex rows, and the labels as a table. Feature ids are kept, so converting to and
+    from the JSON shape of VectorMap loses nothing """
+    vertex_ids: np.ndarray  # V int64
+    positions: np.ndarray  # Vx2 float64
+    edge_ids: np.ndarray  # E int64
+    edges: np.ndarray  # Ex2 int32 rows of positions
+    labels: list[Label] = dataclasses.field(default_factory=list)
+
+    @classmethod
+    def from_json(cls, data: dict) -> "VectorMapArrays":
+        """ From the JSON shape of a VectorMap (as dumped by its Schema, or dataclasses.asdict),
+        without building a dataclass per feature. Raises marshmallow.ValidationError if it is
+        malformed or an edge or label is missing its feature or an edge's vertex """
+        try:
+            features = {int(feature_id): feature for feature_id, feature in data["features"].items()}
+            vertex_ids = np.array(data["vertices"], dtype=np.int64).reshape(-1)
+            positions = np.array(
+                [(features[vertex_id]["position"]["x"], features[vertex_id]["position"]["y"]) for vertex_id in vertex_ids.tolist()],
+                dtype=np.float64,
+            ).reshape(-1, 2)
+            edge_ids = np.array(data["edges"], dtype=np.int64).reshape(-1)
+            edge_vertex_ids = np.array(
+                [(features[edge_id]["vertex_id_a"], features[edge_id]["vertex_id_b"]) for edge_id in edge_ids.tolist()],
+                dtype=np.int64,
+            ).reshape(-1, 2)
+            labels = [Label.Schema().load(features[label_id]) for label_id in data["labels"]]
+        except ValidationError as e:
+            raise ValidationError({"labels": e.messages})
+        except KeyError as e:
+            raise ValidationError({"features": [f"Missing feature or field {e}."]})
+        except (AttributeError, TypeError, ValueError) as e:
+            raise ValidationError({"features": [f"Malformed vector map: {e}."]})
+        return cls(vertex_ids, positions, edge_ids, cls._vertex_rows(vertex_ids, edge_vertex_ids), labels)
+
+    @staticmethod
+    def _vertex_rows(vertex_ids: np.ndarray, edge_vertex_ids: np.ndarray) -> np.ndarray:
+        """ Rows of vertex_ids holding each of edge_vertex_ids """
+        order = np.argsort(vertex_ids, kind="stable")
+        rows = np.searchsorted(vertex_ids, edge_vertex_ids, sorter=order)
+        rows = order[np.minimum(rows, max(len(order) - 1, 0))] if len(order) else np.zeros_like(rows)
+        if len(edge_vertex_ids) and (len(order) == 0 or np.any(vertex_ids[rows] != edge_vertex_ids)):
+            raise ValidationError({"edges": ["Edges must join listed vertices."]})
+        return rows.astype(np.int32)
+
+    def to_json(self) -> dict:
+        """ The JSON shape of the VectorMap, with integer feature ids """
+        features = {}
+        for vertex_id, (x, y) in zip(self.vertex_ids.tolist(), self.positions.tolist()):
+            features[vertex_id] = {"id": vertex_id, "position": {"x": x, "y": y}}
+        for edge_id, (a, b) in zip(self.edge_ids.tolist(), self.vertex_ids[self.edges].reshape(-1, 2).tolist()):
+            features[edge_id] = {"id": edge_id, "vertex_id_a": a, "vertex_id_b": b}
+        for label in self.labels:
+            features[label.id] = dataclasses.asdict(label)
+        return {
+            "features": features,
+            "vertices": self.vertex_ids.tolist(),
+            "edges": self.edge_ids.tolist(),
+            "labels": [label.id for label in self.labels],
+        }
+
+    @classmethod
+    def from_vector_map(cls, vector_map: VectorMap) -> "VectorMapArrays":
+        features = vector_map.features
+        vertex_ids = np.array(vector_map.vertices, dtype=np.int64).reshape(-1)
+        positions = np.array(
+            [(features[vertex_id].position.x, features[vertex_id].position.y) for vertex_id in vector_map.vertices],
+            dtype=np.float64,
+        ).reshape(-1, 2)
+        edge_ids = np.array(vector_map.edges, dtype=np.int64).reshape(-1)
+        edge_vertex_ids = np.array(
+            [(features[edge_id].vertex_id_a, features[edge_id].vertex_id_b) for edge_id in vector_map.edges],
+            dtype=np.int64,
+        ).reshape(-1, 2)
+        labels = [features[label_id] for label_id in vector_map.labels]
+        return cls(vertex_ids, positions, edge_ids, cls._vertex_rows(vertex_ids, edge_vertex_ids), labels)
+
+    def to_vector_map(self) -> VectorMap:
+        return VectorMap.Schema().load(self.to_json())
+
+    def segments(self) -> np.ndarray:
+        """ Ex2x2 end points of the edges """
+        return self.positions[self.edges].reshape(-1, 2, 2)
+
+    def to_bytes(self) -> bytes:
+        label_table = json.dumps([dataclasses.asdict(label) for label in self.labels]).encode()
+        header = VECTOR_MAP_HEADER.pack(
+            VECTOR_MAP_MAGIC, VECTOR_MAP_VERSION, len(self.vertex_ids), len(self.edge_ids), len(self.labels), len(label_table)
+        )
+        return b"".join([
+            header,
+            self.vertex_ids.astype("<i8").tobytes(),
+            self.positions.astype("<f8").tobytes(),
+            self.edge_ids.astype("<i8").tobytes(),
+            self.edges.astype("<i4").tobytes(),
+            label_table,
+        ])
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "VectorMapArrays":
+        """ Raises marshmallow.ValidationError if data is not a vector map of this version """
+        if len(data) < VECTOR_MAP_HEADER.size:
+            raise ValidationError("Vector map is truncated.")
+        magic, version, vertex_count, edge_count, label_count, label_bytes = VECTOR_MAP_HEADER.unpack_from(data)
+        if magic != VECTOR_MAP_MAGIC or version != VECTOR_MAP_VERSION:
+            raise ValidationError(f"Not a version {VECTOR_MAP_VERSION} vector map.")
+        sizes = [8 * vertex_count, 16 * vertex_count, 8 * edge_count, 8 * edge_count, label_bytes]
+        if len(data) != VECTOR_MAP_HEADER.size + sum(sizes):
+            raise ValidationError("Vector map length does not match its header.")
+
+        offset = VECTOR_MAP_HEADER.size
+        def take(dtype, count):
+            nonlocal offset
+            array = np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+            offset += array.nbytes
+            return array.astype(dtype[1:])  # native order, and writable
+        vertex_ids = take("<i8", vertex_count)
+        positions = take("<f8", 2 * vertex_count).reshape(-1, 2)
+        edge_ids = take("<i8", edge_count)
+        edges = take("<i4", 2 * edge_count).reshape(-1, 2)
+        if np.any(edges < 0) or np.any(edges >= vertex_count):
+            raise ValidationError({"edges": ["Edges must join listed vertices."]})
+        try:
+            labels = Label.Schema(many=True).load(json.loads(data[offset:].decode()))
+        except (UnicodeDecodeError, json.JSONDecodeError) as e:
+            raise ValidationError({"labels": [f"Malformed label table: {e}."]})
+        if len(labels) != label_count:
+            raise ValidationError({"labels": ["Label count does not match the header."]})
+        return cls(vertex_ids, positions, edge_ids, edges, labels)
+
+class SpatialIndex:
+    """ Grid hash of 2D points and segments, for finding those near a point.
+    cell_size should be at least about the radius of the queries """
+
+    def __init__(self, cell_size: float):
+        self.cell_size = cell_size
+        self.cells: Dict[tuple, set] = defaultdict(set)
+        self.item_cells: Dict[int, list] = dict()
+
+    def _cell(self, point) -> tuple:
+        return (int(np.floor(point[0] / self.cell_size)), int(np.floor(point[1] / self.cell_size)))
+
+    def insert_point(self, item: int, point):
+        self._insert(item, [self._cell(point)])
+
+    def insert_segment(self, item: int, a, b):
+        # filed under the cells of samples half a cell apart, so every point of the segment
+        # is in or next to one of them (which query allows for)
+        a, b = np.asarray(a), np.asarray(b)
+        steps = max(int(np.ceil(np.linalg.norm(b - a) / (self.cell_size / 2))), 1)
+        samples = a + np.linspace(0, 1, steps + 1).reshape(-1, 1) * (b - a)
+        cells = np.floor(samples / self.cell_size).astype(np.int64)
+        self._insert(item, list(map(tuple, np.unique(cells, axis=0).tolist())))
+
+    def _insert(self, item: int, cells: list):
+        self.item_cells[item] = cells
+        for cell in cells:
+            self.cells[cell].add(item)
+
+    def remove(self, item: int):
+        for cell in self.item_cells.pop(item, []):
+            self.cells[cell].discard(item)
+
+    def query(self, point, radius: float) -> set:
+        """ Items that may be within radius of point (and all that are) """
+        x_min, y_min = self._cell((point[0] - radius, point[1] - radius))
+        x_max, y_max = self._cell((point[0] + radius, point[1] + radius))
+        found = set()
+        for x in range(x_min - 1, x_max + 2):
+            for y in range(y_min - 1, y_max + 2):
+                found |= self.cells.get((x, y), set())
+        return found
+
+
+class VectorMapIndex:
+    """ Spatial index of a VectorMap's vertices and edges, for finding the features nearest
+    a point. Reflects the map as it was when the index was built """
+
+    def __init__(self, vector_map: VectorMap, cell_size: float = 0.5):
+        self.vector_map = vector_map
+        self.vertices = SpatialIndex(cell_size)
+        self.edges = SpatialIndex(cell_size)
+        for vertex_id in vector_map.vertices:
+            self.vertices.insert_point(vertex_id, self._position(vertex_id))
+        for edge_id in vector_map.edges:
+            edge = vector_map.features[edge_id]
+            self.edges.insert_segment(edge_id, self._position(edge.vertex_id_a), self._position(edge.vertex_id_b))
+
+    def _position(self, vertex_id: int) -> np.ndarray:
+        position = self.vector_map.features[vertex_id].position
+        return np.array([position.x, position.y])
+
+    def nearest_vertex(self, point: Coord2D, max_distance: float) -> Optional[int]:
+        """ Id of the vertex nearest point, if any is within max_distance """
+        p = np.array([point.x, point.y])
+        distances = {
+            vertex_id: np.linalg.norm(self._position(vertex_id) - p)
+            for vertex_id in self.vertices.query(p, max_distance)
+        }
+        nearest = min(distances, key=distances.get, default=None)
+        return nearest if nearest is not None and distances[nearest] <= max_distance else None
+
+    def nearest_edge(self, point: Coord2D, max_distance: float) -> Optional[int]:
+        """ Id of the edge nearest point, if any is within max_distance """
+        p = np.array([point.x, point.y])
+        distances = {}
+        for edge_id in self.edges.query(p, max_distance):
+            edge = self.vector_map.features[edge_id]
+            distances[edge_id] = point_segment_distance(p, self._position(edge.vertex_id_a), self._position(edge.vertex_id_b))[0]
+        nearest = min(distances, key=distances.get, default=None)
+        return nearest if nearest is not None and distances[nearest] <= max_distance else None
+
+
+def point_segment_distance(p: np.ndarray, a: np.ndarray, b: np.ndarray):
+    """ Distance of p from the segment a-b, and how far along the segment (0 to 1) its nearest point is """
+    d = b - a
+    length_squared = d @ d
+    t = float(np.clip((p - a) @ d / length_squared, 0, 1)) if length_squared > 0 else 0.0
+    return float(np.linalg.norm(a + t * d - p)), t
+
+
+def line_intersection(a: np.ndarray, b: np.ndarray, c: np.ndarray, d: np.ndarray, min_angle_degrees: float) -> Optional[np.ndarray]:
+    """ Where the lines through a-b and c-d cross, unless they are within min_angle_degrees of parallel """
+    u, v = b - a, d - c
+    cross = u[0] * v[1] - u[1] * v[0]
+    if abs(cross) <= sin(radians(min_angle_degrees)) * np.linalg.norm(u) * np.linalg.norm(v):
+        return None
+    w = c - a
+    return a + u * (w[0] * v[1] - w[1] * v[0]) / cross
+
+
+def incident_edges(edges: Dict[int, tuple]) -> Dict[int, set]:
+    """ Ids of the edges at each vertex, of edges: edge id -> (vertex id, vertex id) """
+    incident = defaultdict(set)
+    for edge_id, (a, b) in edges.items():
+        incident[a].add(edge_id)
+        incident[b].add(edge_id)
+    return incident
+
+
+def unique_edges(edge_pairs) -> list:
+    """ edge_pairs without zero length or repeated edges (either way round) """
+    seen = set()
+    unique = []
+    for a, b in edge_pairs:
+        key = frozenset((a, b))
+        if a != b and key not in seen:
+            seen.add(key)
+            unique.append((a, b))
+    return unique
+
+
+def merge_close_vertices(positions: Dict[int, np.ndarray], edge_pairs: list, tolerance: float, min_angle_degrees: float):
+    """ Merges each group of vertices linked by distances within tolerance into one, placed
+    at the least squares crossing of its walls' lines if at least two of those are more than
+    min_angle_degrees from parallel (and the crossing is within tolerance of the group),
+    otherwise at the group's mean. Returns the merged positions and edges """
+    index = SpatialIndex(tolerance)
+    for vertex_id, position in positions.items():
+        index.insert_point(vertex_id, position)
+
+    parent = {vertex_id: vertex_id for vertex_id in positions}
+    def find(vertex_id):
+        while parent[vertex_id] != vertex_id:
+            parent[vertex_id] = parent[parent[vertex_id]]
+            vertex_id = parent[vertex_id]
+        return vertex_id
+
+    for vertex_id, position in positions.items():
+        for other in index.query(position, tolerance):
+            if other != vertex_id and np.linalg.norm(positions[other] - position) <= tolerance:
+                parent[find(other)] = find(vertex_id)
+
+    groups = defaultdict(list)
+    for vertex_id in positions:
+        groups[find(vertex_id)].append(vertex_id)
+    incident = incident_edges(dict(enumerate(edge_pairs)))
+
+    merged = {}
+    for root, members in groups.items():
+        mean = np.mean([positions[vertex_id] for vertex_id in members], axis=0)
+        merged[root] = mean
+        if len(members) == 1:
+            continue
+        # unit normals of the walls leaving the group, and a point on each
+        lines = []
+        for vertex_id in members:
+            for edge_id in incident[vertex_id]:
+                a, b = edge_pairs[edge_id]
+                other = b if a == vertex_id else a
+                direction = positions[other] - positions[vertex_id]
+                length = np.linalg.norm(direction)
+                if find(other) != root and length > 0:
+                    lines.append((np.array([-direction[1], direction[0]]) / length, positions[vertex_id]))
+        if len(lines) < 2:
+            continue
+        normals = np.array([normal for normal, _ in lines])
+        crossings = np.abs(np.outer(normals[:, 0], normals[:, 1]) - np.outer(normals[:, 1], normals[:, 0]))
+        if crossings.max() <= sin(radians(min_angle_degrees)):
+            continue
+        normal_products = sum(np.outer(normal, normal) for normal, _ in lines)
+        corner = np.linalg.solve(normal_products, sum(np.outer(normal, normal) @ point for normal, point in lines))
+        if np.linalg.norm(corner - mean) <= tolerance:
+            merged[root] = corner
+
+    return merged, unique_edges((find(a), find(b)) for a, b in edge_pairs)
+
+
+def join_wall_ends(positions: Dict[int, np.ndarray], edge_pairs: list, tolerance: float, min_angle_degrees: float) -> list:
+    """ Joins each wall end (vertex of one edge) within tolerance of another edge to it, moving
+    the end to where the walls' lines cross (if within tolerance) or else onto the edge, and
+    splitting the edge there. Updates positions, returns the edges """
+    edges = dict(enumerate(edge_pairs))
+    incident = incident_edges(edges)
+    index = SpatialIndex(4 * tolerance)
+    for edge_id, (a, b) in edges.items():
+        index.insert_segment(edge_id, positions[a], positions[b])
+    next_id = len(edges)
+
+    for vertex_id in list(positions):
+        if len(incident[vertex_id]) != 1:
+            continue
+        (own_edge,) = incident[vertex_id]
+        other = [v for v in edges[own_edge] if v != vertex_id][0]
+        position = positions[vertex_id]
+
+        nearest = None
+        for edge_id in index.query(position, tolerance):
+            a, b = edges[edge_id]
+            if edge_id == own_edge or other in (a, b):
+                continue
+            distance, t = point_segment_distance(position, positions[a], positions[b])
+            if 0 < t < 1 and distance <= tolerance and (nearest is None or distance < nearest[0]):
+                nearest = (distance, edge_id, t)
+        if nearest is None:
+            continue
+
+        _, edge_id, t = nearest
+        a, b = edges[edge_id]
+        joint = positions[a] + t * (positions[b] - positions[a])
+        crossing = line_intersection(positions[other], position, positions[a], positions[b], min_angle_degrees)
+        if crossing is not None and np.linalg.norm(crossing - position) <= tolerance:
+            _, crossing_t = point_segment_distance(crossing, positions[a], positions[b])
+            if 0 < crossing_t < 1:
+                joint = crossing
+        positions[vertex_id] = joint
+
+        # split the edge at the joined end
+        del edges[edge_id]
+        index.remove(edge_id)
+        incident[a].discard(edge_id)
+        incident[b].discard(edge_id)
+        for end in (a, b):
+            edges[next_id] = (end, vertex_id)
+            index.insert_segment(next_id, positions[end], joint)
+            incident[end].add(next_id)
+            incident[vertex_id].add(next_id)
+            next_id += 1
+
+    return unique_edges(edges.values())
+
+
+def merge_collinear_edges(positions: Dict[int, np.ndarray], edge_pairs: list, max_angle_degrees: float) -> list:
+    """ Replaces each pair of edges meeting end to end at a vertex of no other edges, and turning
+    there by at most max_angle_degrees, by one edge. Returns the edges """
+    edges = dict(enumerate(edge_pairs))
+    incident = incident_edges(edges)
+    next_id = len(edges)
+
+    for vertex_id in list(incident):
+        if len(incident[vertex_id]) != 2:
+            continue
+        first, second = incident[vertex_id]
+        u = [v for v in edges[first] if v != vertex_id][0]
+        w = [v for v in edges[second] if v != vertex_id][0]
+        to_u, to_w = positions[u] - positions[vertex_id], positions[w] - positions[vertex_id]
+        lengths = np.linalg.norm(to_u) * np.linalg.norm(to_w)
+        if u == w or lengths == 0 or incident[u] & incident[w]:
+            continue
+        if to_u @ to_w / lengths > -cos(radians(max_angle_degrees)):
+            continue  # turns by more than max_angle_degrees
+
+        for edge_id in (first, second):
+            del edges[edge_id]
+        incident[u].discard(first)
+        incident[w].discard(second)
+        incident[vertex_id].clear()
+        edges[next_id] = (u, w)
+        incident[u].add(next_id)
+        incident[w].add(next_id)
+        next_id += 1
+
+    return list(edges.values())
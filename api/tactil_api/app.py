@@ -1,33 +1,55 @@
+import dataclasses
 import os
 import secrets
+import uuid
 
 from flask import (Flask, jsonify, make_response, request, send_file,
                    send_from_directory)
 from flask_cors import CORS
-from marshmallow_dataclass import dataclass
+from marshmallow import ValidationError
+from marshmallow_dataclass import class_schema
 from werkzeug.utils import secure_filename
 
 from .generate_stl import PhysicalParameters, generate
-from .process_cloud import process
-from .VectorMap import VectorMap
+from .image_operations import TileNotFoundError, render_tile
+from .jobs import JobQueue, JobQueueFullError
+from .parameters import DEFAULT_PRESET, PRESETS, resolve_parameters
+from .profiler import StageProfiler
+from .result_cache import ResultCache
+from .stage_cache import StageCache
+from .sweeper import OutputSweeper
+from .uploads import PARTIAL_DIRNAME, ChunkedUploads, UploadError, UploadOffsetError
+from .VectorMap import VECTOR_MAP_MEDIA_TYPE, VectorMapArrays
 
 UPLOAD_FOLDER = "./pcd_uploads"
 ALLOWED_EXTENSIONS = {"txt", "pdf", "png", "jpg", "jpeg", "gif", "pcd", "xyz"}
 MAX_CONTENT_LENGTH = 16 * 1000 * 1000 * 1000
 OUTPUT_FOLDER = "./stl_output"
 IMAGE_FOLDER = "./image_output"
+JOB_FOLDER = "./jobs"
+MAX_CONCURRENT_JOBS = int(os.environ.get("TACTIL_MAX_CONCURRENT_JOBS", 1))
+MAX_PENDING_JOBS = int(os.environ.get("TACTIL_MAX_PENDING_JOBS", 16))
+PIPELINE_WORKERS = int(os.environ.get("TACTIL_PIPELINE_WORKERS", 1))
+RESULT_CACHE_FOLDER = "./result_cache"
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("TACTIL_RESULT_CACHE_MAX_BYTES", 500 * 1000 * 1000))
+STAGE_CACHE_FOLDER = "./stage_cache"
+STAGE_CACHE_MAX_BYTES = int(os.environ.get("TACTIL_STAGE_CACHE_MAX_BYTES", 2000 * 1000 * 1000))
+PROFILE_FOLDER = os.environ.get("TACTIL_PROFILE_DIR")  # stage timing files are only written if set
+TILE_MAX_AGE = 365 * 24 * 60 * 60  # seconds
+# seconds since last modified after which the sweeper deletes models, editor images and uploads
+MODEL_TTL = float(os.environ.get("TACTIL_MODEL_TTL_SECONDS", 60 * 60))
+IMAGE_TTL = float(os.environ.get("TACTIL_IMAGE_TTL_SECONDS", 7 * 24 * 60 * 60))
+UPLOAD_TTL = float(os.environ.get("TACTIL_UPLOAD_TTL_SECONDS", 7 * 24 * 60 * 60))
+SWEEP_INTERVAL = float(os.environ.get("TACTIL_SWEEP_INTERVAL_SECONDS", 10 * 60))  # 0 never sweeps
+# start the job workers with the app rather than on the first job (0 to start them lazily)
+WARM_WORKERS = os.environ.get("TACTIL_WARM_WORKERS", "1") != "0"
+PHYSICAL_PARAMETERS_SCHEMA = class_schema(PhysicalParameters)()
 
 
 def allowed_file(filename):
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
-@dataclass
-class GeneratePayload():
-    vector_map: VectorMap
-    model_params: PhysicalParameters
-
-
 def create_app():
     app = Flask(__name__)
     app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
@@ -38,6 +60,34 @@ def create_app():
     )  # re-generates key on every startup. Okay if we don't mind invalidating user's cookies
     CORS(app)
 
+    result_cache = ResultCache(RESULT_CACHE_FOLDER, RESULT_CACHE_MAX_BYTES)
+    job_queue = JobQueue(
+        JOB_FOLDER,
+        max_workers=MAX_CONCURRENT_JOBS,
+        max_pending=MAX_PENDING_JOBS,
+        result_cache=result_cache,
+        pipeline_workers=PIPELINE_WORKERS,
+        profile_dir=PROFILE_FOLDER,
+        stage_cache=StageCache(STAGE_CACHE_FOLDER, STAGE_CACHE_MAX_BYTES),
+    )
+    if WARM_WORKERS:
+        job_queue.warm_up()
+    OutputSweeper({
+        OUTPUT_FOLDER: MODEL_TTL,
+        IMAGE_FOLDER: IMAGE_TTL,
+        UPLOAD_FOLDER: UPLOAD_TTL,
+        os.path.join(UPLOAD_FOLDER, PARTIAL_DIRNAME): UPLOAD_TTL,  # abandoned chunked uploads
+    }, SWEEP_INTERVAL).start()
+
+    def validation_error_response(e: ValidationError, message: str = "Invalid process parameters"):
+        resp = jsonify({"message": message, "errors": e.messages})
+        resp.status_code = 400
+        return resp
+
+    @app.route("/api/presets")
+    def process_presets():
+        # every preset's full parameters, e.g. for showing the defaults in a settings form
+        return jsonify({name: dataclasses.asdict(resolve_parameters(preset=name)) for name in PRESETS})
 
     @app.route("/api/process", methods=["POST"])
     def process_file():
@@ -50,39 +100,92 @@ def create_app():
 
         # TODO: validate filename
         cloud_path = os.path.join(UPLOAD_FOLDER, json["filename"])
-        vector_map, image_info = process(
-            cloud_path, IMAGE_FOLDER, visualise=False
-        )
+        try:
+            job_id = job_queue.submit_process(
+                cloud_path, IMAGE_FOLDER, parameters=json.get("parameters"), preset=json.get("preset", DEFAULT_PRESET)
+            )
+        except JobQueueFullError as e:
+            return str(e), 503
+        except ValidationError as e:
+            return validation_error_response(e)
 
         resp = jsonify(
             {
-                "message": "File successfully processed",
-                "initial_vector_map": vector_map,
-                "pcd_image_info": image_info,
+                "message": "File queued for processing",
+                "job_id": job_id,
             }
         )
-        resp.status_code = 200
+        resp.status_code = 202
         return resp
 
+    @app.route("/api/jobs/<job_id>")
+    def job_status(job_id):
+        status = job_queue.status(job_id)
+        if status is None:
+            return "Job not found", 404
+        return jsonify(status)
+
+    @app.route("/api/jobs/<job_id>/rerun", methods=["POST"])
+    def rerun_job(job_id):
+        # e.g. {"parameters": {"plane_fit": {"distance_threshold": 0.08}}}, optionally with a "preset"
+        json_payload = request.get_json(silent=True) or {}
+        try:
+            new_job_id = job_queue.rerun(job_id, IMAGE_FOLDER, json_payload.get("parameters"), json_payload.get("preset"))
+        except JobQueueFullError as e:
+            return str(e), 503
+        except ValidationError as e:
+            return validation_error_response(e)
+        if new_job_id is None:
+            return "Job not found", 404
+
+        resp = jsonify({"message": "File queued for processing", "job_id": new_job_id})
+        resp.status_code = 202
+        return resp
+
+    @app.route("/api/cache/stats")
+    def cache_stats():
+        return jsonify(result_cache.stats())
+
     @app.route("/api/generate", methods=["POST"])
     def generate_model():
+        # either JSON of a vector_map and model_params, or a binary vector map (see
+        # VectorMapArrays.to_bytes) with the model parameters in the query string
         content_type = request.headers.get("Content-Type")
-        if content_type == "application/json":
-            json_payload = request.json
-        else:
-            return "Content-Type not supported!"
-
-        # TODO: validate filename
-        generate_payload = GeneratePayload.Schema().load(json_payload)
-        print(generate_payload.vector_map)
+        try:
+            if content_type == "application/json":
+                json_payload = request.json
+                if not isinstance(json_payload, dict) or "vector_map" not in json_payload:
+                    raise ValidationError({"vector_map": ["Missing data for required field."]})
+                # read straight into arrays, rather than a dataclass per feature
+                vector_map = VectorMapArrays.from_json(json_payload["vector_map"])
+                model_params = PHYSICAL_PARAMETERS_SCHEMA.load(json_payload.get("model_params"))
+            elif content_type == VECTOR_MAP_MEDIA_TYPE:
+                vector_map = VectorMapArrays.from_bytes(request.get_data())
+                model_params = PHYSICAL_PARAMETERS_SCHEMA.load(request.args)
+            else:
+                return "Content-Type not supported!"
+        except ValidationError as e:
+            return validation_error_response(e, "Invalid generate request")
+        print(f"Generating model of {len(vector_map.edge_ids)} walls")
 
-        generate(generate_payload.vector_map, generate_payload.model_params, visualise=False, output_folder=OUTPUT_FOLDER)
+        profiler = StageProfiler()
+        model_id = uuid.uuid4().hex
+        generate(vector_map, model_params, visualise=False, output_folder=OUTPUT_FOLDER, profiler=profiler, model_id=model_id)
 
-        resp = jsonify({"message": "File successfully generated"})
+        resp = jsonify({"message": "File successfully generated", "model_id": model_id, "profile": profiler.report()})
         resp.status_code = 200
         return resp
 
 
+    def convert_upload(cloud_path: str):
+        # parsed once in the background, so that every later process job memory maps the cloud.
+        # Only a warm-up (process jobs convert the cloud themselves if need be), so a failure to
+        # queue it must not fail the upload, which has already succeeded
+        try:
+            job_queue.submit_convert(cloud_path)
+        except Exception as e:
+            print(f"Could not queue conversion of {cloud_path}: {e!r}")
+
     @app.route("/api/upload", methods=["POST"])
     def upload_file():
         if request.method == "POST":
@@ -96,11 +199,12 @@ def create_app():
                 return "No selected file", 400
             if file and allowed_file(file.filename):
                 filename = secure_filename(file.filename)
-                try:
-                    file.save(os.path.join(app.config["UPLOAD_FOLDER"], filename))
-                except FileNotFoundError:
-                    os.makedirs(app.config["UPLOAD_FOLDER"])
-                    file.save(os.path.join(app.config["UPLOAD_FOLDER"], filename))
+                os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
+                # saved under a temporary name and renamed, so a job never reads a partial file
+                tmp_path = os.path.join(app.config["UPLOAD_FOLDER"], f".{uuid.uuid4().hex}.tmp")
+                file.save(tmp_path)
+                os.replace(tmp_path, os.path.join(app.config["UPLOAD_FOLDER"], filename))
+                convert_upload(os.path.join(app.config["UPLOAD_FOLDER"], filename))
                 response = make_response("")
                 response.headers.add("Access-Control-Allow-Origin", "*")
                 return response
@@ -108,6 +212,60 @@ def create_app():
                 return "File type not supported", 400
 
 
+    chunked_uploads = ChunkedUploads(UPLOAD_FOLDER)
+
+    def upload_error_response(e: UploadError):
+        body = {"message": str(e)}
+        if isinstance(e, UploadOffsetError):
+            body["offset"] = e.offset
+        resp = jsonify(body)
+        resp.status_code = e.status_code
+        return resp
+
+    @app.route("/api/upload/chunked", methods=["POST"])
+    def init_chunked_upload():
+        json_payload = request.get_json(silent=True)
+        if json_payload is None or "filename" not in json_payload or "size" not in json_payload:
+            return "Expected JSON with filename and size", 400
+        if not allowed_file(json_payload["filename"]):
+            return "File type not supported", 400
+        try:
+            upload_id = chunked_uploads.init(json_payload["filename"], int(json_payload["size"]))
+        except UploadError as e:
+            return upload_error_response(e)
+        resp = jsonify({"upload_id": upload_id, "offset": 0})
+        resp.status_code = 201
+        return resp
+
+    @app.route("/api/upload/chunked/<upload_id>", methods=["GET"])
+    def chunked_upload_status(upload_id):
+        try:
+            return jsonify(chunked_uploads.status(upload_id))
+        except UploadError as e:
+            return upload_error_response(e)
+
+    @app.route("/api/upload/chunked/<upload_id>", methods=["PUT"])
+    def upload_chunk(upload_id):
+        offset = request.args.get("offset", type=int)
+        if offset is None:
+            return "Missing offset", 400
+        try:
+            # request.stream reads the raw body as it arrives, without spooling it
+            new_offset = chunked_uploads.write_chunk(upload_id, offset, request.stream)
+        except UploadError as e:
+            return upload_error_response(e)
+        return jsonify({"upload_id": upload_id, "offset": new_offset})
+
+    @app.route("/api/upload/chunked/<upload_id>/finalize", methods=["POST"])
+    def finalize_chunked_upload(upload_id):
+        json_payload = request.get_json(silent=True) or {}
+        try:
+            filename = chunked_uploads.finalize(upload_id, json_payload.get("sha256"))
+        except UploadError as e:
+            return upload_error_response(e)
+        convert_upload(os.path.join(UPLOAD_FOLDER, filename))
+        return jsonify({"message": "File successfully uploaded", "filename": filename})
+
     @app.route("/api/uploads/<name>")
     def download_file(name):
         return send_from_directory(app.config["UPLOAD_FOLDER"], name)
@@ -117,10 +275,26 @@ def create_app():
     def send_pcd_image(name):
         return send_from_directory(IMAGE_FOLDER, name)
 
+    @app.route("/api/image_output/<pyramid_id>/<int:z>/<int:x>/<int:y>.png")
+    def send_pcd_image_tile(pyramid_id, z, x, y):
+        try:
+            tile_path = render_tile(IMAGE_FOLDER, pyramid_id, z, x, y)
+        except TileNotFoundError as e:
+            return make_response(jsonify({"message": str(e)}), 404)
+        # tiles never change once rendered, since each pyramid has a new id
+        response = send_file(os.path.abspath(tile_path), mimetype="image/png", max_age=TILE_MAX_AGE)
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
 
-    @app.route("/api/generate/output")
-    def download_output():
-        return send_from_directory(OUTPUT_FOLDER, "model.stl")
+    @app.route("/api/generate/output/<model_id>")
+    def download_output(model_id):
+        try:
+            uuid.UUID(hex=model_id)  # only accept ids we could have generated
+        except ValueError:
+            return make_response(jsonify({"message": f"Unknown model {model_id}"}), 404)
+        return send_from_directory(OUTPUT_FOLDER, model_id + ".stl", as_attachment=True, download_name="model.stl")
 
     return app
 
@@ -0,0 +1,527 @@
+# Out-of-core point cloud reading.
+# Reads .pcd (ascii/binary) and .xyz files in fixed size chunks, applying the vertical
+# axis swap and height threshold to each chunk and accumulating the survivors into a
+# voxel grid, so the full resolution cloud is never held in memory at once.
+# Uploaded clouds are also converted once into memory mappable binary clouds.
+# open3d is only imported to build PointClouds, so the API converts uploads without loading it.
+import dataclasses
+import fcntl
+import io
+import itertools
+import json
+import mmap
+import os
+import shutil
+import typing
+from dataclasses import dataclass
+
+import numpy as np
+
+from .typings.o3d_geometry import PointCloud
+
+DEFAULT_CHUNK_SIZE = 250_000  # points
+
+PCD_TYPES = {
+    ("F", 4): np.float32,
+    ("F", 8): np.float64,
+    ("U", 1): np.uint8,
+    ("U", 2): np.uint16,
+    ("U", 4): np.uint32,
+    ("U", 8): np.uint64,
+    ("I", 1): np.int8,
+    ("I", 2): np.int16,
+    ("I", 4): np.int32,
+    ("I", 8): np.int64,
+}
+
+
+class UnsupportedCloudFormat(Exception):
+    pass
+
+
+@dataclass
+class CloudChunk:
+    """Class for storing a chunk of points, with normals and colours if the file has them"""
+    points: np.ndarray  # Nx3
+    normals: typing.Optional[np.ndarray]  # Nx3
+    colors: typing.Optional[np.ndarray]  # Nx3, in [0, 1]
+
+
+@dataclass
+class PcdHeader:
+    fields: list[str]
+    sizes: list[int]
+    types: list[str]
+    counts: list[int]
+    points: int
+    data: str  # ascii, binary or binary_compressed
+    data_offset: int  # bytes from start of file to first point
+
+    def column(self, field: str) -> typing.Optional[int]:
+        """Index of the first value of field within an ascii row"""
+        if field not in self.fields:
+            return None
+        index = self.fields.index(field)
+        return sum(self.counts[:index])
+
+    def dtype(self) -> np.dtype:
+        """Structured dtype of one point in a binary file"""
+        descr = []
+        for i, (field, size, type_code, count) in enumerate(zip(self.fields, self.sizes, self.types, self.counts)):
+            name = field if field != "_" else f"_padding{i}"
+            try:
+                base = PCD_TYPES[(type_code, size)]
+            except KeyError:
+                raise UnsupportedCloudFormat(f"Unsupported PCD type {type_code}{size} for field {field}")
+            descr.append((name, base, (count,)) if count > 1 else (name, base))
+        return np.dtype(descr)
+
+
+def read_pcd_header(path: typing.Union[str, os.PathLike]) -> PcdHeader:
+    values = {}
+    with open(path, "rb") as f:
+        while True:
+            line = f.readline()
+            if not line:
+                raise UnsupportedCloudFormat(f"{path} has no DATA line in its header")
+            tokens = line.decode("ascii", errors="replace").split()
+            if len(tokens) == 0 or tokens[0].startswith("#"):
+                continue
+            values[tokens[0].upper()] = tokens[1:]
+            if tokens[0].upper() == "DATA":
+                data_offset = f.tell()
+                break
+
+    fields = values["FIELDS"]
+    return PcdHeader(
+        fields=fields,
+        sizes=[int(s) for s in values["SIZE"]],
+        types=[t.upper() for t in values["TYPE"]],
+        counts=[int(c) for c in values.get("COUNT", ["1"] * len(fields))],
+        points=int(values["POINTS"][0]),
+        data=values["DATA"][0].lower(),
+        data_offset=data_offset,
+    )
+
+
+def unpack_rgb(packed: np.ndarray) -> np.ndarray:
+    """Converts PCL-style packed rgb values into Nx3 floats in [0, 1]"""
+    if packed.dtype == np.float32:
+        packed = packed.view(np.uint32)
+    packed = packed.astype(np.uint32)
+    rgb = np.stack([(packed >> 16) & 0xFF, (packed >> 8) & 0xFF, packed & 0xFF], axis=1)
+    return rgb / 255.0
+
+
+def iter_ascii_rows(f: typing.TextIO, chunk_size: int) -> typing.Iterator[np.ndarray]:
+    """Yields blocks of up to chunk_size whitespace separated numeric rows"""
+    while True:
+        lines = list(itertools.islice(f, chunk_size))
+        if len(lines) == 0:
+            return
+        lines = [line for line in lines if line.strip()]
+        if len(lines) == 0:
+            continue
+        width = len(lines[0].split())
+        values = np.array(" ".join(lines).split(), dtype=np.float64)
+        yield values.reshape(-1, width)
+
+
+def iter_pcd_chunks(path: typing.Union[str, os.PathLike], chunk_size: int) -> typing.Iterator[CloudChunk]:
+    header = read_pcd_header(path)
+    has_normals = "normal_x" in header.fields
+    rgb_field = "rgb" if "rgb" in header.fields else ("rgba" if "rgba" in header.fields else None)
+
+    if header.data == "binary":
+        # memory map the file so only the chunk being processed is paged in
+        dtype = header.dtype()
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            for start in range(0, header.points, chunk_size):
+                count = min(chunk_size, header.points - start)
+                offset = header.data_offset + start * dtype.itemsize
+                block = np.frombuffer(mapped, dtype=dtype, count=count, offset=offset)
+                chunk = CloudChunk(
+                    points=np.stack([block["x"], block["y"], block["z"]], axis=1).astype(np.float64),
+                    normals=np.stack([block["normal_x"], block["normal_y"], block["normal_z"]], axis=1).astype(np.float64)
+                    if has_normals else None,
+                    colors=unpack_rgb(block[rgb_field]) if rgb_field is not None else None,
+                )
+                del block  # release the buffer export so the map can be closed
+                # drop the pages just read from this process's resident set
+                page_start = offset - offset % mmap.PAGESIZE
+                mapped.madvise(mmap.MADV_DONTNEED, page_start, offset + count * dtype.itemsize - page_start)
+                yield chunk
+    elif header.data == "ascii":
+        x, nx = header.column("x"), header.column("normal_x")
+        rgb_column = header.column(rgb_field) if rgb_field is not None else None
+        rgb_type = PCD_TYPES[(header.types[header.fields.index(rgb_field)], 4)] if rgb_field is not None else None
+        with open(path, "rb") as raw:
+            raw.seek(header.data_offset)
+            f = io.TextIOWrapper(raw, encoding="ascii")
+            for rows in iter_ascii_rows(f, chunk_size):
+                yield CloudChunk(
+                    points=rows[:, x:x + 3],
+                    normals=rows[:, nx:nx + 3] if has_normals else None,
+                    colors=unpack_rgb(rows[:, rgb_column].astype(rgb_type)) if rgb_column is not None else None,
+                )
+    else:
+        raise UnsupportedCloudFormat(f"Unsupported PCD data encoding: {header.data}")
+
+
+def iter_xyz_chunks(path: typing.Union[str, os.PathLike], chunk_size: int) -> typing.Iterator[CloudChunk]:
+    """Reads x y z rows, with normals when rows have six values (as in .xyzn files)"""
+    with open(path, "r") as f:
+        for rows in iter_ascii_rows(f, chunk_size):
+            yield CloudChunk(
+                points=rows[:, 0:3],
+                normals=rows[:, 3:6] if rows.shape[1] >= 6 else None,
+                colors=None,
+            )
+
+
+def iter_cloud_chunks(
+    path: typing.Union[str, os.PathLike], chunk_size: int = DEFAULT_CHUNK_SIZE
+) -> typing.Iterator[CloudChunk]:
+    extension = os.path.splitext(str(path))[1].lower()
+    if extension == ".pcd":
+        return iter_pcd_chunks(path, chunk_size)
+    elif extension in (".xyz", ".xyzn"):
+        return iter_xyz_chunks(path, chunk_size)
+    raise UnsupportedCloudFormat(f"Streaming is not supported for {extension} files")
+
+
+def supports_streaming(path: typing.Union[str, os.PathLike]) -> bool:
+    if fresh_binary_cloud(path) is not None:
+        return True
+    extension = os.path.splitext(str(path))[1].lower()
+    if extension == ".pcd":
+        return read_pcd_header(path).data in ("ascii", "binary")
+    return extension in (".xyz", ".xyzn")
+
+
+# Binary clouds: a copy of a cloud file in a compact columnar form, so that reprocessing
+# a scan memory maps it instead of parsing text. A binary cloud is a directory holding
+# header.json (BinaryCloudHeader) and one raw little endian file per column:
+# points.f32 and normals.f32 (Nx3 float32) and colors.u8 (Nx3 uint8).
+# Points are stored relative to the header's origin, so float32 keeps georeferenced
+# (e.g. UTM) coordinates to well under a millimetre.
+BINARY_CLOUD_DIRNAME = ".clouds"  # created beside the cloud files
+BINARY_CLOUD_VERSION = 2
+BINARY_HEADER_FILENAME = "header.json"
+BINARY_COLUMNS = {"points": ("points.f32", np.float32), "normals": ("normals.f32", np.float32), "colors": ("colors.u8", np.uint8)}
+
+
+@dataclass
+class BinaryCloudHeader:
+    version: int
+    points: int
+    has_normals: bool
+    has_colors: bool
+    bounds_min: list[float]  # x, y, z
+    bounds_max: list[float]
+    origin: list[float]  # x, y, z added to the stored points (the first chunk's minimum)
+    source_size: int  # bytes, of the file the binary cloud was made from
+    source_mtime_ns: int
+
+
+def binary_cloud_dir(path: typing.Union[str, os.PathLike]) -> str:
+    return os.path.join(os.path.dirname(str(path)), BINARY_CLOUD_DIRNAME, os.path.basename(str(path)))
+
+
+def binary_cloud_lock_path(path: typing.Union[str, os.PathLike]) -> str:
+    """File locked while the binary cloud of path is made (see convert_to_binary_cloud)"""
+    return binary_cloud_dir(path) + ".lock"
+
+
+def read_binary_cloud_header(directory: typing.Union[str, os.PathLike]) -> BinaryCloudHeader:
+    with open(os.path.join(directory, BINARY_HEADER_FILENAME)) as f:
+        return BinaryCloudHeader(**json.load(f))
+
+
+def fresh_binary_cloud(path: typing.Union[str, os.PathLike]) -> typing.Optional[str]:
+    """Directory of the binary cloud made from path, or None if there is none or the
+    file has changed since it was made"""
+    directory = binary_cloud_dir(path)
+    try:
+        header = read_binary_cloud_header(directory)
+        stat = os.stat(path)
+    except (FileNotFoundError, NotADirectoryError, json.JSONDecodeError, TypeError):
+        return None
+    if (header.version, header.source_size, header.source_mtime_ns) != (BINARY_CLOUD_VERSION, stat.st_size, stat.st_mtime_ns):
+        return None
+    return directory
+
+
+def write_binary_cloud(path: typing.Union[str, os.PathLike], chunk_size: int = DEFAULT_CHUNK_SIZE) -> str:
+    """Converts a cloud file that iter_cloud_chunks can read into a binary cloud, one chunk
+    at a time, and returns the binary cloud's directory"""
+    directory = binary_cloud_dir(path)
+    stat = os.stat(path)
+    tmp_dir = f"{directory}.{os.getpid()}.tmp"
+    os.makedirs(tmp_dir, exist_ok=True)
+    files = {name: open(os.path.join(tmp_dir, filename), "wb") for name, (filename, _) in BINARY_COLUMNS.items()}
+    count = 0
+    bounds_min, bounds_max = np.full(3, np.inf), np.full(3, -np.inf)
+    origin = None
+    has_normals = has_colors = None
+    try:
+        for chunk in iter_cloud_chunks(path, chunk_size):
+            if has_normals is None:
+                has_normals, has_colors = chunk.normals is not None, chunk.colors is not None
+            if origin is None and len(chunk.points) > 0:
+                origin = chunk.points.min(axis=0).astype(np.float64)
+            if origin is not None:
+                files["points"].write((chunk.points - origin).astype(np.float32).tobytes())
+            if has_normals:
+                files["normals"].write(chunk.normals.astype(np.float32).tobytes())
+            if has_colors:
+                files["colors"].write(np.round(chunk.colors * 255).astype(np.uint8).tobytes())
+            count += len(chunk.points)
+            if len(chunk.points) > 0:
+                bounds_min = np.minimum(bounds_min, chunk.points.min(axis=0))
+                bounds_max = np.maximum(bounds_max, chunk.points.max(axis=0))
+    finally:
+        for f in files.values():
+            f.close()
+
+    header = BinaryCloudHeader(
+        version=BINARY_CLOUD_VERSION,
+        points=count,
+        has_normals=bool(has_normals),
+        has_colors=bool(has_colors),
+        bounds_min=bounds_min.tolist() if count > 0 else [0.0] * 3,
+        bounds_max=bounds_max.tolist() if count > 0 else [0.0] * 3,
+        origin=origin.tolist() if origin is not None else [0.0] * 3,
+        source_size=stat.st_size,
+        source_mtime_ns=stat.st_mtime_ns,
+    )
+    with open(os.path.join(tmp_dir, BINARY_HEADER_FILENAME), "w") as f:
+        json.dump(dataclasses.asdict(header), f)
+
+    # replace any binary cloud made from an earlier upload of the same name
+    if os.path.exists(directory):
+        shutil.rmtree(directory, ignore_errors=True)
+    os.replace(tmp_dir, directory)
+    return directory
+
+
+def convert_to_binary_cloud(path: typing.Union[str, os.PathLike]) -> typing.Optional[str]:
+    """write_binary_cloud, for uploads: returns None instead of raising if the file is not
+    a cloud format that can be streamed. A cloud is only converted by one process at a time,
+    so callers wait for a conversion already under way, and an up to date binary cloud is
+    returned without converting again"""
+    lock_path = binary_cloud_lock_path(path)
+    os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+    with open(lock_path, "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        directory = fresh_binary_cloud(path)
+        if directory is not None:
+            return directory
+        try:
+            if not supports_streaming(path):
+                return None
+            return write_binary_cloud(path)
+        except (UnsupportedCloudFormat, ValueError):
+            return None
+
+
+def open_binary_cloud(directory: typing.Union[str, os.PathLike]) -> typing.Tuple[BinaryCloudHeader, dict]:
+    """The header, and a read only memory map of each column present (points, normals, colors)"""
+    header = read_binary_cloud_header(directory)
+    present = {"points": header.points > 0, "normals": header.has_normals and header.points > 0,
+               "colors": header.has_colors and header.points > 0}
+    columns = {}
+    for name, (filename, dtype) in BINARY_COLUMNS.items():
+        if present[name]:
+            columns[name] = np.memmap(os.path.join(directory, filename), dtype=dtype, mode="r", shape=(header.points, 3))
+    return header, columns
+
+
+def iter_binary_chunks(directory: typing.Union[str, os.PathLike], chunk_size: int) -> typing.Iterator[CloudChunk]:
+    """Normals are float32 views of the memory map, without copying. Points are float64,
+    with the header's origin added back"""
+    header, columns = open_binary_cloud(directory)
+    origin = np.array(header.origin)
+    for start in range(0, header.points, chunk_size):
+        stop = min(start + chunk_size, header.points)
+        yield CloudChunk(
+            points=columns["points"][start:stop] + origin,
+            normals=columns["normals"][start:stop] if "normals" in columns else None,
+            colors=columns["colors"][start:stop] / 255.0 if "colors" in columns else None,
+        )
+
+
+def read_binary_cloud(directory: typing.Union[str, os.PathLike]) -> PointCloud:
+    """Loads a whole binary cloud. Open3D's legacy PointCloud holds float64, so the columns
+    are converted (one copy each) but nothing is parsed."""
+    import open3d as o3d
+
+    header, columns = open_binary_cloud(directory)
+    pcd = o3d.geometry.PointCloud()
+    if "points" in columns:
+        pcd.points = o3d.utility.Vector3dVector(columns["points"] + np.array(header.origin))
+    if "normals" in columns:
+        pcd.normals = o3d.utility.Vector3dVector(columns["normals"].astype(np.float64))
+    if "colors" in columns:
+        pcd.colors = o3d.utility.Vector3dVector(columns["colors"] / 255.0)
+    return pcd
+
+
+class VoxelGridAccumulator:
+    """Incrementally averages points (and normals/colours) falling into the same voxel.
+
+    Each chunk is reduced to one entry per occupied voxel on arrival, and reduced
+    chunks are merged together once they outgrow the merged grid, so memory use
+    scales with the number of occupied voxels rather than the number of points."""
+
+    # voxel coordinates are packed into one int64 key, 21 bits per axis, relative to the
+    # first chunk's lowest voxel (so that clouds far from the origin, such as georeferenced
+    # scans, fit) which is keyed KEY_OFFSET from zero, so later chunks may extend below it
+    KEY_BITS = 21
+    KEY_OFFSET = 1 << (KEY_BITS - 1)
+
+    def __init__(self, voxel_size: float):
+        self.voxel_size = voxel_size
+        self.has_normals = None
+        self.has_colors = None
+        self._origin = None  # voxel coordinates keyed as zero
+        self._merged = None  # (keys, sums, counts)
+        self._pending = []
+        self._pending_size = 0
+
+    def _keys(self, points: np.ndarray) -> np.ndarray:
+        # in float64 whatever the input, so float32 clouds fall into the same voxels
+        voxel = np.floor(points.astype(np.float64, copy=False) / self.voxel_size).astype(np.int64)
+        if self._origin is None:
+            self._origin = voxel.min(axis=0) - self.KEY_OFFSET
+        return self._pack(voxel - self._origin)
+
+    def _pack(self, voxel: np.ndarray) -> np.ndarray:
+        if np.any(voxel < 0) or np.any(voxel >= 1 << self.KEY_BITS):
+            raise ValueError("Point cloud extent too large for voxel grid")
+        return (voxel[:, 0] << (2 * self.KEY_BITS)) | (voxel[:, 1] << self.KEY_BITS) | voxel[:, 2]
+
+    def _unpack(self, keys: np.ndarray) -> np.ndarray:
+        mask = (1 << self.KEY_BITS) - 1
+        return np.stack([(keys >> shift) & mask for shift in (2 * self.KEY_BITS, self.KEY_BITS, 0)], axis=1)
+
+    def _coarsen(self, keys: np.ndarray, scale: int) -> np.ndarray:
+        # keys of the voxels scale times larger containing each voxel, on the same grid
+        # (that of the origin, as downsampling to the larger voxels directly would be)
+        voxel = self._unpack(keys) + self._origin
+        return self._pack(voxel // scale - self._origin // scale)
+
+    @staticmethod
+    def _reduce(keys: np.ndarray, sums: np.ndarray, counts: np.ndarray):
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
+        reduced_sums = np.stack(
+            [np.bincount(inverse, weights=sums[:, i], minlength=len(unique_keys)) for i in range(sums.shape[1])],
+            axis=1,
+        )
+        reduced_counts = np.bincount(inverse, weights=counts, minlength=len(unique_keys))
+        return unique_keys, reduced_sums, reduced_counts
+
+    def add(self, chunk: CloudChunk):
+        if len(chunk.points) == 0:
+            return
+        if self.has_normals is None:
+            self.has_normals = chunk.normals is not None
+            self.has_colors = chunk.colors is not None
+
+        columns = [chunk.points]
+        if self.has_normals:
+            columns.append(chunk.normals)
+        if self.has_colors:
+            columns.append(chunk.colors)
+        values = np.concatenate(columns, axis=1)
+
+        reduced = self._reduce(self._keys(chunk.points), values, np.ones(len(values)))
+        self._pending.append(reduced)
+        self._pending_size += len(reduced[0])
+        merged_size = len(self._merged[0]) if self._merged is not None else 0
+        if self._pending_size > max(merged_size, DEFAULT_CHUNK_SIZE):
+            self._merge()
+
+    def _merge(self):
+        parts = self._pending + ([self._merged] if self._merged is not None else [])
+        if len(parts) == 0:
+            return
+        if len(parts) == 1:
+            # already reduced, as a single chunk cloud is
+            self._merged, self._pending, self._pending_size = parts[0], [], 0
+            return
+        self._merged = self._reduce(
+            np.concatenate([p[0] for p in parts]),
+            np.concatenate([p[1] for p in parts]),
+            np.concatenate([p[2] for p in parts]),
+        )
+        self._pending = []
+        self._pending_size = 0
+
+    def to_point_cloud(self, scale: int = 1) -> PointCloud:
+        """scale: downsamples to voxels scale times larger along each axis instead, merging
+        the accumulated voxels rather than the points again"""
+        import open3d as o3d
+
+        self._merge()
+        pcd = o3d.geometry.PointCloud()
+        if self._merged is None:
+            return pcd
+
+        keys, sums, counts = self._merged
+        if scale != 1:
+            _, sums, counts = self._reduce(self._coarsen(keys, scale), sums, counts)
+        means = sums / counts.reshape(-1, 1)
+        pcd.points = o3d.utility.Vector3dVector(means[:, 0:3])
+        column = 3
+        if self.has_normals:
+            normals = means[:, column:column + 3]
+            magnitudes = np.linalg.norm(normals, axis=1)
+            magnitudes[magnitudes == 0] = 1.0
+            pcd.normals = o3d.utility.Vector3dVector(normals / magnitudes.reshape(-1, 1))
+            column += 3
+        if self.has_colors:
+            pcd.colors = o3d.utility.Vector3dVector(means[:, column:column + 3])
+        return pcd
+
+
+def read_cloud_downsampled(
+    pcd_path: typing.Union[str, os.PathLike],
+    z_index: int = 2,
+    threshold_height: float = 0.5,
+    voxel_size: float = 0.1,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> PointCloud:
+    """Streams the cloud in chunks, swapping the vertical axis into z, discarding points
+    at or above threshold_height and voxel downsampling what remains.
+    Reads the binary cloud made from pcd_path instead, if there is an up to date one."""
+    return accumulate_cloud(pcd_path, z_index, threshold_height, voxel_size, chunk_size).to_point_cloud()
+
+
+def accumulate_cloud(
+    pcd_path: typing.Union[str, os.PathLike],
+    z_index: int = 2,
+    threshold_height: float = 0.5,
+    voxel_size: float = 0.1,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> VoxelGridAccumulator:
+    """As read_cloud_downsampled, but the voxel grid itself, for downsampling to more than one resolution"""
+    binary_dir = fresh_binary_cloud(pcd_path)
+    chunks = iter_binary_chunks(binary_dir, chunk_size) if binary_dir is not None else iter_cloud_chunks(pcd_path, chunk_size)
+    accumulator = VoxelGridAccumulator(voxel_size)
+    for chunk in chunks:
+        if z_index != 2:
+            swap = [0, 1, 2]
+            swap[2], swap[z_index] = z_index, 2
+            chunk.points = chunk.points[:, swap]
+            if chunk.normals is not None:
+                chunk.normals = chunk.normals[:, swap]
+
+        keep = chunk.points[:, 2] < threshold_height
+        accumulator.add(CloudChunk(
+            points=chunk.points[keep],
+            normals=chunk.normals[keep] if chunk.normals is not None else None,
+            colors=chunk.colors[keep] if chunk.colors is not None else None,
+        ))
+
+    return accumulator
@@ -1,18 +1,24 @@
 from dataclasses import dataclass
 import numpy as np
 import os
-from stl import mesh
-from scipy.spatial.transform import Rotation as R
 import pathlib
+import typing
+import uuid
 
-from .VectorMap import VectorMap, euclidean_distance
+from .VectorMap import VectorMap, VectorMapArrays
+from .profiler import StageProfiler
+
+# numpy-stl and scipy are imported where used, so that importing this module (as the API
+# does at startup) stays cheap
+if typing.TYPE_CHECKING:
+    from stl import mesh
 
 @dataclass
 class BoxProperties:
     """ Class for representing a list of N 3D rectangular prisms """
-    box_centers: list[np.array] # Nx3 coordinates
-    box_extents: list[np.array] # Nx3 measurements of length/2, width/2, height/2
-    box_rotations: list[np.array] # Nx3x3 rotation matrices
+    box_centers: np.ndarray # Nx3 coordinates
+    box_extents: np.ndarray # Nx3 measurements of length/2, width/2, height/2
+    box_rotations: np.ndarray # Nx3x3 rotation matrices
 
 @dataclass
 class PhysicalParameters:
@@ -24,49 +30,149 @@ class PhysicalParameters:
     floor_thickness_mm: float # e.g. 5mm
 
 
-def generate(vector_map: VectorMap, model_params: PhysicalParameters, visualise: bool, output_folder: pathlib.Path):
-    box_properties = vector_map_to_box_properties(vector_map)
-
-    centers_unscaled = np.array(box_properties.box_centers)
-    extents_unscaled = np.array(box_properties.box_extents)
-    rotations = np.array(box_properties.box_rotations)
-
-    # scale dimensions down to model size
-    meters_to_mm = 1000
-    centers = centers_unscaled * model_params.model_scale_factor * meters_to_mm
-    extents = extents_unscaled * model_params.model_scale_factor * meters_to_mm
-
-    # define the 8 vertices of a cube
-    cube_vertices = np.array([\
-        [-1., -1., -1.],
-        [+1., -1., -1.],
-        [+1., +1., -1.],
-        [-1., +1., -1.],
-        [-1., -1., +1.],
-        [+1., -1., +1.],
-        [+1., +1., +1.],
-        [-1., +1., +1.]])
-
-    # define the 12 triangles composing a cube
-    cube_faces = np.array([\
-        [0,3,1],
-        [1,3,2],
-        [0,4,7],
-        [0,7,3],
-        [4,5,6],
-        [4,6,7],
-        [5,1,2],
-        [5,2,6],
-        [2,3,6],
-        [3,7,6],
-        [0,1,5],
-        [0,5,4]])
+# the 8 vertices of a cube
+CUBE_VERTICES = np.array([\
+    [-1., -1., -1.],
+    [+1., -1., -1.],
+    [+1., +1., -1.],
+    [-1., +1., -1.],
+    [-1., -1., +1.],
+    [+1., -1., +1.],
+    [+1., +1., +1.],
+    [-1., +1., +1.]])
+
+# the 12 triangles composing a cube, as indices into CUBE_VERTICES
+CUBE_FACES = np.array([\
+    [0,3,1],
+    [1,3,2],
+    [0,4,7],
+    [0,7,3],
+    [4,5,6],
+    [4,6,7],
+    [5,1,2],
+    [5,2,6],
+    [2,3,6],
+    [3,7,6],
+    [0,1,5],
+    [0,5,4]])
+
+
+def generate(vector_map: typing.Union[VectorMap, VectorMapArrays], model_params: PhysicalParameters, visualise: bool, output_folder: pathlib.Path, profiler: typing.Optional[StageProfiler] = None, model_id: typing.Optional[str] = None) -> str:
+    """ Saves the model as output_folder/<model_id>.stl, returning its path. The file is
+    written under a temporary name and renamed, so it is never seen partly written.
+    vector_map: either form, VectorMapArrays being used as is
+    profiler: records timings of the boxes, mesh and save stages, with walls and
+    triangles counted in place of points
+    model_id: a new unique id if not given """
+    if model_id is None:
+        model_id = uuid.uuid4().hex
+    if profiler is None:
+        profiler = StageProfiler()
+
+    with profiler.stage("boxes") as record:
+        box_properties = vector_map_to_box_properties(vector_map)
+
+        centers_unscaled = np.array(box_properties.box_centers)
+        extents_unscaled = np.array(box_properties.box_extents)
+        rotations = np.array(box_properties.box_rotations)
+
+        # scale dimensions down to model size
+        meters_to_mm = 1000
+        centers = centers_unscaled * model_params.model_scale_factor * meters_to_mm
+        extents = extents_unscaled * model_params.model_scale_factor * meters_to_mm
+        record.points_out = len(centers)
+
+    with profiler.stage("mesh", points_in=len(centers)) as record:
+        combined_mesh = build_mesh(centers, extents, rotations, model_params)
+        record.points_out = len(combined_mesh.vectors)
+
+    with profiler.stage("save", points_in=len(combined_mesh.vectors)):
+        # create output directory if it doesn't exist
+        if not os.path.exists(output_folder):
+            os.makedirs(output_folder, exist_ok=True)
+
+        file_path = os.path.join(output_folder, model_id + '.stl')
+        tmp_path = os.path.join(output_folder, f'.{model_id}.{os.getpid()}.tmp')
+        import stl
+        with open(tmp_path, 'wb') as f:
+            combined_mesh.save('model.stl', fh=f, mode=stl.Mode.BINARY)
+        os.replace(tmp_path, file_path)
+
+    if visualise:
+        display_meshes([combined_mesh])
+
+    return file_path
+
+
+def build_mesh(centers: np.ndarray, extents: np.ndarray, rotations: np.ndarray, model_params: PhysicalParameters) -> "mesh.Mesh":
+    """ Builds the walls and (if it has any thickness) the floor beneath them as one mesh """
+    wall_vertices = wall_box_vertices(centers, extents, rotations, model_params)
+    if model_params.floor_thickness_mm > 0: # only add floor if thickness > 0
+        # create floor mesh on which the walls sit
+        # length and width are defined by the extent of the walls
+        minx, miny = wall_vertices[:, :, 0].min(), wall_vertices[:, :, 1].min()
+        maxx, maxy = wall_vertices[:, :, 0].max(), wall_vertices[:, :, 1].max()
+        border_width = model_params.border_width_mm # 5 mm
+        floor_thickness = model_params.floor_thickness_mm # 5 # mm
+        floor_vert = np.array([\
+            [minx-border_width, miny-border_width, -floor_thickness],
+            [maxx+border_width, miny-border_width, -floor_thickness],
+            [maxx+border_width, maxy+border_width, -floor_thickness],
+            [minx-border_width, maxy+border_width, -floor_thickness],
+            [minx-border_width, miny-border_width, 0],
+            [maxx+border_width, miny-border_width, 0],
+            [maxx+border_width, maxy+border_width, 0],
+            [minx-border_width, maxy+border_width, 0]])
+
+        # combine walls and floor into single mesh to print
+        return boxes_to_mesh(np.concatenate([wall_vertices, floor_vert[np.newaxis]]))
+    return boxes_to_mesh(wall_vertices)
+
+
+def wall_box_vertices(centers: np.ndarray, extents: np.ndarray, rotations: np.ndarray, model_params: PhysicalParameters) -> np.ndarray:
+    """ Computes the corners of every wall box at once. Takes Nx3 centers and extents
+    (in mm) and Nx3x3 rotations, returns Nx8x3 vertices ordered as CUBE_VERTICES """
+    vert = np.tile(CUBE_VERTICES, (len(centers), 1, 1))
+
+    # scale
+    vert[:, :, 2] *= model_params.wall_height_mm / 2
+    vert[:, :, 2] += model_params.wall_height_mm / 2
+    half_length = (extents[:, 0] + model_params.wall_thickness_mm) / 2 # lengthened to make corners join up nicely
+    half_thickness = model_params.wall_thickness_mm / 2 # TODO: remove this / make a minimum
+    vert[:, :, 0] *= half_length[:, np.newaxis]
+    vert[:, :, 1] *= half_thickness
+
+    # rotate about the vertical axis only, discarding any x/y rotation
+    z_angle = np.arctan2(rotations[:, 1, 0], rotations[:, 0, 0])[:, np.newaxis]
+    cos, sin = np.cos(z_angle), np.sin(z_angle)
+    x, y = vert[:, :, 0].copy(), vert[:, :, 1].copy()
+    vert[:, :, 0] = cos * x - sin * y
+    vert[:, :, 1] = sin * x + cos * y
+
+    # translate
+    vert += centers[:, np.newaxis, :]
+    return vert
+
+
+def boxes_to_mesh(box_vertices: np.ndarray) -> "mesh.Mesh":
+    """ Builds a single mesh from Nx8x3 box vertices, 12 triangles per box """
+    from stl import mesh
+    data = np.zeros(len(box_vertices) * len(CUBE_FACES), dtype=mesh.Mesh.dtype)
+    data['vectors'] = box_vertices[:, CUBE_FACES].reshape(-1, 3, 3)
+    return mesh.Mesh(data)
+
+
+def wall_meshes_per_box(centers: np.ndarray, extents: np.ndarray, rotations: np.ndarray, model_params: PhysicalParameters) -> "mesh.Mesh":
+    """ Builds the walls mesh one box at a time. Much slower than
+    boxes_to_mesh(wall_box_vertices(...)), kept as a reference to check it against """
+    from scipy.spatial.transform import Rotation as R
+    from stl import mesh
 
     # generate a list of meshes, one for each bounding box
     box_meshes = []
-    for center, extent, rot in zip(centers, extents, rotations):
+    for center, extent, rot in zip(centers, extents.copy(), rotations):
         # scale
-        vert = cube_vertices.copy()
+        vert = CUBE_VERTICES.copy()
         vert[:, 2] *= model_params.wall_height_mm / 2
         vert[:, 2] += model_params.wall_height_mm / 2
         extent[1] = model_params.wall_thickness_mm # TODO: remove this / make a minimum
@@ -88,53 +194,15 @@ def generate(vector_map: VectorMap, model_params: PhysicalParameters, visualise:
         vert_transformed[:, 0:3] += center
 
         # create mesh
-        box_mesh = mesh.Mesh(np.zeros(cube_faces.shape[0], dtype=mesh.Mesh.dtype))
-        for i, f in enumerate(cube_faces):
+        box_mesh = mesh.Mesh(np.zeros(CUBE_FACES.shape[0], dtype=mesh.Mesh.dtype))
+        for i, f in enumerate(CUBE_FACES):
             for j in range(3):
                 box_mesh.vectors[i][j] = vert_transformed[f[j],:] 
 
         box_meshes.append(box_mesh)
 
     # combine boxes into a single large mesh
-    walls_mesh = mesh.Mesh(np.concatenate([cube.data for cube in box_meshes]))
-    print(model_params)
-    if model_params.floor_thickness_mm > 0: # only add floor if thickness > 0
-        # create floor mesh on which the walls sit
-        # length and width are defined by the extent of the walls
-        minx, maxx, miny, maxy = walls_mesh.x.min(), walls_mesh.x.max(), walls_mesh.y.min(), walls_mesh.y.max()
-        border_width = model_params.border_width_mm # 5 mm
-        floor_thickness = model_params.floor_thickness_mm # 5 # mm
-        floor_vert = np.array([\
-            [minx-border_width, miny-border_width, -floor_thickness],
-            [maxx+border_width, miny-border_width, -floor_thickness],
-            [maxx+border_width, maxy+border_width, -floor_thickness],
-            [minx-border_width, maxy+border_width, -floor_thickness],
-            [minx-border_width, miny-border_width, 0],
-            [maxx+border_width, miny-border_width, 0],
-            [maxx+border_width, maxy+border_width, 0],
-            [minx-border_width, maxy+border_width, 0]])
-
-        floor_mesh = mesh.Mesh(np.zeros(cube_faces.shape[0], dtype=mesh.Mesh.dtype))
-        for i, f in enumerate(cube_faces):
-            for j in range(3):
-                floor_mesh.vectors[i][j] = floor_vert[f[j],:]
-
-        # combine walls and floor into single mesh to print
-        combined_mesh = mesh.Mesh(np.concatenate([cube.data for cube in box_meshes] + [floor_mesh.data]))
-    else:
-        combined_mesh = mesh.Mesh(np.concatenate([cube.data for cube in box_meshes]))
-
-    # create output directory if it doesn't exist
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder, exist_ok=True)
-
-    file_path = os.path.join(output_folder, 'model.stl')
-    combined_mesh.save(file_path)
-
-    print(f"Saved STL file in {file_path}")
-
-    if visualise:
-        display_meshes([combined_mesh])
+    return mesh.Mesh(np.concatenate([cube.data for cube in box_meshes]))
 
 
 def display_meshes(meshes):
@@ -157,38 +225,31 @@ def display_meshes(meshes):
     # Show the plot to the screen
     pyplot.show()
 
-def vector_map_to_box_properties(vector_map: VectorMap) -> BoxProperties:
+def vector_map_to_box_properties(vector_map: typing.Union[VectorMap, VectorMapArrays]) -> BoxProperties:
     """ Convert the walls in 2D vector representation to 3D rectangular prisms """
-    box_centers = []
-    box_extents = []
-    box_rotations = []
-
-    for edge_id in vector_map.edges:
-        edge = vector_map.features[edge_id]
-        vertex_a = vector_map.features[edge.vertex_id_a]
-        vertex_b = vector_map.features[edge.vertex_id_b]
-
-        average = np.array([
-            (vertex_a.position.x + vertex_b.position.x)/2,
-            (vertex_a.position.y + vertex_b.position.y)/2,  
-            0,          
-        ])
-        box_centers.append(average)
-
-        length = euclidean_distance(vertex_a.position, vertex_b.position)
-        height = 1 # metre
-        thickness = 0.1 # metres
-        box_extents.append(np.array([length, thickness, height]))
-
-        zAngleRad = np.arctan2((vertex_b.position.y - vertex_a.position.y), (vertex_b.position.x - vertex_a.position.x))
-        cosTheta = np.cos(zAngleRad)
-        sinTheta = np.sin(zAngleRad)
-        rotMatrix = np.array([
-            [cosTheta, -sinTheta, 0],
-            [sinTheta, cosTheta, 0],
-            [0, 0, 1]
-        ])
-        box_rotations.append(rotMatrix)
+    arrays = vector_map if isinstance(vector_map, VectorMapArrays) else VectorMapArrays.from_vector_map(vector_map)
+    height = 1 # metre
+    thickness = 0.1 # metres
+
+    segments = arrays.segments()
+    vertex_a, vertex_b = segments[:, 0], segments[:, 1]
+    delta = vertex_b - vertex_a
+    length = np.linalg.norm(delta, axis=1)
+
+    # corners are closed by wall_box_vertices, which lengthens every wall by its thickness
+    average = (vertex_a + vertex_b)/2
+    box_centers = np.column_stack([average, np.zeros(len(segments))])
+    box_extents = np.column_stack([length, np.full(len(segments), thickness), np.full(len(segments), height)])
+
+    zAngleRad = np.arctan2(delta[:, 1], delta[:, 0])
+    cosTheta = np.cos(zAngleRad)
+    sinTheta = np.sin(zAngleRad)
+    box_rotations = np.zeros((len(segments), 3, 3))
+    box_rotations[:, 0, 0] = cosTheta
+    box_rotations[:, 0, 1] = -sinTheta
+    box_rotations[:, 1, 0] = sinTheta
+    box_rotations[:, 1, 1] = cosTheta
+    box_rotations[:, 2, 2] = 1
 
     return BoxProperties(box_centers, box_extents, box_rotations)
 
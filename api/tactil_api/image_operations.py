@@ -1,9 +1,12 @@
 import numpy as np
-from dataclasses import dataclass
-import open3d as o3d
+from dataclasses import asdict, dataclass
+import json
 import os
+import struct
+import threading
 import typing
 import uuid
+import zlib
 
 @dataclass
 class Dimensions:
@@ -16,23 +19,278 @@ class Coordinate:
     x: float
     y: float
 
+@dataclass
+class TilePyramidInfo:
+    """Class for storing the layout of a tile pyramid, in the XYZ (slippy map) scheme.
+    Zoom level z has 2^z by 2^z tiles numbered from the top left, and tile 0/0/0 is the
+    square of side extent whose top left corner is (min_x, max_y)."""
+    id: str
+    tile_size: int  # pixels
+    max_zoom: int
+    min_x: float
+    max_y: float
+    extent: float  # metres
+
+    def tile_window(self, z: int, x: int, y: int) -> typing.Tuple[float, float, float]:
+        """min_x, max_y and side length (metres) of a tile"""
+        side = self.extent / 2 ** z
+        return self.min_x + x * side, self.max_y - y * side, side
+
 @dataclass
 class ImageInfo:
     """Class for storing location, size and origin of image."""
     filename: str
     world_dimensions: Dimensions
     origin_camera: Coordinate
+    tiles: typing.Optional[TilePyramidInfo] = None  # for viewing large scans at full detail
+
+    @staticmethod
+    def from_dict(info: dict) -> "ImageInfo":
+        """Inverse of asdict"""
+        return ImageInfo(
+            info["filename"],
+            Dimensions(**info["world_dimensions"]),
+            Coordinate(**info["origin_camera"]),
+            TilePyramidInfo(**info["tiles"]) if info.get("tiles") is not None else None,
+        )
+
+@dataclass
+class TopDownRaster:
+    """Class for storing a top down orthographic image and where it lies in the world."""
+    image: np.ndarray  # rows x cols x 3, uint8. Row 0 is the largest y, column 0 the smallest x
+    pixel_size: float  # metres per pixel
+    min_x: float  # world x of the left edge of the image
+    max_y: float  # world y of the top edge of the image
+
+    def world_dimensions(self) -> Dimensions:
+        rows, cols = self.image.shape[0:2]
+        return Dimensions(cols * self.pixel_size, rows * self.pixel_size)
+
+    def origin_camera(self) -> Coordinate:
+        """World origin relative to the image centre, in the convention of the
+        editor (and of the camera frame previously used by save_image_visualizer)"""
+        dimensions = self.world_dimensions()
+        center_x = self.min_x + dimensions.width / 2
+        center_y = self.max_y - dimensions.height / 2
+        return Coordinate(-center_x, center_y)
+
+
+def point_colours(
+    point_count: int, colors: typing.Optional[np.ndarray] = None, normals: typing.Optional[np.ndarray] = None
+) -> np.ndarray:
+    """Nx3 colours in [0, 1] of a cloud of point_count points: its own, else its normals as Open3D shows them"""
+    if colors is not None:
+        return colors
+    if normals is not None:
+        return np.clip(normals * 0.5 + 0.5, 0, 1)
+    return np.zeros((point_count, 3))
+
+
+def rasterize_top_down(
+    points: np.ndarray,
+    colours: np.ndarray,
+    max_image_size: int = 2048,
+    min_pixel_size: float = 0.005,
+    margin: float = 0.05,
+    splat_radius: int = 1,
+) -> TopDownRaster:
+    """Renders the whole cloud looking straight down the z axis onto a white background
+    (see rasterize_window).
+    colours: Nx3 in [0, 1]
+    max_image_size: pixels along the longer side of the image
+    min_pixel_size: metres, limits the resolution for very small clouds
+    margin: fraction of the cloud's extent left empty around it"""
+    if len(points) == 0:
+        raise RuntimeError("No points to render")
+
+    # fit the cloud's xy bounds (plus margin) into the pixel grid
+    low, high = points[:, 0:2].min(axis=0), points[:, 0:2].max(axis=0)
+    pad = (high - low).max() * margin + min_pixel_size
+    low, high = low - pad, high + pad
+    pixel_size = max((high - low).max() / max_image_size, min_pixel_size)
+    cols, rows = np.ceil((high - low) / pixel_size).astype(int)
+
+    image = rasterize_window(points, to_uint8(colours), low[0], high[1], pixel_size, rows, cols, splat_radius)
+    return TopDownRaster(image, pixel_size, float(low[0]), float(high[1]))
+
+
+def rasterize_window(
+    points: np.ndarray,
+    colours: np.ndarray,
+    min_x: float,
+    max_y: float,
+    pixel_size: float,
+    rows: int,
+    cols: int,
+    splat_radius: int = 1,
+) -> np.ndarray:
+    """Renders the points in a window of the xy plane, whose top left corner is (min_x, max_y),
+    looking straight down the z axis onto a white background. Points outside the window are ignored.
+    Each point is splatted onto a square of (2 * splat_radius + 1) pixels a side, and where
+    points overlap the highest is drawn (a z-buffer).
+    colours: Nx3 uint8
+    :return: rows x cols x 3 uint8 image"""
+    image = np.full((rows * cols, 3), 255, dtype=np.uint8)
+    if len(points) == 0:
+        return image.reshape(rows, cols, 3)
+
+    col = np.floor((points[:, 0] - min_x) / pixel_size).astype(np.int64)
+    row = np.floor((max_y - points[:, 1]) / pixel_size).astype(np.int64)
+
+    # splat each point over its neighbouring pixels
+    offsets = np.arange(-splat_radius, splat_radius + 1)
+    d_row, d_col = [d.reshape(-1, 1) for d in np.meshgrid(offsets, offsets, indexing="ij")]
+    splat_row, splat_col = (row + d_row).ravel(), (col + d_col).ravel()
+    source = np.tile(np.arange(len(points)), len(d_row))
+    inside = (splat_row >= 0) & (splat_row < rows) & (splat_col >= 0) & (splat_col < cols)
+    pixel, source = (splat_row * cols + splat_col)[inside], source[inside]
+
+    # z-buffer: keep the highest point written to each pixel, by sorting on one
+    # int64 key that orders by pixel then height (unique, so the result is deterministic)
+    height_rank = np.empty(len(points), dtype=np.int64)
+    height_rank[np.argsort(points[:, 2])] = np.arange(len(points))
+    order = np.argsort(pixel * len(points) + height_rank[source])
+    pixel, source = pixel[order], source[order]
+    last_in_pixel = np.append(pixel[1:] != pixel[:-1], True)
+
+    image[pixel[last_in_pixel]] = colours[source[last_in_pixel]]
+    return image.reshape(rows, cols, 3)
+
+
+def to_uint8(colours: np.ndarray) -> np.ndarray:
+    return np.round(np.clip(colours, 0, 1) * 255).astype(np.uint8)
+
+
+def write_png(path: typing.Union[str, bytes, os.PathLike], image: np.ndarray, compression: int = 1):
+    """Writes an 8 bit RGB image (rows x cols x 3) as a PNG. Low zlib compression levels
+    are several times faster than the image libraries' defaults, for slightly larger files"""
+    def chunk(chunk_type: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(chunk_type + data))
+
+    rows, cols = image.shape[0:2]
+    # each scanline starts with its filter type, 0 (none)
+    scanlines = np.concatenate([np.zeros((rows, 1), dtype=np.uint8), image.reshape(rows, cols * 3)], axis=1)
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", cols, rows, 8, 2, 0, 0, 0)))  # 8 bit RGB
+        f.write(chunk(b"IDAT", zlib.compress(scanlines.tobytes(), compression)))
+        f.write(chunk(b"IEND", b""))
+
 
 # Save image to be viewed in the editor
 def save_image(
+    points: np.ndarray,
+    colours: np.ndarray,
+    image_dir: typing.Union[str, bytes, os.PathLike],
+    tiles: bool = True,
+    max_image_size: int = 2048,
+) -> ImageInfo:
+    """Renders the Nx3 points from above with rasterize_top_down, needing no display or GL context.
+    colours: Nx3 in [0, 1] (see point_colours)
+    tiles: also save the cloud as the source of a tile pyramid (see save_tile_source)
+    max_image_size: pixels, of the longest side of the image"""
+    # create output directory if it doesn't exist
+    if not os.path.exists(image_dir):
+        os.makedirs(image_dir, exist_ok=True)
+
+    raster = rasterize_top_down(points, colours, max_image_size)
+    image_id = str(uuid.uuid4())
+    image_filename = image_id + ".png"
+    tmp_path = os.path.join(image_dir, f".{image_id}.{os.getpid()}.tmp")
+    write_png(tmp_path, raster.image)
+    os.replace(tmp_path, os.path.join(image_dir, image_filename))
+    tile_info = save_tile_source(points, colours, image_dir, image_id) if tiles else None
+
+    return ImageInfo(image_filename, raster.world_dimensions(), raster.origin_camera(), tile_info)
+
+
+TILE_SIZE = 256  # pixels
+MAX_TILE_ZOOM = 16
+PYRAMID_FILENAME = "pyramid.json"
+
+
+class TileNotFoundError(Exception):
+    pass
+
+
+def save_tile_source(
+    points: np.ndarray,
+    colours: np.ndarray,
+    image_dir: typing.Union[str, bytes, os.PathLike],
+    pyramid_id: str,
+    min_pixel_size: float = 0.01,
+    margin: float = 0.05,
+) -> TilePyramidInfo:
+    """Saves the points and layout from which render_tile draws tiles on demand, in
+    image_dir/pyramid_id. Points are sorted by x so a tile's points are found by binary search.
+    min_pixel_size: metres per pixel at the deepest zoom level"""
+    low, high = points[:, 0:2].min(axis=0), points[:, 0:2].max(axis=0)
+    extent = (high - low).max() * (1 + 2 * margin) + 2 * min_pixel_size
+    max_zoom = int(np.clip(np.ceil(np.log2(extent / (TILE_SIZE * min_pixel_size))), 0, MAX_TILE_ZOOM))
+    center = (low + high) / 2
+    info = TilePyramidInfo(pyramid_id, TILE_SIZE, max_zoom, float(center[0] - extent / 2), float(center[1] + extent / 2), float(extent))
+
+    # written to a temporary directory and renamed, so render_tile never sees a partial source
+    pyramid_dir = os.path.join(image_dir, pyramid_id)
+    tmp_dir = pyramid_dir + ".tmp"
+    os.makedirs(tmp_dir, exist_ok=True)
+    order = np.argsort(points[:, 0], kind="stable")
+    np.save(os.path.join(tmp_dir, "points.npy"), points[order].astype(np.float32))
+    np.save(os.path.join(tmp_dir, "colours.npy"), to_uint8(colours[order]))
+    with open(os.path.join(tmp_dir, PYRAMID_FILENAME), "w") as f:
+        json.dump(asdict(info), f)
+    os.rename(tmp_dir, pyramid_dir)
+    return info
+
+
+def render_tile(image_dir: typing.Union[str, bytes, os.PathLike], pyramid_id: str, z: int, x: int, y: int) -> str:
+    """Path of the tile's PNG, rendering it first if this is the first request for it.
+    Raises TileNotFoundError for unknown pyramids or tiles outside the pyramid."""
+    try:
+        uuid.UUID(pyramid_id)  # only accept ids we could have generated
+        with open(os.path.join(image_dir, pyramid_id, PYRAMID_FILENAME)) as f:
+            info = TilePyramidInfo(**json.load(f))
+    except (ValueError, FileNotFoundError):
+        raise TileNotFoundError(f"Unknown tile pyramid {pyramid_id}")
+    if not (0 <= z <= info.max_zoom and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        raise TileNotFoundError(f"No tile {z}/{x}/{y} in pyramid {pyramid_id}")
+
+    tile_path = os.path.join(image_dir, pyramid_id, str(z), str(x), f"{y}.png")
+    if os.path.exists(tile_path):
+        return tile_path
+
+    min_x, max_y, side = info.tile_window(z, x, y)
+    pixel_size = side / info.tile_size
+    splat_margin = 2 * pixel_size  # points just outside the tile may be splatted into it
+    points = np.load(os.path.join(image_dir, pyramid_id, "points.npy"), mmap_mode="r")
+    colours = np.load(os.path.join(image_dir, pyramid_id, "colours.npy"), mmap_mode="r")
+    start, stop = np.searchsorted(points[:, 0], [min_x - splat_margin, min_x + side + splat_margin])
+    in_strip = np.asarray(points[start:stop])
+    in_tile = (in_strip[:, 1] <= max_y + splat_margin) & (in_strip[:, 1] >= max_y - side - splat_margin)
+    image = rasterize_window(
+        in_strip[in_tile], np.asarray(colours[start:stop])[in_tile], min_x, max_y, pixel_size, info.tile_size, info.tile_size
+    )
+
+    # concurrent requests for the same tile each write their own file, and the last rename wins
+    os.makedirs(os.path.dirname(tile_path), exist_ok=True)
+    tmp_path = tile_path + f".{os.getpid()}.{threading.get_ident()}.tmp"
+    write_png(tmp_path, image)
+    os.replace(tmp_path, tile_path)
+    return tile_path
+
+
+def save_image_visualizer(
     pcd, image_dir: typing.Union[str, bytes, os.PathLike]
 ) -> ImageInfo:
+    """Renders pcd with an Open3D Visualizer window. Needs a display (or EGL), and
+    raises RuntimeError when running headless. Superseded by save_image."""
     # create output directory if it doesn't exist
     if not os.path.exists(image_dir):
         os.makedirs(image_dir, exist_ok=True)
 
     image_filename = str(uuid.uuid4()) + ".png"
     image_path = os.path.join(image_dir, image_filename)
+    import open3d as o3d  # only this legacy renderer needs it, so the API starts without it
     vis = o3d.visualization.Visualizer()
     vis.create_window(visible=False)
     vis.add_geometry(pcd)
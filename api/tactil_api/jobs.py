@@ -0,0 +1,297 @@
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+import dataclasses
+import json
+import os
+import threading
+import traceback
+import typing
+import uuid
+
+from .cloud_reader import convert_to_binary_cloud
+from .parallel import process_context
+from .parameters import DEFAULT_PRESET, PROCESS_STAGES, merge_parameters, resolve_parameters
+from .profiler import StageProfiler
+from .result_cache import ResultCache
+from .stage_cache import StageCache
+
+# Job states
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETE = "complete"
+FAILED = "failed"
+
+# Stage states
+PENDING = "pending"
+DONE = "done"
+
+
+@dataclasses.dataclass
+class JobStatus:
+    """Class for storing the state of a background processing job."""
+    id: str
+    state: str
+    stages: typing.Dict[str, str]  # stage name -> pending, running or done
+    current_stage: typing.Optional[str] = None
+    result: typing.Optional[dict] = None
+    error: typing.Optional[str] = None
+    cloud_path: typing.Optional[str] = None
+    parameters: typing.Optional[dict] = None  # every stage's parameters, as a ProcessParameters dict
+
+
+def job_path(job_dir: typing.Union[str, os.PathLike], job_id: str) -> str:
+    return os.path.join(job_dir, job_id + ".json")
+
+
+def write_status(job_dir: typing.Union[str, os.PathLike], status: JobStatus):
+    """Writes the job status file atomically so that readers in other
+    processes never see a partially written file"""
+    path = job_path(job_dir, status.id)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(dataclasses.asdict(status), f)
+    os.replace(tmp_path, path)
+
+
+def read_status(job_dir: typing.Union[str, os.PathLike], job_id: str) -> typing.Optional[JobStatus]:
+    try:
+        with open(job_path(job_dir, job_id)) as f:
+            return JobStatus(**json.load(f))
+    except FileNotFoundError:
+        return None
+
+
+def run_process_job(
+    job_dir: typing.Union[str, os.PathLike],
+    job_id: str,
+    cloud_path: typing.Union[str, os.PathLike],
+    image_dir: typing.Union[str, os.PathLike],
+    parameters: typing.Optional[dict] = None,
+    result_cache: typing.Optional[ResultCache] = None,
+    pipeline_workers: int = 1,
+    profile_dir: typing.Optional[typing.Union[str, os.PathLike]] = None,
+    stage_cache: typing.Optional[StageCache] = None,
+):
+    """Runs process() inside a pool worker, recording progress in the job status file.
+    If result_cache holds a result for this cloud and parameters, process() is skipped.
+    parameters: ProcessParameters as a dict, overriding the defaults
+    pipeline_workers: processes used within process() for the per-cluster stages
+    profile_dir: if given, the stage timings are also written there as <job_id>.json
+    and a Chrome trace <job_id>.trace.json
+    stage_cache: intermediate outputs, so only the stages affected by changed parameters run"""
+    process_params = resolve_parameters(parameters)
+    params = dataclasses.asdict(process_params)
+    status = JobStatus(job_id, RUNNING, {stage: PENDING for stage in PROCESS_STAGES},
+                       cloud_path=str(cloud_path), parameters=params)
+
+    if result_cache is not None:
+        cache_key = result_cache.key(cloud_path, params)
+        cached_result = result_cache.get(cache_key, image_dir)
+        if cached_result is not None:
+            status.stages = {stage: DONE for stage in PROCESS_STAGES}
+            status.state = COMPLETE
+            status.result = {**cached_result, "profile": None}
+            write_status(job_dir, status)
+            return
+
+    def progress(stage: str):
+        if status.current_stage is not None:
+            status.stages[status.current_stage] = DONE
+        status.current_stage = stage
+        status.stages[stage] = RUNNING
+        write_status(job_dir, status)
+
+    from .process_cloud import process  # after the cache check, which needs none of the pipeline
+
+    profiler = StageProfiler(on_stage=progress)
+    try:
+        # parsed once into a binary cloud, if that was not already done (or started) after upload
+        progress("load")
+        convert_to_binary_cloud(cloud_path)
+        vector_map, image_info = process(
+            cloud_path, image_dir, process_params, visualise=False, profiler=profiler,
+            workers=pipeline_workers, stage_cache=stage_cache,
+        )
+    except Exception:
+        status.state = FAILED
+        status.error = traceback.format_exc()
+        write_status(job_dir, status)
+        raise
+
+    # stages merged into others (e.g. when streaming) are never reported, so mark all done
+    status.stages = {stage: DONE for stage in PROCESS_STAGES}
+    status.current_stage = None
+    status.state = COMPLETE
+    status.result = {
+        "message": "File successfully processed",
+        "initial_vector_map": dataclasses.asdict(vector_map),
+        "pcd_image_info": dataclasses.asdict(image_info) if image_info is not None else None,
+    }
+    if result_cache is not None:
+        result_cache.put(cache_key, status.result)
+    status.result["profile"] = profiler.report()
+    if profile_dir is not None:
+        os.makedirs(profile_dir, exist_ok=True)
+        profiler.write_json(os.path.join(profile_dir, job_id + ".json"))
+        profiler.write_chrome_trace(os.path.join(profile_dir, job_id + ".trace.json"))
+    write_status(job_dir, status)
+
+
+def warm_worker():
+    # the pipeline is already imported in workers forked from a preloaded fork server (see
+    # process_context), and imported now otherwise, rather than during the first job
+    from . import process_cloud  # noqa: F401
+
+
+class JobQueueFullError(Exception):
+    pass
+
+
+class JobQueue:
+    """Runs processing jobs in a bounded pool of worker processes.
+
+    max_workers limits how many clouds are processed at once (and therefore held
+    in memory together), and max_pending limits how many jobs may wait for a worker.
+    Job state is kept in files in job_dir so any server process can report on it."""
+
+    def __init__(
+        self,
+        job_dir: typing.Union[str, os.PathLike],
+        max_workers: int = 1,
+        max_pending: int = 16,
+        result_cache: typing.Optional[ResultCache] = None,
+        pipeline_workers: int = 1,
+        profile_dir: typing.Optional[typing.Union[str, os.PathLike]] = None,
+        stage_cache: typing.Optional[StageCache] = None,
+    ):
+        self.job_dir = job_dir
+        self.profile_dir = profile_dir
+        self.result_cache = result_cache
+        self.stage_cache = stage_cache
+        self.pipeline_workers = pipeline_workers
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._executor = None
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> concurrent.futures.ProcessPoolExecutor:
+        # created lazily (or by warm_up) so that importing this module does not start any processes
+        if self._executor is None:
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=process_context(),
+            )
+        return self._executor
+
+    def warm_up(self):
+        """Starts every worker in the background, so that the first jobs do not wait for
+        workers to start and import the pipeline"""
+        def start_workers():
+            with self._lock:
+                executor = self._get_executor()
+            # blocks until the workers have started (see process_context)
+            for _ in range(self.max_workers):
+                executor.submit(warm_worker)
+
+        threading.Thread(target=start_workers, name="worker-warm-up", daemon=True).start()
+
+    def _submit(self, fn: typing.Callable, *args) -> concurrent.futures.Future:
+        # called with the lock held
+        try:
+            return self._get_executor().submit(fn, *args)
+        except BrokenProcessPool:
+            # a worker died (e.g. killed when out of memory), start a fresh pool
+            self._executor = None
+            return self._get_executor().submit(fn, *args)
+
+    def submit_convert(self, cloud_path: typing.Union[str, os.PathLike]) -> concurrent.futures.Future:
+        """Converts an uploaded cloud into a binary cloud (see convert_to_binary_cloud) in a
+        worker, so that the upload need not wait for a large cloud to be parsed. Process jobs
+        of the cloud wait for the conversion to finish, or convert it themselves."""
+        with self._lock:
+            future = self._submit(convert_to_binary_cloud, cloud_path)
+
+        def report(f: concurrent.futures.Future):
+            if f.exception() is not None:
+                print(f"Converting {cloud_path} failed: {f.exception()!r}")
+
+        future.add_done_callback(report)
+        return future
+
+    def submit_process(
+        self,
+        cloud_path: typing.Union[str, os.PathLike],
+        image_dir: typing.Union[str, os.PathLike],
+        z_index: int = 2,
+        parameters: typing.Optional[dict] = None,
+        preset: str = DEFAULT_PRESET,
+    ) -> str:
+        """Queues a point cloud for processing and returns the new job's id.
+        parameters: stage -> {parameter: value} overrides of the preset's ProcessParameters,
+        taking precedence over z_index. Raises marshmallow.ValidationError if they are invalid."""
+        parameters = dataclasses.asdict(resolve_parameters({"load": {"z_index": z_index}}, parameters, preset=preset))
+        os.makedirs(self.job_dir, exist_ok=True)
+        job_id = uuid.uuid4().hex
+
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise JobQueueFullError(f"Too many jobs queued ({self._pending})")
+            write_status(self.job_dir, JobStatus(job_id, QUEUED, {stage: PENDING for stage in PROCESS_STAGES},
+                                                 cloud_path=str(cloud_path), parameters=parameters))
+            job_args = (
+                self.job_dir,
+                job_id,
+                cloud_path,
+                image_dir,
+                parameters,
+                self.result_cache,
+                self.pipeline_workers,
+                self.profile_dir,
+                self.stage_cache,
+            )
+            future = self._submit(run_process_job, *job_args)
+            self._pending += 1
+
+        future.add_done_callback(lambda f: self._on_done(job_id, f))
+        return job_id
+
+    def _on_done(self, job_id: str, future: concurrent.futures.Future):
+        with self._lock:
+            self._pending -= 1
+        error = future.exception()
+        if error is None:
+            return
+        status = self.status(job_id)
+        if status is not None and status.state != FAILED:
+            # worker exited without recording the failure itself
+            status.state = FAILED
+            status.error = repr(error)
+            write_status(self.job_dir, status)
+
+    def rerun(
+        self,
+        job_id: str,
+        image_dir: typing.Union[str, os.PathLike],
+        parameters: typing.Optional[dict] = None,
+        preset: typing.Optional[str] = None,
+    ) -> typing.Optional[str]:
+        """Queues the cloud of an earlier job again, with its parameters updated by parameters,
+        and returns the new job's id (or None if there is no such job). With a stage cache,
+        only the stages downstream of a changed parameter are run again.
+        preset: start from this preset instead of the earlier job's parameters (though
+        keeping its load parameters, which describe the scan)"""
+        status = self.status(job_id)
+        if status is None or status.cloud_path is None:
+            return None
+        if preset is None:
+            return self.submit_process(status.cloud_path, image_dir, parameters=merge_parameters(status.parameters, parameters))
+        return self.submit_process(status.cloud_path, image_dir, preset=preset,
+                                   parameters=merge_parameters({"load": status.parameters["load"]}, parameters))
+
+    def status(self, job_id: str) -> typing.Optional[JobStatus]:
+        try:
+            uuid.UUID(hex=job_id)  # only accept ids we could have generated
+        except ValueError:
+            return None
+        return read_status(self.job_dir, job_id)
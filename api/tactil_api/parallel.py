@@ -0,0 +1,59 @@
+import concurrent.futures
+import functools
+import multiprocessing
+import typing
+
+EXECUTOR_KINDS = ("process", "thread")
+
+# imported once by the fork server, so that the workers forked from it start with them loaded
+PRELOAD_MODULES = ["tactil_api.process_cloud"]
+
+# pools are kept for the life of the process so that workers (and their imports) are reused
+_executors: typing.Dict[typing.Tuple[str, int], concurrent.futures.Executor] = {}
+
+
+def process_context() -> multiprocessing.context.BaseContext:
+    """Start method for worker processes: forkserver where available, spawn otherwise.
+    Forking the app itself is unsafe once open3d/OpenMP have started threads, but the fork
+    server is a fresh single threaded process, which imports PRELOAD_MODULES (without running
+    anything) and then forks a worker for each request, with no import cost per worker."""
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(PRELOAD_MODULES)
+        return context
+    return multiprocessing.get_context("spawn")
+
+
+def get_executor(kind: str, workers: int) -> concurrent.futures.Executor:
+    key = (kind, workers)
+    if key not in _executors:
+        if kind == "process":
+            _executors[key] = concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=process_context())
+        elif kind == "thread":
+            _executors[key] = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        else:
+            raise ValueError(f"Unknown executor kind {kind}, expected one of {EXECUTOR_KINDS}")
+    return _executors[key]
+
+
+def parallel_map(
+    fn: typing.Callable,
+    *iterables: typing.Iterable,
+    workers: int = 1,
+    executor: str = "process",
+    **kwargs,
+) -> list:
+    """Like map(fn, *iterables), with kwargs passed to every call, run across a pool of
+    workers. Results are returned in input order regardless of which finishes first.
+    With workers <= 1 everything runs serially in the calling process.
+    executor: "process" (fn and its arguments must be picklable) or "thread" (only
+    useful when fn spends its time in native code that releases the GIL)"""
+    fn = functools.partial(fn, **kwargs)
+    arguments = list(zip(*iterables))
+    if workers <= 1 or len(arguments) <= 1:
+        return [fn(*args) for args in arguments]
+    if executor == "process" and multiprocessing.parent_process() is not None:
+        # already inside a pool worker (e.g. a JobQueue job): nested process pools
+        # are unreliable, and open3d releases the GIL, so use threads instead
+        executor = "thread"
+    return list(get_executor(executor, workers).map(fn, *zip(*arguments)))
@@ -0,0 +1,159 @@
+# Parameters of process(), kept apart from the pipeline itself so that the API can
+# validate them without importing open3d, scikit-learn and the rest of the pipeline.
+import typing
+from dataclasses import field
+
+from marshmallow import ValidationError
+from marshmallow.validate import OneOf, Range
+from marshmallow_dataclass import dataclass
+
+POSITIVE = Range(min=0, min_inclusive=False)
+
+# Stages of process(), in the order they run. When the cloud is streamed, load also
+# covers threshold and downsample. normals only does work for clouds without normals.
+# The "planes" wall engine runs clustering to box_fit, the "lines" engine runs line_fit
+# instead. snap joins up the walls of the resulting map.
+PROCESS_STAGES = [
+    "load", "threshold", "downsample", "normals", "wall_filter", "clustering", "partition", "plane_fit", "box_fit", "line_fit", "image",
+    "snap",
+]
+WALL_ENGINES = ["planes", "lines"]
+
+# Parameters of each stage, as the fields of ProcessParameters. A stage's cached output is
+# keyed by its parameters and the keys of its inputs (see stage_cache.stage_key), so changing a
+# parameter only invalidates that stage and the stages downstream of it.
+@dataclass
+class LoadParameters:
+    """Class for storing how the point cloud is read"""
+    z_index: int = field(default=2, metadata={"validate": OneOf([0, 1, 2])})  # axis pointing up in the scan
+    streaming: bool = True  # read in chunks where the format allows (see cloud_reader)
+
+@dataclass
+class ThresholdParameters:
+    threshold_height: float = 0.5  # metres, points at or above are removed (e.g. the roof)
+
+@dataclass
+class DownsampleParameters:
+    voxel_size: float = field(default=0.1, metadata={"validate": POSITIVE})  # metres
+    # the editor image is taken of the cloud downsampled to display_scale * voxel_size, from the same voxel grid
+    display_scale: int = field(default=1, metadata={"validate": Range(min=1)})
+
+@dataclass
+class NormalsParameters:
+    # of clouds without normals, estimated after downsampling (see pcd_operations.estimate_normals)
+    radius: float = field(default=0.3, metadata={"validate": POSITIVE})  # metres, neighbourhood a normal is fitted to
+    max_nn: int = field(default=30, metadata={"validate": Range(min=3)})  # nearest neighbours within radius used at most
+
+@dataclass
+class WallFilterParameters:
+    max_normal_z: float = field(default=0.2, metadata={"validate": Range(0, 1)})  # vertical component of a wall point's normal
+    epsilon: float = field(default=0.5, metadata={"validate": POSITIVE})  # metres, dbscan neighbourhood
+    min_points: int = field(default=20, metadata={"validate": Range(min=1)})  # dbscan core point neighbours
+    min_cluster_size: int = field(default=20, metadata={"validate": Range(min=0)})  # points, smaller clusters are removed
+
+@dataclass
+class WallsParameters:
+    # "planes": clusters wall points by normal and density, fits 3D planes and then boxes to them.
+    # "lines": extracts 2D line segments from the wall points seen from above (see process_cloud.fit_lines)
+    engine: typing.Literal["planes", "lines"] = "planes"
+    snap_tolerance: float = field(default=0.25, metadata={"validate": Range(min=0)})  # metres, 0 leaves walls unjoined (see VectorMap.snapped)
+    merge_angle: float = field(default=5.0, metadata={"validate": Range(0, 90)})  # degrees, walls meeting straighter than this are merged
+
+@dataclass
+class ClusteringParameters:
+    normal_clusterer: typing.Literal["meanshift", "histogram"] = "meanshift"  # see process_cloud.NORMAL_CLUSTERERS
+    bandwidth_quantile: float = field(default=0.05, metadata={"validate": Range(0, 1, min_inclusive=False)})  # meanshift only
+    sample_fraction: float = field(default=1.0, metadata={"validate": Range(0, 1, min_inclusive=False)})  # of normals meanshift is fitted to
+
+@dataclass
+class PartitionParameters:
+    epsilon: float = field(default=0.2, metadata={"validate": POSITIVE})  # metres, dbscan neighbourhood
+    min_points: int = field(default=10, metadata={"validate": Range(min=1)})  # dbscan core point neighbours
+
+@dataclass
+class PlaneFitParameters:
+    distance_threshold: float = field(default=0.05, metadata={"validate": POSITIVE})  # metres, RANSAC inlier distance
+    num_iterations: int = field(default=1000, metadata={"validate": Range(min=1)})  # RANSAC iterations per plane (at most, if adaptive)
+    verticality_epsilon: float = field(default=0.5, metadata={"validate": Range(0, 1)})  # vertical component of a wall plane's normal
+    min_plane_size: int = field(default=100, metadata={"validate": Range(min=3)})  # points
+    max_planes: int = field(default=15, metadata={"validate": Range(min=1)})  # RANSAC attempts per cluster
+    seed: int = 0  # cluster i seeds RANSAC with seed + i
+    method: typing.Literal["adaptive", "open3d"] = "adaptive"  # see process_cloud.segment_cluster_planes
+    confidence: float = field(default=0.99, metadata={"validate": Range(0, 1, min_inclusive=False, max_inclusive=False)})  # adaptive only
+
+@dataclass
+class BoxFitParameters:
+    pass
+
+@dataclass
+class LineFitParameters:
+    cell_size: float = field(default=0.05, metadata={"validate": POSITIVE})  # metres, occupancy grid the points are projected to
+    distance_threshold: float = field(default=0.05, metadata={"validate": POSITIVE})  # metres, line inlier distance and Hough offset step
+    min_line_cells: int = field(default=10, metadata={"validate": Range(min=2)})  # occupied cells
+    min_length: float = field(default=0.5, metadata={"validate": Range(min=0)})  # metres
+    max_gap: float = field(default=0.3, metadata={"validate": Range(min=0)})  # metres, wider gaps along a line split it
+    max_lines: int = field(default=100, metadata={"validate": Range(min=1)})
+    angle_steps: int = field(default=180, metadata={"validate": Range(min=1)})  # Hough line angles over 180 degrees
+
+@dataclass
+class ImageParameters:
+    max_image_size: int = field(default=2048, metadata={"validate": Range(min=1)})  # pixels, longest side of the editor image
+    tiles: bool = True  # also save a tile pyramid for viewing at full detail
+
+@dataclass
+class ProcessParameters:
+    """Class for storing the parameters of every stage of process()"""
+    load: LoadParameters = field(default_factory=LoadParameters)
+    threshold: ThresholdParameters = field(default_factory=ThresholdParameters)
+    downsample: DownsampleParameters = field(default_factory=DownsampleParameters)
+    normals: NormalsParameters = field(default_factory=NormalsParameters)
+    wall_filter: WallFilterParameters = field(default_factory=WallFilterParameters)
+    walls: WallsParameters = field(default_factory=WallsParameters)
+    clustering: ClusteringParameters = field(default_factory=ClusteringParameters)
+    partition: PartitionParameters = field(default_factory=PartitionParameters)
+    plane_fit: PlaneFitParameters = field(default_factory=PlaneFitParameters)
+    box_fit: BoxFitParameters = field(default_factory=BoxFitParameters)
+    line_fit: LineFitParameters = field(default_factory=LineFitParameters)
+    image: ImageParameters = field(default_factory=ImageParameters)
+
+
+# Named starting points trading accuracy for speed, as overrides of the defaults
+PRESETS = {
+    "fast": {
+        "downsample": {"voxel_size": 0.15},
+        "clustering": {"normal_clusterer": "histogram"},
+        # sizes scaled down for the coarser point spacing
+        "partition": {"epsilon": 0.3},
+        "plane_fit": {"num_iterations": 250, "max_planes": 10, "min_plane_size": 40},
+        "image": {"max_image_size": 1024},
+    },
+    "balanced": {},
+    "accurate": {
+        "downsample": {"voxel_size": 0.05},
+        "clustering": {"sample_fraction": 0.5},
+        "plane_fit": {"num_iterations": 4000, "max_planes": 30},
+        "image": {"max_image_size": 4096},
+    },
+}
+DEFAULT_PRESET = "balanced"
+
+
+def merge_parameters(*overrides: typing.Optional[dict]) -> dict:
+    """Merges dicts of stage -> {parameter: value}, later ones taking precedence"""
+    merged = {}
+    for override in overrides:
+        for stage, values in (override or {}).items():
+            if isinstance(values, dict) and isinstance(merged.get(stage), dict):
+                merged[stage].update(values)
+            else:
+                merged[stage] = dict(values) if isinstance(values, dict) else values  # the schema reports non-dicts
+    return merged
+
+
+def resolve_parameters(*overrides: typing.Optional[dict], preset: str = DEFAULT_PRESET) -> ProcessParameters:
+    """The preset's parameters updated with each of overrides in turn (see merge_parameters).
+    Raises marshmallow.ValidationError for unknown presets, stages or parameters, and for
+    invalid values."""
+    if preset not in PRESETS:
+        raise ValidationError({"preset": [f"Must be one of: {', '.join(PRESETS)}."]})
+    return ProcessParameters.Schema().load(merge_parameters(PRESETS[preset], *overrides))
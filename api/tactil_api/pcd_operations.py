@@ -1,9 +1,9 @@
 import numpy as np
 import open3d as o3d
-import matplotlib.pyplot as plt
 from .typings.o3d_geometry import PointCloud
 from .SuppressStream import SuppressStream
 import sys
+import typing
 
 # Max vertical threhold
 def vertical_threshold(pcd: PointCloud, threshold_height: float) -> PointCloud:
@@ -17,45 +17,71 @@ def vertical_threshold(pcd: PointCloud, threshold_height: float) -> PointCloud:
 # Filter out for only points that have close to horizontal normals
 def horizontal_normal_filter(pcd: PointCloud, epsilon: float) -> PointCloud:
     normals = np.asarray(pcd.normals)
-    vertical = np.array([0.0, 1.0, 0.0])
-    dot = np.array([np.dot(vertical, norm) for norm in normals])
-    horz_norms = np.arange(len(dot))[np.abs(dot) < epsilon]
+    # dot product with the vertical (y) axis is just the y component
+    horz_norms = np.flatnonzero(np.abs(normals[:, 1]) < epsilon)
     pcd = pcd.select_by_index(horz_norms)
     return pcd
 
 
+def estimate_normals(pcd: PointCloud, radius: float, max_nn: int) -> PointCloud:
+    """Estimates pcd's normals in place from its (at most max_nn) neighbours within radius, facing the centroid"""
+    pcd.estimate_normals(o3d.geometry.KDTreeSearchParamHybrid(radius=radius, max_nn=max_nn))
+    # facing the centroid orients all of a plane's normals alike, unless it passes through the centroid
+    normals = np.asarray(pcd.normals)
+    towards_centroid = pcd.get_center() - np.asarray(pcd.points)
+    flip = np.einsum("ij,ij->i", normals, towards_centroid) < 0
+    normals[flip] *= -1
+    pcd.normals = o3d.utility.Vector3dVector(normals)
+    return pcd
+
+
 # Cluster using dbscan
-def dbscan_cluster(pcd: PointCloud, epsilon: float, min_points: int) -> np.ndarray:
+def dbscan_cluster(pcd: PointCloud, epsilon: float, min_points: int, paint: bool = False) -> typing.Tuple[np.ndarray, int]:
+    """Labels (see dbscan_labels) and number of clusters of pcd's points.
+    paint: also colour pcd by cluster (see paint_by_labels), for visualising"""
+    labels = dbscan_labels(np.asarray(pcd.points), epsilon, min_points)
+    cluster_count = labels.max() + 1 if len(labels) else 0
+    if paint:
+        paint_by_labels(pcd, labels)
+    return labels, cluster_count
+
+
+# Colour each point according to its cluster label, with noise (-1) in black
+def paint_by_labels(pcd: PointCloud, labels: np.ndarray):
+    if len(labels) == 0:
+        return
+    max_label = labels.max()
+    from matplotlib import colormaps  # only to visualise, so the pipeline's workers need not load it
+
+    colors = colormaps["tab20"](labels / (max_label if max_label > 0 else 1))[:, :3]
+    colors[labels < 0] = 0
+    pcd.colors = o3d.utility.Vector3dVector(colors)
+
+
+def dbscan_labels(points: np.ndarray, epsilon: float, min_points: int) -> np.ndarray:
+    """Array version of dbscan_cluster, so it can run in a worker process.
+    For Nx3 points, returns N integer labels, with -1 representing noise points,
+    and positive ints and 0 indicating which cluster a point belongs to"""
+    pcd = o3d.geometry.PointCloud()
+    pcd.points = o3d.utility.Vector3dVector(points)
     with o3d.utility.VerbosityContextManager(o3d.utility.VerbosityLevel.Error) as cm:
         labels = np.array(
             pcd.cluster_dbscan(eps=epsilon, min_points=min_points, print_progress=False)
         )
-        # for an nx3 pcd, labels is nx1 integers, with -1 representing noise points,
-        # and positive ints and 0 indicating which cluster a point belongs to
-    max_label = labels.max()
-    cluster_count = max_label + 1
-    colors = plt.get_cmap("tab20")(labels / (max_label if max_label > 0 else 1))
-    colors[labels < 0] = 0
-    pcd.colors = o3d.utility.Vector3dVector(colors[:, :3])
-    return labels, cluster_count
+    return labels
+
+
+def large_cluster_indices(labels: np.ndarray, min_point_count: int) -> np.ndarray:
+    """Indices of the points in clusters of more than min_point_count points, noise (-1) excluded,
+    from one count of every label. labels is left unchanged."""
+    counts = np.bincount(labels + 1, minlength=1)  # noise counted first
+    counts[0] = 0
+    return np.flatnonzero(counts[labels + 1] > min_point_count)
 
 
 # Remove small clusters
 def remove_small_clusters(pcd: PointCloud, labels: np.ndarray, min_point_count: int) -> PointCloud:
-    noise_label = np.amax(labels) + 1
-    labels[labels == -1] = noise_label  # need all non-negative for bincount
-    count = np.bincount(labels)
-    large_cluster_labels = np.unique(labels)[count > min_point_count]
-    noise_points = np.argwhere(large_cluster_labels == noise_label)
-    large_cluster_labels = np.delete(
-        large_cluster_labels, noise_points
-    )  # remove noise points which might otherwise form a big cluster
-    is_large_cluster = np.in1d(labels, large_cluster_labels)
-    larger_cluster_indices = np.arange(np.asarray(pcd.points).shape[0])[
-        is_large_cluster
-    ]
-    pcd = pcd.select_by_index(larger_cluster_indices)
-    return pcd
+    return pcd.select_by_index(large_cluster_indices(labels, min_point_count))
 
 
 # Perform plane segmentation and get bounding boxes for vertical planes
@@ -66,16 +92,51 @@ def segment_planes(
     verticality_epsilon: float,
     min_plane_size: int,
     z_index: int, # 0, 1, or 2
+    seed: typing.Optional[int] = None,
+    max_planes: int = 15,
+):
+    segment_indices, segment_models, rest_indices = segment_plane_indices(
+        np.asarray(pcd.points),
+        distance_threshold,
+        num_iterations,
+        verticality_epsilon,
+        min_plane_size,
+        z_index,
+        seed,
+        max_planes,
+    )
+    segments = [pcd.select_by_index(indices) for indices in segment_indices]
+    rest = pcd.select_by_index(rest_indices)
+
+    return segments, segment_models, rest
+
+
+def segment_plane_indices(
+    points: np.ndarray,
+    distance_threshold: float,
+    num_iterations: int,
+    verticality_epsilon: float,
+    min_plane_size: int,
+    z_index: int, # 0, 1, or 2
+    seed: typing.Optional[int] = None,
+    max_planes: int = 15,
 ):
+    """Array version of segment_planes, so it can run in a worker process.
+    seed: if given, seeds Open3D's RANSAC so that the same planes are found every run
+    max_planes: number of RANSAC attempts, each finding at most one plane
+    :return: (inlier indices of each vertical plane, plane models, indices of the remaining points)"""
+    if seed is not None:
+        o3d.utility.random.seed(seed)
     segment_models = []
-    segments = []
-    rest = pcd
-    max_plane_idx = 15
+    segment_indices = []
+    remaining = np.arange(len(points))
 
-    for i in range(max_plane_idx):
+    for i in range(max_planes):
         try:
-            if len(np.asarray(rest.points)) < min_plane_size:
+            if len(remaining) < min_plane_size:
                 break
+            rest = o3d.geometry.PointCloud()
+            rest.points = o3d.utility.Vector3dVector(points[remaining])
             plane_model, inliers = rest.segment_plane(
                 distance_threshold=distance_threshold,
                 ransac_n=3,
@@ -88,22 +149,184 @@ def segment_planes(
             is_vertical = np.dot(vertical, normal) < verticality_epsilon
             if is_vertical:
                 segment_models.append(plane_model)
-                segment = rest.select_by_index(inliers)
-                # segment.paint_uniform_color(list(colours[:3]))
-                segments.append(segment)
-                rest = rest.select_by_index(inliers, invert=True)
+                segment_indices.append(remaining[inliers])
+                remaining = np.delete(remaining, inliers)
         except Exception as e:
             print(e)
 
-    return segments, segment_models, rest
+    return segment_indices, segment_models, remaining
+
+
+def segment_plane_indices_adaptive(
+    points: np.ndarray,
+    distance_threshold: float,
+    num_iterations: int,
+    verticality_epsilon: float,
+    min_plane_size: int,
+    z_index: int, # 0, 1, or 2
+    seed: typing.Optional[int] = None,
+    max_planes: int = 15,
+    confidence: float = 0.99,
+    batch_size: int = 32,
+):
+    """Drop in replacement for segment_plane_indices using adaptive RANSAC.
+    Each plane is searched for only until, given the best inlier ratio w so far, another
+    hypothesis is unlikely to do better: log(1 - confidence) / log(1 - w^3) hypotheses,
+    capped at num_iterations. Hypotheses are scored batch_size at a time with numpy.
+    Non-vertical planes are masked out rather than found again, and the search stops
+    once the best plane among the remaining points has fewer than min_plane_size inliers.
+    :return: (inlier indices of each vertical plane, plane models, indices of the remaining points)"""
+    rng = np.random.default_rng(seed)
+    vertical = np.zeros(3)
+    vertical[z_index] = 1.0
+    segment_models = []
+    segment_indices = []
+    searching = np.arange(len(points))  # not yet in a plane, vertical or not
+    rejected = []  # inliers of non-vertical planes
+
+    for _ in range(max_planes):
+        if len(searching) < max(min_plane_size, 3):
+            break
+        candidates = points[searching]
+        best_count, best_model = 0, None
+        required = num_iterations
+        tried = 0
+        while tried < min(required, num_iterations):
+            samples = candidates[rng.integers(0, len(candidates), size=(batch_size, 3))]
+            normals = np.cross(samples[:, 1] - samples[:, 0], samples[:, 2] - samples[:, 0])
+            lengths = np.linalg.norm(normals, axis=1)
+            valid = lengths > 1e-12  # degenerate (collinear or repeated) samples
+            normals = normals[valid] / lengths[valid].reshape(-1, 1)
+            offsets = -np.einsum("ij,ij->i", normals, samples[valid, 0])
+            tried += batch_size
+            if len(normals) == 0:
+                continue
+            counts = np.count_nonzero(np.abs(candidates @ normals.T + offsets) < distance_threshold, axis=0)
+            best = np.argmax(counts)
+            if counts[best] > best_count:
+                best_count, best_model = counts[best], np.append(normals[best], offsets[best])
+                inlier_ratio = best_count / len(candidates)
+                if inlier_ratio >= 1:
+                    required = 0
+                else:
+                    required = np.log(1 - confidence) / np.log(1 - inlier_ratio ** 3)
+        if best_model is None or best_count < min_plane_size:
+            break  # nothing left can form a plane
+
+        # refine the model by least squares on its inliers, then take the refined inliers
+        inliers = np.flatnonzero(np.abs(candidates @ best_model[0:3] + best_model[3]) < distance_threshold)
+        centroid = candidates[inliers].mean(axis=0)
+        normal = np.linalg.svd(candidates[inliers] - centroid, full_matrices=False)[2][2]
+        refined_inliers = np.flatnonzero(np.abs((candidates - centroid) @ normal) < distance_threshold)
+        if len(refined_inliers) >= len(inliers):
+            inliers = refined_inliers
+            best_model = np.append(normal, -normal @ centroid)
+
+        # filter for vertical planes (horizontal normals), either side up
+        if abs(np.dot(vertical, best_model[0:3])) < verticality_epsilon:
+            segment_models.append(best_model)
+            segment_indices.append(searching[inliers])
+        else:
+            rejected.append(searching[inliers])
+        searching = np.delete(searching, inliers)
+
+    remaining = np.sort(np.concatenate([searching, *rejected])) if rejected else searching
+    return segment_indices, segment_models, remaining
+
+
+def hough_line_segments(
+    points: np.ndarray,
+    cell_size: float,
+    distance_threshold: float,
+    min_line_cells: int,
+    min_length: float,
+    max_gap: float,
+    max_lines: int = 100,
+    angle_steps: int = 180,
+    chunk_size: int = 65536,
+):
+    """Wall line segments of a point cloud seen from above (x and y of points).
+    The points are projected once onto an occupancy grid of cell_size, and its occupied cells
+    vote in a Hough accumulator of angle_steps line angles by distance_threshold offsets.
+    Lines are taken from the highest peak down, each refined by least squares on the cells
+    within distance_threshold of it (weighted by their points, so a noisy wall's sparse outer
+    cells do not pull it off the wall), and the cells reaching within distance_threshold of
+    the refined line are taken as its inliers, whose votes are then removed. The
+    cells of a line are split where consecutive cells are more than max_gap apart, and runs
+    of fewer than min_line_cells cells or shorter than min_length are dropped. Stops after
+    max_lines lines or when no peak has min_line_cells votes.
+    :return: (Lx2x2 array of segment end points, angle of each segment's normal in [0, pi),
+    occupied cells of each segment)"""
+    cells, cell_points = np.unique(np.floor(points[:, :2] / cell_size).astype(np.int64), axis=0, return_counts=True)
+    if len(cells) == 0:
+        return np.empty((0, 2, 2)), np.empty(0), np.empty(0, dtype=int)
+    # centred, so line offsets range over +-rho_max
+    origin = (cells.min(axis=0) + cells.max(axis=0) + 1) * cell_size / 2
+    centers = (cells + 0.5) * cell_size - origin
+    angles = np.arange(angle_steps) * np.pi / angle_steps
+    normals = np.stack([np.cos(angles), np.sin(angles)])
+    rho_max = np.linalg.norm(centers, axis=1).max()
+    rho_bins = int(2 * rho_max / distance_threshold) + 2
+
+    def votes(indices):
+        rho = np.rint((centers[indices] @ normals + rho_max) / distance_threshold).astype(np.int64)
+        return np.bincount((rho + np.arange(angle_steps) * rho_bins).ravel(), minlength=angle_steps * rho_bins)
+
+    accumulator = np.zeros(angle_steps * rho_bins, dtype=np.int64)
+    for start in range(0, len(centers), chunk_size):
+        accumulator += votes(np.arange(start, min(start + chunk_size, len(centers))))
+
+    # cells reaching within distance_threshold of a line, as cell centres are up to half a
+    # cell diagonal from the points in them (a band of distance_threshold alone leaves a noisy
+    # wall's outer cell columns to become parallel lines)
+    band = distance_threshold + cell_size * np.sqrt(2) / 2
+    active = np.ones(len(centers), dtype=bool)
+    segments, segment_angles, segment_cells = [], [], []
+    for _ in range(max_lines):
+        peak = np.argmax(accumulator)
+        if accumulator[peak] < min_line_cells:
+            break  # nothing left can form a line
+        angle_index, rho_index = divmod(peak, rho_bins)
+        candidates = np.flatnonzero(active)
+        # includes every cell voting for the peak, as their offsets round to within half a bin of it
+        offsets = centers[candidates] @ normals[:, angle_index] - (rho_index * distance_threshold - rho_max)
+        inliers = candidates[np.abs(offsets) <= band]
+
+        # refine the line by least squares, then take the refined inliers
+        weights = cell_points[inliers].reshape(-1, 1)
+        centroid = (centers[inliers] * weights).sum(axis=0) / weights.sum()
+        direction = np.linalg.svd((centers[inliers] - centroid) * np.sqrt(weights), full_matrices=False)[2][0]
+        normal = np.array([-direction[1], direction[0]])
+        refined_inliers = candidates[np.abs((centers[candidates] - centroid) @ normal) <= band]
+        if len(refined_inliers) >= len(inliers):
+            inliers = refined_inliers
+        else:
+            direction = np.array([-normals[1, angle_index], normals[0, angle_index]])
+            normal = normals[:, angle_index]
+        active[inliers] = False
+        accumulator -= votes(inliers)
+
+        # split into runs of cells along the line
+        along = np.sort((centers[inliers] - centroid) @ direction)
+        for run in np.split(along, np.flatnonzero(np.diff(along) > max_gap) + 1):
+            # cell centres are half a cell in from the ends of the wall
+            start, end = run[0] - cell_size / 2, run[-1] + cell_size / 2
+            if len(run) < min_line_cells or end - start < min_length:
+                continue
+            segments.append([centroid + start * direction + origin, centroid + end * direction + origin])
+            segment_angles.append(np.arctan2(normal[1], normal[0]) % np.pi)
+            segment_cells.append(len(run))
+
+    return np.reshape(segments, (-1, 2, 2)), np.array(segment_angles), np.array(segment_cells, dtype=int)
 
 
 # Find and draw oriented bounding boxes
-def get_bounding_boxes(segments: list[PointCloud]):
+def get_bounding_boxes(segments: list[np.ndarray]):
+    """segments: Nx3 points of each segment, boxed without building a PointCloud of them"""
     line_sets = []
     boxes = []
     for i in range(len(segments)):
-        box = segments[i].get_oriented_bounding_box(robust=True)
+        box = o3d.geometry.OrientedBoundingBox.create_from_points(o3d.utility.Vector3dVector(segments[i]), robust=True)
         line_set = o3d.geometry.LineSet.create_from_oriented_bounding_box(box)
         colors = [[1, 0, 0] for _ in range(12)]
         line_set.colors = o3d.utility.Vector3dVector(colors)
@@ -117,15 +340,19 @@ def get_bounding_boxes(segments: list[PointCloud]):
 def separate_pcd_by_labels(pcd: PointCloud, labels: np.ndarray) -> list[PointCloud]:
     """pcd: open3d point cloud with N points
     labels: 1xN numpy array of non-negative integers serving as point labels"""
-    clusters = []
+    return [pcd.select_by_index(indices) for indices in partition_indices_by_labels(labels)]
 
-    for label in range(np.amax(labels) + 1):
-        current_cluster_mask = labels == label
-        current_cluster_indices = np.arange(np.asarray(pcd.points).shape[0])[
-            current_cluster_mask
-        ]
-        cluster = pcd.select_by_index(current_cluster_indices)
-        clusters.append(cluster)
 
-    return clusters
+def partition_indices_by_labels(labels: np.ndarray) -> list[np.ndarray]:
+    """Splits point indices by label in a single pass, rather than building a mask per label.
+    labels: 1xN numpy array of integer labels, where negative labels (noise) are discarded
+    :return: list where entry i holds the (ascending) indices of the points labelled i"""
+    labels = np.asarray(labels)
+    if len(labels) == 0 or np.amax(labels) < 0:
+        return []  # nothing but noise
+    counts = np.bincount(labels[labels >= 0], minlength=np.amax(labels) + 1)
+    # stable sort keeps indices within each label ascending; noise labels sort first
+    order = np.argsort(labels, kind="stable")
+    noise_count = len(labels) - np.sum(counts)
+    return np.split(order[noise_count:], np.cumsum(counts)[:-1])
 
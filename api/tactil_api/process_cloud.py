@@ -1,73 +1,310 @@
+import copy
+import dataclasses
+import json
 import numpy as np
 import open3d as o3d
 import sys
-import time
 from sklearn.cluster import MeanShift, estimate_bandwidth
-import matplotlib.pyplot as plt
 import typing
 import os
 from .VectorMap import VectorMap
 from .typings.o3d_geometry import PointCloud
 from .pcd_operations import (
-    dbscan_cluster,
-    remove_small_clusters,
+    dbscan_labels,
+    estimate_normals,
+    large_cluster_indices,
+    paint_by_labels,
     get_bounding_boxes,
-    segment_planes,
+    segment_plane_indices,
+    segment_plane_indices_adaptive,
+    hough_line_segments,
+    partition_indices_by_labels,
     separate_pcd_by_labels,
-    vertical_threshold,
 )
-from .image_operations import ImageInfo, save_image
+from .parallel import parallel_map
+from .image_operations import ImageInfo, point_colours, save_image
+from .cloud_reader import (CloudChunk, VoxelGridAccumulator, accumulate_cloud, fresh_binary_cloud, read_binary_cloud,
+                           supports_streaming)
 from scipy import stats
 from scipy.spatial.transform import Rotation as R
 import math
 from typing import Tuple
 from .SuppressStream import SuppressStream
+from .profiler import StageProfiler
+from .result_cache import cloud_digest, image_files_exist
+from .stage_cache import StageCache, StageOutput, stage_key
+from .parameters import ProcessParameters
+
+
+@dataclasses.dataclass
+class Stage:
+    """Class for storing a node of process()'s stage graph"""
+    inputs: list[str]  # stages whose outputs are passed to run, in order
+    parameter_groups: list[str]  # fields of ProcessParameters the output depends on
+    run: typing.Callable[..., StageOutput]  # run(parameters, *input outputs)
+    is_valid: typing.Optional[typing.Callable[[StageOutput], bool]] = None  # whether a cached output is still usable
 
 
 def process(
     pcd_path: typing.Union[str, bytes, os.PathLike],
     image_dir: typing.Union[str, bytes, os.PathLike],
-    z_index: int = 2,
+    parameters: typing.Optional[ProcessParameters] = None,
     visualise=False,
+    profiler: typing.Optional[StageProfiler] = None,
+    workers: int = 1,
+    executor: str = "process",
+    stage_cache: typing.Optional[StageCache] = None,
 ) -> Tuple[VectorMap, ImageInfo]:
-    # o3d.utility.set_verbosity_level(o3d.utility.VerbosityLevel.Error)
-    pcd = read_cloud(pcd_path, z_index)
+    """parameters: of every stage, the defaults if not given (see also resolve_parameters).
+    Streaming is always off when visualising.
+    profiler: records timings of each stage (see PROCESS_STAGES), and reports
+    progress through its on_stage callback
+    workers, executor: pool used for the per-cluster dbscan and plane fitting (see parallel_map)
+    stage_cache: if given, stages whose output is cached there (for the same cloud, parameters
+    and inputs) are loaded rather than run, and new outputs are added (always off when visualising)
+    """
+    if profiler is None:
+        profiler = StageProfiler()
+    parameters = copy.deepcopy(parameters) if parameters is not None else ProcessParameters()
+    parameters.load.streaming = parameters.load.streaming and not visualise and supports_streaming(pcd_path)
     if visualise:
-        print("Pre-vertical threshold.")
-        o3d.visualization.draw_geometries([pcd])
-    pcd = vertical_threshold(pcd, threshold_height=0.5)  # Remove roof
-    downsampled_for_display = create_display_pcd(pcd, visualise)
-    pcd = remove_nonwall_points(pcd, visualise)
-    unit_normals, labels = cluster_by_normal(pcd)
-    rotation_matrix = find_rot_to_primary_normal(unit_normals, labels)
-    pcd.rotate(rotation_matrix, center=(0, 0, 0))
-    print("Rotated to primary normal direction")
-    large_normal_clusters = partition_by_normal_and_density(pcd, labels, visualise)
-    centers, extents, rotations = fit_models(large_normal_clusters, visualise)
+        stage_cache = None
+
+    # o3d.utility.set_verbosity_level(o3d.utility.VerbosityLevel.Error)
+    engine = parameters.walls.engine
+    graph = stage_graph(pcd_path, image_dir, parameters.load.streaming, visualise, workers, executor, engine)
+    cloud_key = cloud_digest(pcd_path) if stage_cache is not None else None
+    walls = "box_fit" if engine == "planes" else "line_fit"
+    outputs = run_stages(graph, [walls, "image"], parameters, profiler, stage_cache, cloud_key)
+
     # convert to VectorMap representation
-    vector_map = VectorMap.from_boxes(centers, extents, rotations)
+    if engine == "planes":
+        boxes = outputs["box_fit"]
+        vector_map = VectorMap.from_boxes(boxes["centers"].tolist(), boxes["extents"].tolist(), boxes["rotations"].tolist())
+    else:
+        vector_map = VectorMap.from_segments(outputs["line_fit"]["segments"].tolist())
+    if parameters.walls.snap_tolerance > 0:
+        with profiler.stage("snap", points_in=len(vector_map.vertices)) as record:
+            vector_map = vector_map.snapped(parameters.walls.snap_tolerance, parameters.walls.merge_angle)
+            record.points_out = len(vector_map.vertices)
+    image_info = json.loads(str(outputs["image"]["image_info"]))
+    return vector_map, ImageInfo.from_dict(image_info) if image_info is not None else None
+
+
+def stage_graph(
+    pcd_path: typing.Union[str, bytes, os.PathLike],
+    image_dir: typing.Union[str, bytes, os.PathLike],
+    streaming: bool,
+    visualise: bool,
+    workers: int,
+    executor: str,
+    engine: str = "planes",
+) -> dict[str, Stage]:
+    """The stages of process(). Point clouds pass between stages as arrays (see cloud_to_arrays).
+    engine: of the walls (see WallsParameters), which decides the rotation the image is taken with"""
+
+    def load(p):
+        return cloud_to_arrays(read_cloud(pcd_path, p.load.z_index))
+
+    def load_streamed(p):
+        # load, threshold and downsample chunk by chunk, never holding the full cloud
+        accumulator = accumulate_cloud(pcd_path, p.load.z_index, p.threshold.threshold_height, p.downsample.voxel_size)
+        return downsampled_to_arrays(*downsample_cloud(accumulator, visualise, p.downsample.display_scale))
+
+    def threshold(p, cloud):
+        if visualise:
+            print("Pre-vertical threshold.")
+            o3d.visualization.draw_geometries([arrays_to_cloud(cloud)])
+        keep = cloud["points"][:, 2] < p.threshold.threshold_height  # Remove roof
+        return {name: values[keep] for name, values in cloud.items()}
+
+    def downsample(p, cloud):
+        if visualise:
+            print("Pre-downsampling")
+            o3d.visualization.draw_geometries([arrays_to_cloud(cloud)])
+        accumulator = VoxelGridAccumulator(p.downsample.voxel_size)
+        accumulator.add(CloudChunk(cloud["points"], cloud.get("normals"), cloud.get("colors")))
+        return downsampled_to_arrays(*downsample_cloud(accumulator, visualise, p.downsample.display_scale))
+
+    def normals(p, cloud):
+        if "normals" in cloud:
+            return cloud
+        pcd = estimate_normals(arrays_to_cloud({"points": cloud["points"]}), p.normals.radius, p.normals.max_nn)
+        return {**cloud, "normals": np.array(pcd.normals)}
+
+    def wall_filter(p, cloud):
+        keep = wall_point_indices(cloud["points"], cloud["normals"], visualise, **dataclasses.asdict(p.wall_filter))
+        # the display cloud of downsampled_to_arrays is left behind
+        return {name: cloud[name][keep] for name in ("points", "normals", "colors") if name in cloud}
+
+    def clustering(p, cloud):
+        if p.clustering.normal_clusterer == "meanshift":
+            unit_normals, labels = cluster_by_normal(
+                cloud["normals"], p.clustering.bandwidth_quantile, p.clustering.sample_fraction
+            )
+        else:
+            unit_normals, labels = NORMAL_CLUSTERERS[p.clustering.normal_clusterer](cloud["normals"])
+        rotation_matrix = find_rot_to_primary_normal(unit_normals, labels)
+        # rotated about the origin, as PointCloud.rotate(rotation_matrix, center=(0, 0, 0)) would
+        rotated = {name: cloud[name] @ rotation_matrix.T for name in ("points", "normals")}
+        return {**cloud, **rotated, "labels": labels, "rotation": rotation_matrix}
+
+    def partition(p, clustered):
+        clusters = partition_by_normal_and_density(
+            clustered["points"], clustered["labels"], visualise, workers, executor, **dataclasses.asdict(p.partition)
+        )
+        return gather_clouds(clustered["points"], clusters)
+
+    def plane_fit(p, clusters):
+        planes = fit_planes(
+            clusters["points"], clusters["lengths"], visualise, workers, executor, **dataclasses.asdict(p.plane_fit)
+        )
+        return gather_clouds(clusters["points"], planes)
+
+    def box_fit(p, planes):
+        centers, extents, rotations = fit_boxes(split_clouds(planes), visualise)
+        return {
+            "centers": np.reshape(centers, (-1, 3)),
+            "extents": np.reshape(extents, (-1, 3)),
+            "rotations": np.reshape(rotations, (-1, 3, 3)),
+        }
+
+    def line_fit(p, cloud):
+        segments, rotation_matrix = fit_lines(cloud["points"], visualise, **dataclasses.asdict(p.line_fit))
+        return {"segments": segments, "rotation": rotation_matrix}
+
+    def image(p, display, aligned):
+        # Take picture of rotated cloud for editor, aligned like the walls
+        cloud = display_arrays(display)
+        rotation_matrix = aligned["rotation"]
+        points = cloud["points"] @ rotation_matrix.T
+        normals = cloud["normals"] @ rotation_matrix.T if "normals" in cloud else None
+        colours = point_colours(len(points), cloud.get("colors"), normals)
+        try:
+            image_info = dataclasses.asdict(save_image(points, colours, image_dir, p.image.tiles, p.image.max_image_size))
+        except RuntimeError as e:
+            print(e)
+            image_info = None
+        return {"image_info": np.array(json.dumps(image_info))}
+
+    def image_exists(output):
+        image_info = json.loads(str(output["image_info"]))
+        return image_info is None or image_files_exist(image_info, image_dir)
+
+    if streaming:
+        graph = {"load": Stage([], ["load", "threshold", "downsample"], load_streamed)}
+        display = "load"
+    else:
+        graph = {
+            "load": Stage([], ["load"], load),
+            "threshold": Stage(["load"], ["threshold"], threshold),
+            "downsample": Stage(["threshold"], ["downsample"], downsample),
+        }
+        display = "downsample"
+    graph.update({
+        "normals": Stage([display], ["normals"], normals),
+        "wall_filter": Stage(["normals"], ["wall_filter"], wall_filter),
+        "clustering": Stage(["wall_filter"], ["clustering"], clustering),
+        "partition": Stage(["clustering"], ["partition"], partition),
+        "plane_fit": Stage(["partition"], ["plane_fit"], plane_fit),
+        "box_fit": Stage(["plane_fit"], ["box_fit"], box_fit),
+        "line_fit": Stage(["wall_filter"], ["line_fit"], line_fit),
+        "image": Stage([display, "clustering" if engine == "planes" else "line_fit"], ["image"], image, is_valid=image_exists),
+    })
+    return graph
+
+
+def run_stages(
+    graph: dict[str, Stage],
+    targets: list[str],
+    parameters: ProcessParameters,
+    profiler: StageProfiler,
+    stage_cache: typing.Optional[StageCache] = None,
+    cloud_key: typing.Optional[str] = None,
+) -> dict[str, StageOutput]:
+    """Outputs of the target stages, running each stage needed at most once.
+    With a stage_cache, a stage whose output is cached is loaded (and recorded as cached)
+    instead, and the stages upstream of it are not run at all.
+    cloud_key: identifies the point cloud, as the input of the stages without inputs"""
+    keys, outputs = {}, {}
+
+    def key(name: str) -> str:
+        if name not in keys:
+            stage = graph[name]
+            input_keys = [key(i) for i in stage.inputs] if stage.inputs else [cloud_key]
+            stage_parameters = {group: dataclasses.asdict(getattr(parameters, group)) for group in stage.parameter_groups}
+            keys[name] = stage_key(name, stage_parameters, input_keys)
+        return keys[name]
+
+    def output(name: str) -> StageOutput:
+        if name in outputs:
+            return outputs[name]
+        stage = graph[name]
+        if stage_cache is not None and stage_cache.contains(key(name)):
+            with profiler.stage(name) as record:
+                cached = stage_cache.get(key(name))
+                record.cached = cached is not None and (stage.is_valid is None or stage.is_valid(cached))
+                record.points_out = point_count(cached) if record.cached else None
+            if record.cached:
+                outputs[name] = cached
+                return cached
+
+        inputs = [output(i) for i in stage.inputs]
+        with profiler.stage(name, points_in=point_count(inputs[0]) if inputs else None) as record:
+            outputs[name] = stage.run(parameters, *inputs)
+            record.points_out = point_count(outputs[name])
+            if stage_cache is not None:
+                stage_cache.put(key(name), outputs[name])
+        return outputs[name]
+
+    return {name: output(name) for name in targets}
+
+
+def point_count(output: StageOutput) -> typing.Optional[int]:
+    return len(output["points"]) if "points" in output else None
+
+
+def cloud_to_arrays(pcd: PointCloud) -> StageOutput:
+    arrays = {"points": np.array(pcd.points)}
+    if pcd.has_normals():
+        arrays["normals"] = np.array(pcd.normals)
+    if pcd.has_colors():
+        arrays["colors"] = np.array(pcd.colors)
+    return arrays
+
+
+def arrays_to_cloud(arrays: StageOutput) -> PointCloud:
+    pcd = o3d.geometry.PointCloud()
+    pcd.points = o3d.utility.Vector3dVector(arrays["points"])
+    if "normals" in arrays:
+        pcd.normals = o3d.utility.Vector3dVector(arrays["normals"])
+    if "colors" in arrays:
+        pcd.colors = o3d.utility.Vector3dVector(arrays["colors"])
+    return pcd
+
 
-    # Take picture of rotated pcd for editor
-    downsampled_for_display.rotate(rotation_matrix, center=(0, 0, 0))
-    try:
-        image_info = save_image(downsampled_for_display, image_dir)
-    except RuntimeError as e:
-        print(e)
-        image_info = None
+def gather_clouds(points: np.ndarray, indices: list[np.ndarray]) -> StageOutput:
+    """The points of a list of clouds, each given by its indices into points, gathered
+    into one array with a single copy, with the length of each"""
+    return {
+        "points": points[np.concatenate(indices)] if indices else np.zeros((0, 3)),
+        "lengths": np.array([len(i) for i in indices], dtype=np.int64),
+    }
 
-    print("Initial processing complete.")
-    return vector_map, image_info
+
+def split_clouds(arrays: StageOutput) -> list[np.ndarray]:
+    """The points of each cloud of gather_clouds' arrays, as views of its points array"""
+    if len(arrays["lengths"]) == 0:
+        return []
+    return np.split(arrays["points"], np.cumsum(arrays["lengths"])[:-1])
 
 
 def read_cloud(
     pcd_path: typing.Union[str, bytes, os.PathLike], z_index: int = 2
 ) -> PointCloud:
-    # Load pcd
-    load_tic = time.perf_counter()
-    print("Loading pcd")
-    pcd = o3d.io.read_point_cloud(pcd_path)
-    load_toc = time.perf_counter()
-    print(f"Loaded pcd {pcd_path} in {load_toc-load_tic: 0.4f} seconds")
+    # Load pcd, from its binary cloud if there is an up to date one
+    binary_dir = fresh_binary_cloud(pcd_path)
+    pcd = read_binary_cloud(binary_dir) if binary_dir is not None else o3d.io.read_point_cloud(pcd_path)
 
     # Switch vertical axis if specified
     if z_index != 2:
@@ -81,84 +318,173 @@ def read_cloud(
     return pcd
 
 
-def create_display_pcd(pcd: PointCloud, visualise: bool) -> PointCloud:
-    if visualise:
-        print("Pre-downsampling")
-        o3d.visualization.draw_geometries([pcd])
-
-    # Display downsampled pcd with roof removed
-    downsampled_for_display = pcd.voxel_down_sample(voxel_size=0.1)
-    # Create coordinate frame for visualisation
-    origin_frame = o3d.geometry.TriangleMesh.create_coordinate_frame(
-        size=0.6, origin=[0, 0, 0]
-    )
+def downsample_cloud(
+    accumulator: VoxelGridAccumulator, visualise: bool, display_scale: int = 1
+) -> Tuple[PointCloud, PointCloud]:
+    """The cloud walls are found in, downsampled to the accumulator's voxel size, and the cloud shown in
+    the editor image, downsampled to display_scale times that by merging the same voxels (the same cloud
+    if display_scale is 1), so the points are only hashed into voxels once"""
+    pcd = accumulator.to_point_cloud()
+    display = pcd if display_scale == 1 else accumulator.to_point_cloud(display_scale)
     if visualise:
         print("Post-downsampling")
-        o3d.visualization.draw_geometries([downsampled_for_display, origin_frame])
+        # Create coordinate frame for visualisation
+        origin_frame = o3d.geometry.TriangleMesh.create_coordinate_frame(
+            size=0.6, origin=[0, 0, 0]
+        )
+        o3d.visualization.draw_geometries([display, origin_frame])
+
+    return pcd, display
+
 
-    return downsampled_for_display
+def downsampled_to_arrays(pcd: PointCloud, display: PointCloud) -> StageOutput:
+    """The arrays of pcd, with those of display prefixed by display_ if it is another cloud"""
+    arrays = cloud_to_arrays(pcd)
+    if display is not pcd:
+        arrays.update({"display_" + name: values for name, values in cloud_to_arrays(display).items()})
+    return arrays
 
 
-def remove_nonwall_points(pcd: PointCloud, visualise: bool) -> PointCloud:
+def display_arrays(arrays: StageOutput) -> StageOutput:
+    """The points, normals and colours of the cloud shown in the editor image, of the arrays
+    of downsampled_to_arrays"""
+    if "display_points" not in arrays:
+        return {name: arrays[name] for name in ("points", "normals", "colors") if name in arrays}
+    return {name: arrays["display_" + name] for name in ("points", "normals", "colors") if "display_" + name in arrays}
+
+
+def remove_nonwall_points(
+    pcd: PointCloud,
+    visualise: bool,
+    voxel_size: typing.Optional[float] = None,
+    max_normal_z: float = 0.2,
+    epsilon: float = 0.5,
+    min_points: int = 20,
+    min_cluster_size: int = 20,
+) -> PointCloud:
+    """voxel_size: to downsample pcd to first, None if it has already been downsampled (see downsample_cloud)
+    See wall_point_indices for the other parameters"""
     # Downsample pcd
-    pcd = pcd.voxel_down_sample(voxel_size=0.1)
-    print(f"Downsampled pcd. New length: {np.asarray(pcd.points).shape[0]}")
+    if voxel_size is not None:
+        pcd = pcd.voxel_down_sample(voxel_size=voxel_size)
 
-    # Filter out for only points that have close to horizontal normals
-    normals = np.asarray(pcd.normals)
-    vertical = np.array([0.0, 0.0, 0.0])
-    vertical[2] = 1.0
-    dot = np.array([np.dot(vertical, norm) for norm in normals])
-    horz_norms = np.arange(len(dot))[np.abs(dot) < 0.2]
-    pcd = pcd.select_by_index(horz_norms)
-    print(
-        f"Filtered for horizontal normals, new length: {np.asarray(pcd.points).shape[0]}"
+    wall_indices = wall_point_indices(
+        np.asarray(pcd.points), np.asarray(pcd.normals), visualise, max_normal_z, epsilon, min_points, min_cluster_size
     )
+    return pcd.select_by_index(wall_indices)
+
+
+def wall_point_indices(
+    points: np.ndarray,
+    normals: np.ndarray,
+    visualise: bool,
+    max_normal_z: float = 0.2,
+    epsilon: float = 0.5,
+    min_points: int = 20,
+    min_cluster_size: int = 20,
+) -> np.ndarray:
+    """Indices of the wall points among Nx3 points and their normals, selecting on the arrays
+    without building a PointCloud for each step (except to visualise them)
+    max_normal_z: points whose normal has a larger vertical component are not wall points
+    epsilon, min_points: dbscan parameters, clusters of min_cluster_size points or fewer are removed"""
+    # Filter out for only points that have close to horizontal normals
+    # dot product with the vertical (z) axis is just the z component
+    horz_norms = np.flatnonzero(np.abs(normals[:, 2]) < max_normal_z)
     if visualise:
-        o3d.visualization.draw_geometries([pcd])
+        horz_pcd = arrays_to_cloud({"points": points[horz_norms]})
+        o3d.visualization.draw_geometries([horz_pcd])
 
     # Perform dbscan clustering and remove small clusters
-    min_cluster_size = 20  # points
-    rem_small_tic = time.perf_counter()
-    labels, _ = dbscan_cluster(pcd, epsilon=0.5, min_points=20)
-    rem_small_toc = time.perf_counter()
-    print(f"Performed clustering in {rem_small_toc-rem_small_tic: 0.4f} seconds")
-    if visualise:
-        o3d.visualization.draw_geometries([pcd])
-    pcd = remove_small_clusters(pcd, labels, min_point_count=min_cluster_size)
-    print(f"Removed clusters smaller than {min_cluster_size} points")
+    labels = dbscan_labels(points[horz_norms], epsilon=epsilon, min_points=min_points)
+    large = large_cluster_indices(labels, min_point_count=min_cluster_size)
     if visualise:
-        o3d.visualization.draw_geometries([pcd])
+        paint_by_labels(horz_pcd, labels)
+        o3d.visualization.draw_geometries([horz_pcd])
+        o3d.visualization.draw_geometries([horz_pcd.select_by_index(large)])
 
-    return pcd
+    return horz_norms[large]
 
 
-def cluster_by_normal(pcd: PointCloud) -> Tuple[np.ndarray, np.ndarray]:
+def cluster_by_normal(
+    normals: np.ndarray, bandwidth_quantile: float = 0.05, sample_fraction: float = 1.0
+) -> Tuple[np.ndarray, np.ndarray]:
+    """normals: Nx3, of the points to cluster
+    sample_fraction: MeanShift is fitted to an evenly strided sample of this fraction
+    of the normals, and every normal is then labelled with its nearest cluster centre"""
     # Compute unit normal vectors
-    normals = np.asarray(pcd.normals)
-    step = 1
-    normals = normals[::step, :]
     magnitudes = np.linalg.norm(normals, axis=1)
     magnitudes[magnitudes == 0] = 1e-6  # set 0 magnitude to very small value
     unit_normals = normals / magnitudes.reshape(-1, 1)
+    step = max(1, int(round(1 / sample_fraction)))
+    sample = unit_normals[::step, :]
 
     # Compute clustering with MeanShift after estimating bandwidth
-    bw_tic = time.perf_counter()
-    bandwidth = estimate_bandwidth(unit_normals, quantile=0.05)
-    bw_toc = time.perf_counter()
-    print(f"Estimated bandwidth as {bandwidth} in {bw_toc-bw_tic: 0.4f} seconds")
-    ms_tic = time.perf_counter()
+    bandwidth = estimate_bandwidth(sample, quantile=bandwidth_quantile)
     ms = MeanShift(bandwidth=bandwidth, bin_seeding=True)
-    ms.fit(unit_normals)
-    ms_toc = time.perf_counter()
-    labels = ms.labels_
-    print(
-        f"Meanshift normal clustering: found clusters in {ms_toc-ms_tic: 0.4f} seconds"
-    )
+    ms.fit(sample)
+    labels = ms.labels_ if step == 1 else ms.predict(unit_normals)
 
     return unit_normals, labels
 
 
+def cluster_by_normal_histogram(
+    normals: np.ndarray,
+    bin_degrees: float = 1.0,
+    min_peak_fraction: float = 0.01,
+    peak_separation_degrees: float = 20.0,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Clusters (near horizontal) normals by their azimuth angle, as a fast alternative to
+    cluster_by_normal. Peaks of a circularly smoothed azimuth histogram become the cluster
+    centres, and every point is labelled with its nearest peak.
+    Labels are ordered by cluster size, largest first, as MeanShift orders them."""
+    magnitudes = np.linalg.norm(normals, axis=1)
+    magnitudes[magnitudes == 0] = 1e-6  # set 0 magnitude to very small value
+    unit_normals = normals / magnitudes.reshape(-1, 1)
+    if len(unit_normals) == 0:
+        return unit_normals, np.zeros(0, dtype=int)
+
+    # Histogram of azimuth angles, smoothed with a wrapped [1, 2, 1] kernel
+    azimuth = np.arctan2(unit_normals[:, 1], unit_normals[:, 0])
+    bin_count = int(round(360 / bin_degrees))
+    bins = ((azimuth + np.pi) / (2 * np.pi) * bin_count).astype(int) % bin_count
+    hist = np.bincount(bins, minlength=bin_count).astype(float)
+    smoothed = 2 * hist + np.roll(hist, 1) + np.roll(hist, -1)
+
+    # Local maxima with enough support, strongest first, suppressing nearby weaker peaks
+    is_peak = (smoothed >= np.roll(smoothed, 1)) & (smoothed > np.roll(smoothed, -1))
+    is_peak &= smoothed >= min_peak_fraction * 4 * len(unit_normals)
+    candidates = np.flatnonzero(is_peak)
+    candidates = candidates[np.argsort(-smoothed[candidates], kind="stable")]
+    separation_bins = peak_separation_degrees / bin_degrees
+    peaks = []
+    for candidate in candidates:
+        bin_distances = [min(abs(candidate - p), bin_count - abs(candidate - p)) for p in peaks]
+        if all(d >= separation_bins for d in bin_distances):
+            peaks.append(candidate)
+    if len(peaks) == 0:
+        peaks = [int(np.argmax(smoothed))]
+    peak_angles = (np.array(peaks) + 0.5) / bin_count * 2 * np.pi - np.pi
+
+    # Label each point with its nearest peak (circular distance)
+    difference = np.abs(azimuth.reshape(-1, 1) - peak_angles.reshape(1, -1))
+    difference = np.minimum(difference, 2 * np.pi - difference)
+    labels = np.argmin(difference, axis=1)
+
+    # Relabel so that label 0 is the largest cluster
+    order = np.argsort(-np.bincount(labels, minlength=len(peaks)), kind="stable")
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    labels = rank[labels]
+
+    return unit_normals, labels
+
+
+NORMAL_CLUSTERERS = {
+    "meanshift": cluster_by_normal,
+    "histogram": cluster_by_normal_histogram,
+}
+
+
 def find_rot_to_primary_normal(unit_normals: np.ndarray, labels: np.ndarray):
     # Rotate pcd to align with primary direction
     most_common_label = stats.mode(labels).mode
@@ -172,107 +498,171 @@ def find_rot_to_primary_normal(unit_normals: np.ndarray, labels: np.ndarray):
     return rotation_matrix
 
 
-def partition_by_normal_and_density(pcd: PointCloud, labels, visualise: bool) -> list[PointCloud]:
-    """Divides the pcd into a list of sub-clouds according to the normal direction clustering,
-    and by then using dbscan"""
-    # Separate pcd based on normal direction
-    normal_clusters = []
-    labels_unique = np.unique(labels)
-    for i in range(len(labels_unique)):
-        current_cluster_mask = labels == i
-        point_count = len(np.asarray(pcd.points))
-        current_cluster_indices = np.arange(point_count)[current_cluster_mask]
-        cluster = pcd.select_by_index(current_cluster_indices)
-        normal_clusters.append(cluster)
+def partition_by_normal_and_density(
+    points: np.ndarray,
+    labels,
+    visualise: bool,
+    workers: int = 1,
+    executor: str = "process",
+    epsilon: float = 0.2,
+    min_points: int = 10,
+) -> list[np.ndarray]:
+    """Divides the Nx3 points into clusters according to the normal direction clustering,
+    and by then using dbscan (with epsilon and min_points). Each normal cluster is clustered
+    independently, spread over workers (see parallel_map)
+    :return: the (ascending) indices into points of each cluster"""
+    # Separate points based on normal direction
+    normal_clusters = partition_indices_by_labels(labels)
 
     if visualise:
-        o3d.visualization.draw_geometries(normal_clusters)
-
-    # Separate pcds further using dbscan clustering
+        normal_clouds = [arrays_to_cloud({"points": points[indices]}) for indices in normal_clusters]
+        o3d.visualization.draw_geometries(normal_clouds)
+
+    # Separate clusters further using dbscan clustering, one task per normal cluster
+    density_labels = parallel_map(
+        dbscan_labels,
+        [points[indices] for indices in normal_clusters],
+        workers=workers,
+        executor=executor,
+        epsilon=epsilon,
+        min_points=min_points,
+    )
     large_normal_clusters = []
-    print("Cluster count: [", end='')
-    for norm_clust in normal_clusters:
-        labels, cluster_count = dbscan_cluster(norm_clust, epsilon=0.2, min_points=10)
-        print(f"{cluster_count}, ", end='')
-        separated_clusters = separate_pcd_by_labels(norm_clust, labels)
-        # remove last label which are "noise" points
-        large_normal_clusters += separated_clusters[:-1]
-    print("]")
-
-    # Paint point cloud according to cluster
-    def paint_pcd_list(pcd_list):
-        for i in range(len(pcd_list)):
-            colour = plt.get_cmap("tab20")(i)
-            pcd_list[i].paint_uniform_color(list(colour[:3]))
-
-    paint_pcd_list(normal_clusters)
+    for indices, labels in zip(normal_clusters, density_labels):
+        # noise points (label -1) are left out by partition_indices_by_labels
+        large_normal_clusters += [indices[cluster] for cluster in partition_indices_by_labels(labels)]
+
     if visualise:
-        o3d.visualization.draw_geometries(large_normal_clusters)
+        # Paint point cloud according to cluster
+        cluster_clouds = []
+        for normal_cloud, labels in zip(normal_clouds, density_labels):
+            paint_by_labels(normal_cloud, labels)
+            cluster_clouds += separate_pcd_by_labels(normal_cloud, labels)
+        o3d.visualization.draw_geometries(cluster_clouds)
 
     return large_normal_clusters
 
 
+def segment_cluster_planes(
+    points: np.ndarray,
+    seed: int,
+    distance_threshold: float = 0.05,
+    num_iterations: int = 1000,
+    verticality_epsilon: float = 0.5,
+    min_plane_size: int = 100,
+    max_planes: int = 15,
+    method: str = "adaptive",
+    confidence: float = 0.99,
+) -> Tuple[list[np.ndarray], list[np.ndarray], np.ndarray]:
+    """Plane segmentation of a single cluster, run as one task of fit_planes
+    method: "adaptive" (segment_plane_indices_adaptive, stopping each plane's search at
+    confidence) or "open3d" (segment_plane_indices, num_iterations for every plane)"""
+    if method == "open3d":
+        return segment_plane_indices(
+            points,
+            distance_threshold=distance_threshold,
+            num_iterations=num_iterations,
+            verticality_epsilon=verticality_epsilon,
+            min_plane_size=min_plane_size,
+            z_index=2,
+            seed=seed,
+            max_planes=max_planes,
+        )
+    return segment_plane_indices_adaptive(
+        points,
+        distance_threshold=distance_threshold,
+        num_iterations=num_iterations,
+        verticality_epsilon=verticality_epsilon,
+        min_plane_size=min_plane_size,
+        z_index=2,
+        seed=seed,
+        max_planes=max_planes,
+        confidence=confidence,
+    )
+
+
 def fit_models(
-    large_normal_clusters: list[PointCloud], visualise: bool
+    points: np.ndarray,
+    lengths: np.ndarray,
+    visualise: bool,
+    workers: int = 1,
+    executor: str = "process",
+    seed: int = 0,
 ) -> Tuple[list[np.ndarray], list[np.ndarray], list[np.ndarray]]:
+    """fit_planes followed by fit_boxes"""
+    planes = fit_planes(points, lengths, visualise, workers, executor, seed)
+    return fit_boxes([points[indices] for indices in planes], visualise)
+
+
+def fit_planes(
+    points: np.ndarray,
+    lengths: np.ndarray,
+    visualise: bool,
+    workers: int = 1,
+    executor: str = "process",
+    seed: int = 0,
+    **ransac_parameters,
+) -> list[np.ndarray]:
+    """Clusters are segmented independently, spread over workers (see parallel_map).
+    Cluster i seeds RANSAC with seed + i, so the result does not depend on scheduling
+    (for the "open3d" method with threads, Open3D's generator is shared, so use processes
+    for repeatable output)
+    points: the clusters' points, concatenated, lengths: the number of points of each
+    ransac_parameters: passed to segment_cluster_planes
+    :return: the (ascending) indices into points of each plane"""
+    clusters = split_clouds({"points": points, "lengths": lengths})
+    offsets = np.cumsum(lengths) - lengths
+
     # segment planes
     planes = []
-    plane_models = []
-    remaining_points = []
     with SuppressStream(sys.stderr):
-        for norm_clust in large_normal_clusters:
-            segments, segment_models, rest = segment_planes(
-                norm_clust,
-                distance_threshold=0.05,
-                num_iterations=1000,
-                verticality_epsilon=0.5,
-                min_plane_size=100,
-                z_index=2,
-            )
-
-            planes += segments
-            plane_models += segment_models
-            remaining_points.append(rest)
-
-        line_sets, _ = get_bounding_boxes(planes)
-
-        # o3d.visualization.draw_geometries(line_sets + planes)
-        # o3d.visualization.draw_geometries(normal_clusters + line_sets + planes + remaining_points)
+        plane_indices = parallel_map(
+            segment_cluster_planes,
+            clusters,
+            range(seed, seed + len(clusters)),
+            workers=workers,
+            executor=executor,
+            **ransac_parameters,
+        )
+    for offset, (segment_indices, _, _) in zip(offsets, plane_indices):
+        planes += [offset + np.sort(indices) for indices in segment_indices]
 
-        # Flatten into 2D
-        def flatten(pcd):
-            points = np.asarray(pcd.points)
-            points[:, 2] = 0.0  # flatten in z direction
-            pcd.points = o3d.utility.Vector3dVector(points)
+    # o3d.visualization.draw_geometries(get_bounding_boxes([points[i] for i in planes])[0])
+    return planes
 
-        for cloud in planes:
-            flatten(cloud)
 
-        line_sets, boxes = get_bounding_boxes(planes)
+def fit_boxes(
+    planes: list[np.ndarray], visualise: bool
+) -> Tuple[list[np.ndarray], list[np.ndarray], list[np.ndarray]]:
+    """Flattens each plane (Nx3 points) into 2D and fits an oriented bounding box to it"""
+    # Flatten into 2D, in z direction
+    flat_planes = [np.column_stack([points[:, 0:2], np.zeros(len(points))]) for points in planes]
+    with SuppressStream(sys.stderr):
+        line_sets, boxes = get_bounding_boxes(flat_planes)
 
-    # Create coordinate frame for visualisation
-    origin_frame = o3d.geometry.TriangleMesh.create_coordinate_frame(
-        size=0.6, origin=[0, 0, 0]
-    )
     if visualise:
-        o3d.visualization.draw_geometries(planes + line_sets + [origin_frame])
-
-    # Display frame markers for each box
-    frame_markers = []
-    for box in boxes:
-        center = box.get_center()
-        rotation = box.R
-
-        mesh = (
-            o3d.geometry.TriangleMesh.create_coordinate_frame()
-            .rotate(rotation)
-            .translate(center)
+        # Create coordinate frame for visualisation
+        origin_frame = o3d.geometry.TriangleMesh.create_coordinate_frame(
+            size=0.6, origin=[0, 0, 0]
         )
-        frame_markers.append(mesh)
+        plane_clouds = [arrays_to_cloud({"points": points}) for points in flat_planes]
+        o3d.visualization.draw_geometries(plane_clouds + line_sets + [origin_frame])
+
+        # Display frame markers for each box
+        frame_markers = []
+        for box in boxes:
+            center = box.get_center()
+            rotation = box.R
+
+            mesh = (
+                o3d.geometry.TriangleMesh.create_coordinate_frame()
+                .rotate(rotation)
+                .translate(center)
+            )
+            frame_markers.append(mesh)
 
-    if visualise:
         o3d.visualization.draw_geometries(
-            planes + line_sets + [origin_frame] + frame_markers
+            plane_clouds + line_sets + [origin_frame] + frame_markers
         )
 
     centers = [box.get_center().tolist() for box in boxes]
@@ -281,6 +671,36 @@ def fit_models(
 
     return centers, extents, rotations
 
+def fit_lines(points: np.ndarray, visualise: bool, **hough_parameters) -> Tuple[np.ndarray, np.ndarray]:
+    """Wall line segments of the Nx3 points seen from above (see hough_line_segments), rotated
+    about the origin so the primary wall direction (that with the most wall cells) lies along x,
+    as find_rot_to_primary_normal does for the "planes" engine.
+    :return: (Lx2x2 array of rotated segment end points, 3x3 rotation matrix)"""
+    segments, normal_angles, cell_counts = hough_line_segments(points, **hough_parameters)
+    if len(segments) == 0:
+        return segments, np.eye(3)
+
+    # the longest line of the direction (to a degree) with the most cells
+    directions = np.rint(np.degrees(normal_angles)).astype(int) % 180
+    primary = np.argmax(np.bincount(directions, weights=cell_counts))
+    longest = np.argmax(np.where(directions == primary, cell_counts, -1))
+    z_angle = normal_angles[longest] - np.pi / 2
+    rotation_matrix = R.from_euler("xyz", [0, 0, -z_angle]).as_matrix()
+    rotated = segments @ rotation_matrix[0:2, 0:2].T
+
+    if visualise:
+        pcd = arrays_to_cloud({"points": points @ rotation_matrix.T})
+        end_points = np.concatenate([rotated.reshape(-1, 2), np.zeros((2 * len(rotated), 1))], axis=1)
+        line_set = o3d.geometry.LineSet(
+            o3d.utility.Vector3dVector(end_points),
+            o3d.utility.Vector2iVector(np.arange(2 * len(rotated)).reshape(-1, 2)),
+        )
+        line_set.paint_uniform_color([1, 0, 0])
+        o3d.visualization.draw_geometries([pcd, line_set])
+
+    return rotated, rotation_matrix
+
+
 def main():
     visualise = False
     if len(sys.argv) > 2:
@@ -293,4 +713,9 @@ def main():
         os.makedirs(image_dir, exist_ok=True)
 
     # process point cloud
-    outputs, image_info = process(sys.argv[1], image_dir, visualise=visualise)
+    profiler = StageProfiler()
+    outputs, image_info = process(sys.argv[1], image_dir, visualise=visualise, profiler=profiler)
+
+    print(profiler.summary())
+    profiler.write_json(os.path.join(output_dir, "profile.json"))
+    profiler.write_chrome_trace(os.path.join(output_dir, "profile.trace.json"))
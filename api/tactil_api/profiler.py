@@ -0,0 +1,135 @@
+# Lightweight instrumentation of pipeline stages.
+# Records wall time, CPU time, peak resident memory and point counts for each stage,
+# and exports them as a dict (for API responses), JSON or a Chrome trace
+# (viewable in chrome://tracing or https://ui.perfetto.dev).
+import contextlib
+import dataclasses
+import json
+import os
+import re
+import resource
+import sys
+import time
+import typing
+
+
+@dataclasses.dataclass
+class StageRecord:
+    """Class for storing the measurements of one pipeline stage"""
+    name: str
+    start: float  # seconds since the profiler was created
+    wall_time: float = 0.0  # seconds
+    cpu_time: float = 0.0  # seconds, summed over all threads of this process
+    peak_rss: typing.Optional[int] = None  # bytes, high-water mark of resident memory during the stage
+    points_in: typing.Optional[int] = None
+    points_out: typing.Optional[int] = None
+    cached: bool = False  # output loaded from the stage cache rather than computed
+
+
+def _read_peak_rss() -> typing.Optional[int]:
+    """Resident memory high-water mark in bytes. On Linux this is since the last
+    _reset_peak_rss(), elsewhere it is the peak over the life of the process"""
+    try:
+        with open("/proc/self/status") as f:
+            match = re.search(r"VmHWM:\s+(\d+) kB", f.read())
+        if match is not None:
+            return int(match.group(1)) * 1024
+    except OSError:
+        pass
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def _reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")  # resets VmHWM to the current resident size
+    except OSError:
+        pass
+
+
+class StageProfiler:
+    """Records one StageRecord per stage, timed with the stage() context manager:
+
+        with profiler.stage("downsample", points_in=len(pcd.points)) as record:
+            pcd = pcd.voxel_down_sample(0.1)
+            record.points_out = len(pcd.points)
+
+    Stages should not be nested, since peak memory is tracked per process.
+    Work done in other processes (see parallel_map) is included in wall time only.
+    on_stage: optional callback, called with the name of each stage as it begins"""
+
+    def __init__(self, on_stage: typing.Optional[typing.Callable[[str], None]] = None):
+        self.on_stage = on_stage
+        self.stages: list[StageRecord] = []
+        self._origin = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name: str, points_in: typing.Optional[int] = None) -> typing.Iterator[StageRecord]:
+        if self.on_stage is not None:
+            self.on_stage(name)
+        record = StageRecord(name, start=time.perf_counter() - self._origin, points_in=points_in)
+        _reset_peak_rss()
+        wall_tic, cpu_tic = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        finally:
+            record.wall_time = time.perf_counter() - wall_tic
+            record.cpu_time = time.process_time() - cpu_tic
+            record.peak_rss = _read_peak_rss()
+            self.stages.append(record)
+
+    def report(self) -> dict:
+        return {
+            "total_wall_time": sum(s.wall_time for s in self.stages),
+            "total_cpu_time": sum(s.cpu_time for s in self.stages),
+            "peak_rss": max((s.peak_rss for s in self.stages if s.peak_rss is not None), default=None),
+            "stages": [dataclasses.asdict(s) for s in self.stages],
+        }
+
+    def chrome_trace(self) -> dict:
+        """The stages as complete ("X") events in the Chrome trace event format"""
+        events = []
+        for s in self.stages:
+            events.append({
+                "name": s.name,
+                "cat": "stage",
+                "ph": "X",
+                "ts": s.start * 1e6,  # microseconds
+                "dur": s.wall_time * 1e6,
+                "pid": os.getpid(),
+                "tid": 0,
+                "args": {
+                    "cpu_time": s.cpu_time,
+                    "peak_rss": s.peak_rss,
+                    "points_in": s.points_in,
+                    "points_out": s.points_out,
+                    "cached": s.cached,
+                },
+            })
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write_json(self, path: typing.Union[str, os.PathLike]):
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+
+    def write_chrome_trace(self, path: typing.Union[str, os.PathLike]):
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(), f)
+
+    def summary(self) -> str:
+        """The report as a human readable table"""
+        def count(n):
+            return "" if n is None else str(n)
+
+        lines = [f"{'stage':<12} {'wall (s)':>9} {'cpu (s)':>9} {'peak rss (MB)':>14} {'points in':>10} {'points out':>11}"]
+        for s in self.stages:
+            rss = "" if s.peak_rss is None else f"{s.peak_rss / 1e6:.0f}"
+            name = s.name + "*" if s.cached else s.name
+            lines.append(f"{name:<12} {s.wall_time:>9.3f} {s.cpu_time:>9.3f} {rss:>14} "
+                         f"{count(s.points_in):>10} {count(s.points_out):>11}")
+        report = self.report()
+        lines.append(f"{'total':<12} {report['total_wall_time']:>9.3f} {report['total_cpu_time']:>9.3f}")
+        if any(s.cached for s in self.stages):
+            lines.append("* loaded from the stage cache")
+        return "\n".join(lines)
@@ -0,0 +1,155 @@
+import fcntl
+import hashlib
+import json
+import os
+import typing
+
+# Bump when a change to the pipeline alters its output, so stale results are not served
+PIPELINE_VERSION = 10
+
+STATS_FILENAME = "stats.json"
+
+# (path, size, mtime) -> digest, so a file is only hashed again once it changes
+_digest_memo: typing.Dict[tuple, str] = {}
+
+
+def file_digest(path: typing.Union[str, os.PathLike], block_size: int = 1 << 20) -> str:
+    """sha256 of the file contents, read in blocks so large scans are never held in memory"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def cloud_digest(path: typing.Union[str, os.PathLike]) -> str:
+    """file_digest, memoised on the file's path, size and modification time"""
+    stat = os.stat(path)
+    memo_key = (os.path.realpath(path), stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _digest_memo:
+        _digest_memo[memo_key] = file_digest(path)
+    return _digest_memo[memo_key]
+
+
+def image_files_exist(image_info: dict, image_dir: typing.Union[str, os.PathLike]) -> bool:
+    """Whether the editor image (and tile source) of an ImageInfo are still in image_dir"""
+    if not os.path.exists(os.path.join(image_dir, image_info["filename"])):
+        return False
+    tiles = image_info.get("tiles")
+    return tiles is None or os.path.isdir(os.path.join(image_dir, tiles["id"]))
+
+
+class ResultCache:
+    """Persistent cache of process() results, keyed on the content of the point
+    cloud file and the pipeline parameters.
+
+    Entries are JSON files in cache_dir. The least recently used entries are
+    deleted once the total size exceeds max_bytes. Hit and miss counts are kept in
+    a stats file so they are shared by every server and pool worker process."""
+
+    def __init__(self, cache_dir: typing.Union[str, os.PathLike], max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def key(self, cloud_path: typing.Union[str, os.PathLike], params: dict) -> str:
+        key_data = json.dumps(
+            {"cloud": cloud_digest(cloud_path), "params": params, "version": PIPELINE_VERSION},
+            sort_keys=True,
+        )
+        return hashlib.sha256(key_data.encode()).hexdigest()
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + ".json")
+
+    def get(self, key: str, image_dir: typing.Union[str, os.PathLike]) -> typing.Optional[dict]:
+        """Returns the cached result, or None on a miss. A result whose editor image
+        (or tile source) has since been deleted from image_dir is treated as a miss."""
+        path = self._entry_path(key)
+        try:
+            with open(path) as f:
+                result = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self._count("misses")
+            return None
+
+        image_info = result.get("pcd_image_info")
+        if image_info is not None and not image_files_exist(image_info, image_dir):
+            self._remove(path)
+            self._count("misses")
+            return None
+
+        os.utime(path)  # mark as recently used
+        self._count("hits")
+        return result
+
+    def put(self, key: str, result: dict):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._entry_path(key)
+        tmp_path = path + f".{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(result, f)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        """Deletes least recently used entries until the cache fits in max_bytes"""
+        entries = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith(".json") and entry.name != STATS_FILENAME:
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            self._remove(path)
+            total_bytes -= size
+
+    def _remove(self, path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass  # already evicted by another process
+
+    def _count(self, counter: str):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(os.path.join(self.cache_dir, STATS_FILENAME), "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            contents = f.read()
+            counts = json.loads(contents) if contents else {}
+            counts[counter] = counts.get(counter, 0) + 1
+            f.seek(0)
+            f.truncate()
+            json.dump(counts, f)
+
+    def stats(self) -> dict:
+        try:
+            with open(os.path.join(self.cache_dir, STATS_FILENAME)) as f:
+                fcntl.flock(f, fcntl.LOCK_SH)
+                contents = f.read()
+                counts = json.loads(contents) if contents else {}
+        except FileNotFoundError:
+            counts = {}
+
+        entries = 0
+        total_bytes = 0
+        if os.path.exists(self.cache_dir):
+            with os.scandir(self.cache_dir) as it:
+                for entry in it:
+                    if entry.name.endswith(".json") and entry.name != STATS_FILENAME:
+                        entries += 1
+                        total_bytes += entry.stat().st_size
+
+        hits = counts.get("hits", 0)
+        misses = counts.get("misses", 0)
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses > 0 else 0.0,
+            "entries": entries,
+            "bytes": total_bytes,
+            "max_bytes": self.max_bytes,
+        }
@@ -0,0 +1,78 @@
+import hashlib
+import json
+import os
+import typing
+
+import numpy as np
+
+from .result_cache import PIPELINE_VERSION
+
+# A stage's output, as named arrays
+StageOutput = typing.Dict[str, np.ndarray]
+
+
+def stage_key(stage: str, parameters: dict, input_keys: typing.List[str]) -> str:
+    """Identifies a stage's output by the stage, its parameters and the keys of its inputs
+    (for the first stage, the digest of the point cloud), so a changed parameter changes
+    the key of its own stage and of every stage downstream of it"""
+    key_data = json.dumps(
+        {"stage": stage, "parameters": parameters, "inputs": input_keys, "version": PIPELINE_VERSION},
+        sort_keys=True,
+    )
+    return hashlib.sha256(key_data.encode()).hexdigest()
+
+
+class StageCache:
+    """Persistent cache of the intermediate outputs of process(), so re-running it with
+    some parameters changed only repeats the stages those parameters affect.
+
+    Entries are uncompressed .npz files in cache_dir, named by stage_key. The least
+    recently used entries are deleted once the total size exceeds max_bytes."""
+
+    def __init__(self, cache_dir: typing.Union[str, os.PathLike], max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + ".npz")
+
+    def contains(self, key: str) -> bool:
+        return os.path.exists(self._entry_path(key))
+
+    def get(self, key: str) -> typing.Optional[StageOutput]:
+        path = self._entry_path(key)
+        try:
+            with np.load(path, allow_pickle=False) as entry:
+                output = {name: entry[name] for name in entry.files}
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        os.utime(path)  # mark as recently used
+        return output
+
+    def put(self, key: str, output: StageOutput):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._entry_path(key)
+        # np.savez would append .npz to a name not ending in it
+        tmp_path = path + f".{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, **output)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        """Deletes least recently used entries until the cache fits in max_bytes"""
+        entries = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith(".npz") and ".tmp" not in entry.name:
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass  # already evicted by another process
+            total_bytes -= size
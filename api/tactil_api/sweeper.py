@@ -0,0 +1,82 @@
+import os
+import shutil
+import threading
+import time
+import typing
+
+from .cloud_reader import binary_cloud_dir, binary_cloud_lock_path
+
+
+def remove_entry(path: typing.Union[str, os.PathLike]):
+    """Removes a file or directory, ignoring one already removed (e.g. by another worker's sweeper)"""
+    try:
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def sweep_directory(directory: typing.Union[str, os.PathLike], max_age: float, now: typing.Optional[float] = None) -> int:
+    """Removes the files and directories in directory last modified more than max_age seconds
+    ago, with the binary clouds (see cloud_reader) of any removed point clouds.
+    Hidden entries (such as the binary clouds and in progress uploads) are left alone, other
+    than the temporary files of interrupted writes (.tmp).
+    :return: number of entries removed"""
+    now = time.time() if now is None else now
+    removed = 0
+    try:
+        entries = list(os.scandir(directory))
+    except FileNotFoundError:
+        return 0
+    for entry in entries:
+        if entry.name.startswith(".") and not entry.name.endswith(".tmp"):
+            continue
+        try:
+            modified = entry.stat(follow_symlinks=False).st_mtime
+        except FileNotFoundError:
+            continue
+        if now - modified > max_age:
+            remove_entry(entry.path)
+            if os.path.isdir(binary_cloud_dir(entry.path)):
+                remove_entry(binary_cloud_dir(entry.path))
+            remove_entry(binary_cloud_lock_path(entry.path))
+            removed += 1
+    return removed
+
+
+class OutputSweeper:
+    """Deletes what the API leaves on disk (models, images, uploads) once it outlives a time
+    to live, checking every interval seconds in a daemon thread.
+
+    Safe to run in every worker process at once: each entry is removed whole, and entries
+    already removed by another sweeper are skipped. Files being written are not at risk
+    while they are younger than their time to live, since writes go to new names."""
+
+    def __init__(self, directories: typing.Dict[typing.Union[str, os.PathLike], float], interval: float):
+        """directories: path -> time to live (seconds) of its entries"""
+        self.directories = directories
+        self.interval = interval
+        self._thread: typing.Optional[threading.Thread] = None
+
+    def sweep(self, now: typing.Optional[float] = None) -> int:
+        """Sweeps every directory once. :return: number of entries removed"""
+        return sum(sweep_directory(directory, max_age, now) for directory, max_age in self.directories.items())
+
+    def start(self):
+        """Sweeps in the background every interval seconds (never, if interval is not positive)"""
+        if self.interval <= 0 or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="output-sweeper", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                removed = self.sweep()
+                if removed:
+                    print(f"Swept {removed} expired outputs")
+            except OSError as e:
+                print(f"Output sweep failed: {e}")
+            time.sleep(self.interval)
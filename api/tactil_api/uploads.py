@@ -0,0 +1,121 @@
+import hashlib
+import json
+import os
+import typing
+import uuid
+
+from werkzeug.utils import secure_filename
+
+PARTIAL_DIRNAME = ".partial"
+BLOCK_SIZE = 1 << 20  # bytes read from the request per write, bounding memory use
+
+
+class UploadError(Exception):
+    """Base class for chunked upload errors, carrying the HTTP status to respond with"""
+    status_code = 400
+
+
+class UploadNotFoundError(UploadError):
+    status_code = 404
+
+
+class UploadOffsetError(UploadError):
+    status_code = 409
+
+    def __init__(self, message: str, offset: int):
+        super().__init__(message)
+        self.offset = offset
+
+
+class ChunkedUploads:
+    """Resumable uploads written straight to disk in chunks.
+
+    A client starts an upload with init(), sends chunks with write_chunk() at the
+    offset returned by offset() (so an interrupted transfer resumes where it stopped),
+    then calls finalize() to check the size and checksum and move the file into
+    upload_dir. Incomplete uploads live in upload_dir/.partial."""
+
+    def __init__(self, upload_dir: typing.Union[str, os.PathLike]):
+        self.upload_dir = upload_dir
+        self.partial_dir = os.path.join(upload_dir, PARTIAL_DIRNAME)
+
+    def _paths(self, upload_id: str) -> typing.Tuple[str, str]:
+        try:
+            uuid.UUID(hex=upload_id)  # only accept ids we could have generated
+        except ValueError:
+            raise UploadNotFoundError(f"Unknown upload {upload_id}")
+        base = os.path.join(self.partial_dir, upload_id)
+        return base + ".part", base + ".json"
+
+    def _info(self, upload_id: str) -> dict:
+        _, info_path = self._paths(upload_id)
+        try:
+            with open(info_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise UploadNotFoundError(f"Unknown upload {upload_id}")
+
+    def init(self, filename: str, size: int) -> str:
+        filename = secure_filename(filename)
+        if filename == "":
+            raise UploadError("Invalid filename")
+        if size < 0:
+            raise UploadError("Invalid size")
+
+        os.makedirs(self.partial_dir, exist_ok=True)
+        upload_id = uuid.uuid4().hex
+        part_path, info_path = self._paths(upload_id)
+        open(part_path, "wb").close()
+        with open(info_path, "w") as f:
+            json.dump({"filename": filename, "size": size}, f)
+        return upload_id
+
+    def offset(self, upload_id: str) -> int:
+        """Number of bytes received so far, i.e. where the next chunk should start"""
+        part_path, _ = self._paths(upload_id)
+        self._info(upload_id)
+        return os.path.getsize(part_path)
+
+    def status(self, upload_id: str) -> dict:
+        info = self._info(upload_id)
+        return {"upload_id": upload_id, "offset": self.offset(upload_id), **info}
+
+    def write_chunk(self, upload_id: str, offset: int, stream: typing.BinaryIO) -> int:
+        """Copies stream into the upload starting at offset, and returns the new offset.
+        Chunks may overlap data already received (e.g. a retried chunk) but not leave gaps."""
+        info = self._info(upload_id)
+        part_path, _ = self._paths(upload_id)
+        received = os.path.getsize(part_path)
+        if offset < 0 or offset > received:
+            raise UploadOffsetError(f"Chunk offset {offset} does not match received bytes {received}", received)
+
+        with open(part_path, "r+b") as f:
+            f.seek(offset)
+            while True:
+                block = stream.read(BLOCK_SIZE)
+                if not block:
+                    break
+                if f.tell() + len(block) > info["size"]:
+                    raise UploadError("Chunk extends past the declared file size")
+                f.write(block)
+            return max(f.tell(), received)
+
+    def finalize(self, upload_id: str, sha256: typing.Optional[str] = None) -> str:
+        """Verifies the completed upload and moves it into upload_dir. Returns the filename."""
+        info = self._info(upload_id)
+        part_path, info_path = self._paths(upload_id)
+        received = os.path.getsize(part_path)
+        if received != info["size"]:
+            raise UploadOffsetError(f"Upload incomplete: received {received} of {info['size']} bytes", received)
+
+        if sha256 is not None:
+            digest = hashlib.sha256()
+            with open(part_path, "rb") as f:
+                for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+                    digest.update(block)
+            if digest.hexdigest() != sha256.lower():
+                raise UploadError("Checksum mismatch")
+
+        os.replace(part_path, os.path.join(self.upload_dir, info["filename"]))
+        os.remove(info_path)
+        return info["filename"]
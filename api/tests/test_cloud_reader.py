@@ -0,0 +1,47 @@
+import numpy as np
+
+from tactil_api.cloud_reader import (CloudChunk, VoxelGridAccumulator, iter_binary_chunks, iter_cloud_chunks,
+                                     read_binary_cloud, write_binary_cloud)
+
+VOXEL_SIZE = 0.1
+
+
+def grid_cloud(offset: np.ndarray, seed: int = 0) -> np.ndarray:
+    """Points near the centres of voxels of a 10 m cube, several per voxel, moved by offset"""
+    rng = np.random.default_rng(seed)
+    centres = (rng.integers(0, 100, (2000, 3)) + 0.5) * VOXEL_SIZE
+    points = np.repeat(centres, 3, axis=0) + rng.uniform(-0.02, 0.02, (6000, 3))
+    return points + offset
+
+
+def downsampled_points(points: np.ndarray, scale: int = 1, chunk_size: int = 1000) -> np.ndarray:
+    accumulator = VoxelGridAccumulator(VOXEL_SIZE)
+    for start in range(0, len(points), chunk_size):
+        accumulator.add(CloudChunk(points[start:start + chunk_size], None, None))
+    downsampled = np.asarray(accumulator.to_point_cloud(scale).points)
+    return downsampled[np.lexsort(downsampled.T)]
+
+
+def test_georeferenced_cloud():
+    # UTM like coordinates, far beyond 2^20 voxels of the origin
+    offset = np.array([5e6, 5e6, 100.0])
+    for scale in (1, 2):
+        near = downsampled_points(grid_cloud(np.zeros(3)), scale)
+        far = downsampled_points(grid_cloud(offset), scale)
+        assert len(far) == len(near)
+        np.testing.assert_allclose(far - offset, near, atol=1e-6)
+
+
+def test_binary_cloud_keeps_georeferenced_precision(tmp_path):
+    # a 200 m scan at UTM like coordinates, beyond float32's precision if stored absolutely
+    rng = np.random.default_rng(0)
+    points = rng.uniform(0, 200, (5000, 3)) + np.array([5e6, 5e6, 100.0])
+    normals = rng.normal(size=(5000, 3))
+    path = tmp_path / "scan.xyz"
+    np.savetxt(path, np.concatenate([points, normals], axis=1), fmt="%.6f")
+    source = np.concatenate([chunk.points for chunk in iter_cloud_chunks(path)])
+
+    directory = write_binary_cloud(path, chunk_size=1000)
+    streamed = np.concatenate([chunk.points for chunk in iter_binary_chunks(directory, 1000)])
+    np.testing.assert_allclose(streamed, source, rtol=0, atol=1e-4)
+    np.testing.assert_allclose(np.asarray(read_binary_cloud(directory).points), source, rtol=0, atol=1e-4)
@@ -0,0 +1,53 @@
+import numpy as np
+
+from tactil_api.generate_stl import (PhysicalParameters, boxes_to_mesh, vector_map_to_box_properties, wall_box_vertices,
+                                     wall_meshes_per_box)
+from tactil_api.VectorMap import VectorMap
+
+MODEL_PARAMS = PhysicalParameters(
+    model_scale_factor=1 / 120, wall_height_mm=2.5, wall_thickness_mm=2.5, border_width_mm=5, floor_thickness_mm=5
+)
+
+
+def model_wall_vertices(vector_map: VectorMap) -> np.ndarray:
+    """Nx8x3 vertices (mm) of the walls of vector_map, as generate() builds them"""
+    boxes = vector_map_to_box_properties(vector_map)
+    scale = MODEL_PARAMS.model_scale_factor * 1000
+    return wall_box_vertices(
+        boxes.box_centers * scale, boxes.box_extents * scale, boxes.box_rotations, MODEL_PARAMS
+    )
+
+
+def test_joined_corner_is_flush():
+    # an L corner at the origin: one wall along x, one along y
+    vector_map = VectorMap.from_graph(np.array([[0.0, 0.0], [3.0, 0.0], [0.0, 2.0]]), np.array([[0, 1], [0, 2]]))
+    x_wall, y_wall = model_wall_vertices(vector_map)
+    half_thickness = MODEL_PARAMS.wall_thickness_mm / 2
+
+    # each wall reaches exactly to the other's outer face, leaving no gap and no stub
+    np.testing.assert_allclose(x_wall[:, 0].min(), y_wall[:, 0].min())
+    np.testing.assert_allclose(y_wall[:, 1].min(), x_wall[:, 1].min())
+    np.testing.assert_allclose(x_wall[:, 0].min(), -half_thickness)
+    np.testing.assert_allclose(y_wall[:, 1].min(), -half_thickness)
+
+
+def test_batched_walls_match_reference():
+    # a small random layout, in the form generate() passes to the builders (mm)
+    rng = np.random.default_rng(0)
+    wall_count = 20
+    centers = np.c_[rng.uniform(-200, 200, (wall_count, 2)), np.zeros(wall_count)]
+    extents = np.c_[rng.uniform(1, 50, wall_count), np.full(wall_count, 0.8), np.full(wall_count, 8)]
+    angles = rng.uniform(-np.pi, np.pi, wall_count)
+    rotations = np.zeros((wall_count, 3, 3))
+    rotations[:, 0, 0] = rotations[:, 1, 1] = np.cos(angles)
+    rotations[:, 0, 1] = -np.sin(angles)
+    rotations[:, 1, 0] = np.sin(angles)
+    rotations[:, 2, 2] = 1
+
+    reference = wall_meshes_per_box(centers, extents, rotations, MODEL_PARAMS)
+    batched = boxes_to_mesh(wall_box_vertices(centers, extents, rotations, MODEL_PARAMS))
+
+    # the same triangles (each face's vertices, in order) with the same facing
+    assert batched.vectors.shape == reference.vectors.shape == (wall_count * 12, 3, 3)
+    np.testing.assert_allclose(batched.vectors, reference.vectors, atol=1e-3)
+    np.testing.assert_allclose(batched.normals, reference.normals, atol=1e-3)
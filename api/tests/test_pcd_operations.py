@@ -0,0 +1,28 @@
+import numpy as np
+
+import pytest
+
+from tactil_api.pcd_operations import hough_line_segments, partition_indices_by_labels
+
+
+def test_partition_indices_by_labels():
+    groups = partition_indices_by_labels(np.array([1, -1, 0, 1, 2, -1, 0]))
+    assert [group.tolist() for group in groups] == [[2, 6], [0, 3], [4]]
+
+
+def test_partition_indices_by_labels_all_noise():
+    assert partition_indices_by_labels(np.array([-1, -1, -1])) == []
+    assert partition_indices_by_labels(np.array([], dtype=int)) == []
+
+
+@pytest.mark.parametrize("wall_x, noise", [(0.0, 0.02), (1.234, 0.02), (3.33, 0.02), (3.37, 0.03)])
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_noisy_wall_is_one_segment(wall_x, noise, seed):
+    # a 4 m wall along y, with points spread over neighbouring cell columns by the noise
+    rng = np.random.default_rng(seed)
+    points = np.c_[wall_x + rng.normal(0, noise, 4000), rng.uniform(0, 4, 4000), rng.uniform(0, 2, 4000)]
+    segments, _, _ = hough_line_segments(
+        points, cell_size=0.05, distance_threshold=0.05, min_line_cells=10, min_length=0.5, max_gap=0.3
+    )
+    assert len(segments) == 1
+    np.testing.assert_allclose(segments[0, :, 0], wall_x, atol=0.03)
@@ -2,14 +2,66 @@ import { distance } from "../geometry";
 
 // Backend URLs
 export const upload_url = "/api/upload";
+export const chunkedUploadUrl = "/api/upload/chunked";
 export const process_url = "/api/process";
+export const jobsUrl = "/api/jobs";
+export const presetsUrl = "/api/presets";
 export const generateUrl = "/api/generate";
 export const outputUrl = "/api/generate/output";
+export const imageOutputUrl = "/api/image_output";
+
+export function imageTileUrl(pyramidId: string, z: number, x: number, y: number) {
+    return `${imageOutputUrl}/${pyramidId}/${z}/${x}/${y}.png`;
+}
+
+// Each generated model has its own id (model_id in the generateUrl response)
+export function modelOutputUrl(modelId: string) {
+    return `${outputUrl}/${modelId}`;
+}
+
+export type StageRecord = {
+    name: string,
+    start: number, // seconds since processing began
+    wall_time: number, // seconds
+    cpu_time: number, // seconds
+    peak_rss: number | null, // bytes
+    points_in: number | null,
+    points_out: number | null,
+    cached: boolean, // loaded from the stage cache rather than computed
+};
+
+export type ProfileReport = {
+    total_wall_time: number,
+    total_cpu_time: number,
+    peak_rss: number | null,
+    stages: StageRecord[],
+};
 
 export type ProcessReponse = {
     initial_vector_map: VectorMapPython,
     pcd_image_info: ImageInfo,
     message: string,
+    profile: ProfileReport | null, // null when the result came from the cache
+};
+
+export type JobState = "queued" | "running" | "complete" | "failed";
+
+// Parameters of each pipeline stage, e.g. { plane_fit: { distance_threshold: 0.05 } }.
+// The full set for each preset is served from presetsUrl.
+export type StageParameters = Record<string, Record<string, number | string | boolean>>;
+
+// Named parameter sets trading accuracy for speed, sent with process_url as "preset"
+export type ProcessPreset = "fast" | "balanced" | "accurate";
+
+export type JobStatus = {
+    id: string,
+    state: JobState,
+    stages: Record<string, "pending" | "running" | "done">,
+    current_stage: string | null,
+    result: ProcessReponse | null,
+    error: string | null,
+    cloud_path: string | null,
+    parameters: StageParameters | null,
 };
 
 export type Dimensions = {
@@ -17,10 +69,22 @@ export type Dimensions = {
     height: number;
 };
 
+// Layout of a tile pyramid (XYZ scheme): zoom z has 2^z x 2^z tiles numbered from the top left,
+// and tile 0/0/0 is the square of side extent (metres) with top left corner (min_x, max_y)
+export type TilePyramidInfo = {
+    id: string,
+    tile_size: number, // pixels
+    max_zoom: number,
+    min_x: number,
+    max_y: number,
+    extent: number,
+}
+
 export type ImageInfo = {
     filename: string | undefined,
     world_dimensions: Dimensions, // height and width of the image in metres
     origin_camera: Coordinate, // world origin expressed in camera frame, metres (camera frame at center of image)
+    tiles?: TilePyramidInfo | null, // full detail tiles, served from imageTileUrl
 }
 
 export type BoxProperties = {
@@ -49,6 +113,90 @@ export async function postData(url = '', data = {}) {
     return response.json();
 };
 
+const UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024; // bytes
+const UPLOAD_MAX_RETRIES = 5;
+
+// Uploads a file in chunks so that a dropped connection only loses the current chunk.
+// The upload id is remembered so that retrying the same file (even after a reload) resumes it.
+export async function uploadFileChunked(file: File, onProgress: (fraction: number) => void): Promise<string> {
+    const resumeKey = "upload:" + file.name + ":" + file.size + ":" + file.lastModified;
+    let uploadId = localStorage.getItem(resumeKey);
+    let offset = 0;
+
+    if (uploadId !== null) {
+        const response = await fetch(chunkedUploadUrl + "/" + uploadId, { cache: 'no-cache' });
+        if (response.ok) {
+            offset = (await response.json()).offset;
+        } else {
+            uploadId = null;
+        }
+    }
+    if (uploadId === null) {
+        const init = await postData(chunkedUploadUrl, { filename: file.name, size: file.size });
+        uploadId = init.upload_id as string;
+        localStorage.setItem(resumeKey, uploadId);
+    }
+
+    let retries = 0;
+    while (offset < file.size) {
+        const chunk = file.slice(offset, offset + UPLOAD_CHUNK_SIZE);
+        try {
+            const response = await fetch(chunkedUploadUrl + "/" + uploadId + "?offset=" + offset, {
+                method: 'PUT',
+                headers: { 'Content-Type': 'application/octet-stream' },
+                body: chunk,
+            });
+            const body = await response.json();
+            if (!response.ok && response.status !== 409) {
+                throw new Error(body.message);
+            }
+            offset = body.offset; // on a 409 the server tells us where to continue from
+            retries = 0;
+            onProgress(offset / file.size);
+        } catch (error) {
+            retries += 1;
+            if (retries > UPLOAD_MAX_RETRIES) {
+                throw error;
+            }
+            await new Promise((resolve) => setTimeout(resolve, 1000 * retries));
+            const response = await fetch(chunkedUploadUrl + "/" + uploadId, { cache: 'no-cache' });
+            if (response.ok) {
+                offset = (await response.json()).offset;
+            }
+        }
+    }
+
+    const finalized = await postData(chunkedUploadUrl + "/" + uploadId + "/finalize", {});
+    localStorage.removeItem(resumeKey);
+    return finalized.filename;
+};
+
+// Queues a job's cloud again with some parameters changed, returning the new job's id.
+// Only the stages affected by the changed parameters are run again. With a preset, the
+// changes are made to the preset's parameters rather than the earlier job's.
+export async function rerunJob(jobId: string, parameters: StageParameters, preset?: ProcessPreset): Promise<string> {
+    const response = await postData(jobsUrl + "/" + jobId + "/rerun", { parameters: parameters, preset: preset });
+    return response.job_id;
+};
+
+// Polls a processing job until it completes, reporting the stage currently running
+export async function waitForJob(jobId: string, onProgress: (status: JobStatus) => void, intervalMs = 1000): Promise<ProcessReponse> {
+    while (true) {
+        const response = await fetch(jobsUrl + "/" + jobId, { cache: 'no-cache' });
+        if (!response.ok) {
+            throw new Error("Failed to fetch status of job " + jobId);
+        }
+        const status: JobStatus = await response.json();
+        onProgress(status);
+        if (status.state === "complete" && status.result !== null) {
+            return status.result;
+        } else if (status.state === "failed") {
+            throw new Error(status.error ?? "Processing failed");
+        }
+        await new Promise((resolve) => setTimeout(resolve, intervalMs));
+    }
+};
+
 export type Coordinate = {
     x: number,
     y: number,
@@ -1,7 +1,7 @@
 import React, { useEffect, useState } from 'react';
 import './Interface.css'
 import { useNavigate } from "react-router-dom";
-import { ProcessReponse, ImageInfo, VectorMap, deserializeVectorMap, postData, upload_url, process_url } from '../api/api';
+import { ProcessReponse, ImageInfo, VectorMap, deserializeVectorMap, postData, process_url, waitForJob, JobStatus, uploadFileChunked } from '../api/api';
 import example_api_response from './example_api_response.json';
 
 type UploadProps = {
@@ -12,6 +12,8 @@ type UploadProps = {
 function Upload(props: UploadProps) {
     const [isUploading, setIsUploading] = useState(false);
     const [isProcessing, setIsProcessing] = useState(false);
+    const [processingStage, setProcessingStage] = useState<string | null>(null);
+    const [uploadProgress, setUploadProgress] = useState(0);
     const navigate = useNavigate();
     // const isDevEnvironment = process.env.NODE_ENV === 'development';
     const [isDragging, setDragging] = useState(false);
@@ -24,21 +26,20 @@ function Upload(props: UploadProps) {
 
     const handleSubmission = (file: File) => {
         if (file != null) {
-            const formData = new FormData();
-            formData.append("file", file, file.name);
             setIsUploading(true);
-            fetch(upload_url, {
-                method: "POST",
-                body: formData
-            }).then((value: Response) => {
+            setUploadProgress(0);
+            uploadFileChunked(file, setUploadProgress).then((filename: string) => {
                 setIsUploading(false);
-                //TODO: check value.ok
-            }).then(() => {
+                return filename;
+            }).then((filename: string) => {
                 if (file != null) {
-                    const data = { "filename": file.name };
+                    const data = { "filename": filename };
                     setIsProcessing(true);
-                    postData(process_url, data).then((response: ProcessReponse) => {
+                    postData(process_url, data).then((job: { job_id: string }) => {
+                        return waitForJob(job.job_id, (status: JobStatus) => setProcessingStage(status.current_stage));
+                    }).then((response: ProcessReponse) => {
                         setIsProcessing(false);
+                        setProcessingStage(null);
                         const vectorMap = deserializeVectorMap(response);
                         props.setVectorMap(vectorMap);
                         props.setPcdImageInfo(response.pcd_image_info);
@@ -128,7 +129,8 @@ function Upload(props: UploadProps) {
                                 }
                                 {(isUploading || isProcessing) &&
                                     <div className='text-center'>
-                                        <p>{isProcessing ? "Processing..." : "Uploading..."}</p>
+                                        <p>{isProcessing ? "Processing..." : "Uploading... " + Math.round(uploadProgress * 100) + "%"}</p>
+                                        {isProcessing && processingStage !== null && <p>Stage: {processingStage}</p>}
                                         <div className='lds-dual-ring'></div>
                                     </div>
                                 }
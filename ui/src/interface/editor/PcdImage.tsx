@@ -1,6 +1,6 @@
 import { useState } from "react";
-import { Coordinate, ImageInfo } from "../../api/api";
-import { worldToPixel } from "../../geometry";
+import { Coordinate, ImageInfo, imageTileUrl, PIXEL_TO_WORLD_FACTOR, TilePyramidInfo } from "../../api/api";
+import { pixelToWorld, worldToPixel } from "../../geometry";
 
 type PcdImageProps = {
     imageInfo: ImageInfo,
@@ -8,6 +8,40 @@ type PcdImageProps = {
     panOffset: Coordinate,
 }
 
+type Tile = {
+    z: number,
+    x: number,
+    y: number,
+    topLeft: Coordinate, // world coordinates
+    side: number, // metres
+}
+
+// Tiles of the pyramid covering the visible part of the editor, at the coarsest zoom level
+// with at least as much detail as the screen
+function visibleTiles(tiles: TilePyramidInfo, zoomLevel: number, panOffset: Coordinate): Tile[] {
+    const screenPixelsPerMetre = zoomLevel / PIXEL_TO_WORLD_FACTOR;
+    const idealZoom = Math.ceil(Math.log2(screenPixelsPerMetre * tiles.extent / tiles.tile_size));
+    const z = Math.min(tiles.max_zoom, Math.max(0, idealZoom));
+    const tileCount = 2 ** z;
+    const side = tiles.extent / tileCount;
+
+    // the editor frame is never larger than the window, and positions are relative to its centre
+    const viewTopLeft = pixelToWorld({ x: -window.innerWidth / 2, y: -window.innerHeight / 2 }, panOffset, zoomLevel);
+    const viewBottomRight = pixelToWorld({ x: window.innerWidth / 2, y: window.innerHeight / 2 }, panOffset, zoomLevel);
+    const firstX = Math.max(0, Math.floor((viewTopLeft.x - tiles.min_x) / side));
+    const lastX = Math.min(tileCount - 1, Math.floor((viewBottomRight.x - tiles.min_x) / side));
+    const firstY = Math.max(0, Math.floor((tiles.max_y - viewTopLeft.y) / side));
+    const lastY = Math.min(tileCount - 1, Math.floor((tiles.max_y - viewBottomRight.y) / side));
+
+    const visible: Tile[] = [];
+    for (let x = firstX; x <= lastX; x++) {
+        for (let y = firstY; y <= lastY; y++) {
+            visible.push({ z, x, y, topLeft: { x: tiles.min_x + x * side, y: tiles.max_y - y * side }, side });
+        }
+    }
+    return visible;
+}
+
 function PcdImage(props: PcdImageProps) {
     const [hasImageError, setHasImageError] = useState(false);
 
@@ -34,6 +68,25 @@ function PcdImage(props: PcdImageProps) {
         setHasImageError(true);
     }
 
+    // full detail tiles are drawn over the overview image, which shows while they load
+    const tiles = props.imageInfo.tiles;
+    const tileImages = tiles ? visibleTiles(tiles, props.zoomLevel, props.panOffset).map((tile) => {
+        const position = worldToPixel(tile.topLeft, props.panOffset, props.zoomLevel);
+        const size = tile.side * props.zoomLevel / PIXEL_TO_WORLD_FACTOR;
+        return <img key={`${tile.z}/${tile.x}/${tile.y}`}
+            src={imageTileUrl(tiles.id, tile.z, tile.x, tile.y)}
+            style={{
+                left: 'calc(' + position.x + 'px + 50%)',
+                top: 'calc(' + position.y + 'px + 50%)',
+                position: 'absolute',
+                width: size,
+                height: size,
+                pointerEvents: 'none',
+            }} draggable={false}
+            alt=""
+        />
+    }) : [];
+
     return (
         <>
             {/* <img src={"http://localhost:5000/./image_output/f9fff180-7302-4b2c-9e3f-541d6934cc75.png"} */}
@@ -50,8 +103,9 @@ function PcdImage(props: PcdImageProps) {
                 }} draggable={false}
                 alt={"Room scan from bird's eye view"}
             />}
+            {tileImages}
         </>
     )
 }
 
-export default PcdImage;
\ No newline at end of file
+export default PcdImage;
@@ -1,5 +1,5 @@
 import { SyntheticEvent, useState } from 'react';
-import { postData, serializeVectorMap, VectorMap, generateUrl, outputUrl } from '../../api/api';
+import { postData, serializeVectorMap, VectorMap, generateUrl, modelOutputUrl } from '../../api/api';
 
 type GenerateProps = {
   vectorMap: VectorMap | undefined,
@@ -27,9 +27,9 @@ function Generate(props: GenerateProps) {
   const handleGenerate = (_: SyntheticEvent) => {
     if (props.vectorMap !== undefined) {
       const generatePayload = { "vector_map": serializeVectorMap(props.vectorMap), "model_params": modelParams };
-      postData(generateUrl, generatePayload).then(_ => {
+      postData(generateUrl, generatePayload).then(response => {
         // Automatically download file when it is ready
-        fetch(outputUrl).then((response) => {
+        fetch(modelOutputUrl(response.model_id)).then((response) => {
           response.blob().then((blob) => {
             // Create dummy link element to hold file
             const element = document.createElement("a");